@@ -0,0 +1,334 @@
+'''Benchmarks the server and the client over synthetic outputs, all on this machine, so that one run
+can be compared with another. Each benchmark times single operations, and reports the p50, p95 and
+p99 of their latency in seconds and the throughput over the whole benchmark. The server is driven
+through the Flask test client, except for block_verifier, which needs two servers that disagree on an
+output, and runs them on local ports.
+
+    python benchmarks.py run [num_outputs] [results.json]
+    python benchmarks.py compare results.json [baseline.json] [regression_factor]
+    python benchmarks.py metrics [num_outputs]
+    python benchmarks.py profile [num_outputs] [report.json] [baseline_report.json] [workers] [profile_dir]
+
+run writes its results as JSON, and compares them with the baseline in tests/baseline.json if that
+was made at the same scale. compare exits with status 1 if any benchmark regressed. Timings on a
+shared or virtual machine can differ by a third from one run to the next, so a larger factor, or
+the best of a few runs, is needed there.
+
+profile builds the forest from a scratch out_table with the build profiler on, adds the last tenth
+of the outputs as updates, and writes the phases that both took as a report, which it compares with
+an earlier report if given one.'''
+import time, sys, os, json, random, subprocess, platform, itertools, gc, sqlite3, tempfile, shutil
+from hashlib import sha256
+import numpy as np
+import requests
+import monero_server as server
+import monero_client as client
+import build_profile
+
+first_arg = sys.argv[1] if len(sys.argv) > 1 else None
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "baseline.json")
+# a benchmark whose p50 grew by more than this factor over the baseline is a regression
+regression_factor = 1.25
+# the ports that the two servers for block_verifier listen on
+conflict_ports = (5001, 5002)
+# the number of operations timed by each benchmark
+trials = {"build": 1000, "add_adjust": 1000, "getout": 1000, "getouts": 200, "check_path": 1000, "block_verifier": 20}
+# the number of outputs asked for by each /getouts request
+batch_size = 100
+
+def summarize(samples, elapsed, count=None, unit="operations"):
+    '''Returns the p50, p95 and p99 of the latencies in samples, in seconds, and the throughput in
+    unit per second, for count of them over elapsed seconds, or one per sample.'''
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {"n": len(samples), "p50": float(p50), "p95": float(p95), "p99": float(p99),
+        "mean": float(np.mean(samples)), "per_second": (len(samples) if count is None else count) / elapsed, "unit": unit}
+
+def synthetic_rows(num_outputs):
+    '''The synthetic rows of the out_table that every benchmark runs over, the same for every run.'''
+    from tree_bench import make_outkeys
+    return make_outkeys(num_outputs)
+
+def bench_build(rows):
+    '''Builds the forest over rows in one process, for the throughput in outputs per second, and then
+    times block_to_merkle over a sample of the blocks, for the latency of building one block.'''
+    server.merkle_forest = {}
+    gc.collect()
+    start = time.time()
+    server.scan_over_new_blocks(rows, workers=1)
+    elapsed = time.time() - start
+    blocks = list(server.group_blocks(rows))
+    samples = []
+    for block_outkeys in random.sample(blocks, min(trials["build"], len(blocks))):
+        t = time.time()
+        server.block_to_merkle(block_outkeys)
+        samples.append(time.time() - t)
+    return summarize(samples, elapsed, len(rows), "outputs")
+
+def bench_add_adjust(blocks):
+    '''Adds the blocks to the built forest one at a time, as /update does, timing each.'''
+    server.queue_new_blocks(itertools.chain.from_iterable(blocks))
+    samples = []
+    start = time.time()
+    while True:
+        t = time.time()
+        if not server.add_blocks(count=1):
+            break
+        samples.append(time.time() - t)
+    return summarize(samples, time.time() - start, unit="blocks")
+
+def bench_getout(c):
+    '''Asks /getout for random outputs, timing each request. Returns the results, and the
+    responses for bench_check_path.'''
+    picks = np.random.randint(0, server.top_root[1] + 1, trials["getout"])
+    samples, responses = [], []
+    start = time.time()
+    for idx in picks:
+        t = time.time()
+        r = c.get("/getout", data=json.dumps({"idx": int(idx)}), content_type="application/json")
+        samples.append(time.time() - t)
+        responses.append(json.loads(r.data))
+    return summarize(samples, time.time() - start, unit="requests"), responses
+
+def bench_getouts(c):
+    '''Asks /getouts for batches of random outputs, timing each request, with the throughput
+    in outputs per second.'''
+    samples = []
+    start = time.time()
+    for _ in range(trials["getouts"]):
+        picks = [int(idx) for idx in np.random.randint(0, server.top_root[1] + 1, batch_size)]
+        t = time.time()
+        c.get("/getouts", data=json.dumps({"idx": picks}), content_type="application/json")
+        samples.append(time.time() - t)
+    return summarize(samples, time.time() - start, trials["getouts"] * batch_size, "outputs")
+
+def bench_check_path(responses):
+    '''Checks the proofs that bench_getout got back, timing each check.'''
+    samples = []
+    start = time.time()
+    for r in responses:
+        t = time.time()
+        ok = client.check_path(r["found"], r["proof"], server.top_root)
+        samples.append(time.time() - t)
+        assert ok, r["found"]
+    return summarize(samples, time.time() - start, unit="proofs")
+
+def serve(num_outputs, port, corrupt=None):
+    '''Serves the forest over the synthetic rows on a local port, with the output key of the output
+    at index corrupt replaced, for bench_block_verifier to find.'''
+    rows = synthetic_rows(num_outputs)
+    if corrupt is not None:
+        block_hash, tx_hash, _, idx = rows[corrupt]
+        rows[corrupt] = (block_hash, tx_hash, sha256("corrupt%d" % idx).hexdigest(), idx)
+    server.snapshot_path = server.delta_log_path = None
+    server.scan_over_new_blocks(rows, workers=1)
+    server.app.run(port=port, threaded=True)
+
+def bench_block_verifier(num_outputs):
+    '''Starts two servers over the synthetic rows, one of them with a random output changed, and
+    times block_verifier finding the conflict between them.'''
+    corrupt = random.randrange(num_outputs)
+    args = [[str(num_outputs), str(conflict_ports[0])], [str(num_outputs), str(conflict_ports[1]), str(corrupt)]]
+    pids = [subprocess.Popen([sys.executable, __file__, "serve"] + a, stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+        for a in args]
+    try:
+        client.server1, client.server2 = ["http://127.0.0.1:%d" % port for port in conflict_ports]
+        roots = []
+        for address in (client.server1, client.server2):
+            while True:
+                if any(pid.poll() is not None for pid in pids):
+                    raise RuntimeError("A block_verifier server exited before it was up.")
+                try:
+                    roots.append(tuple(requests.get(address+"/getroot").json()["root"]))
+                    break
+                except requests.ConnectionError:
+                    time.sleep(0.5)
+        samples = []
+        start = time.time()
+        for _ in range(trials["block_verifier"]):
+            t = time.time()
+            client.block_verifier(roots[0], roots[1])
+            samples.append(time.time() - t)
+        return summarize(samples, time.time() - start, unit="conflicts")
+    finally:
+        for pid in pids:
+            pid.terminate()
+            pid.wait()
+
+def run(num_outputs):
+    '''Runs every benchmark over num_outputs synthetic outputs. The forest is built over most of
+    them, and the last blocks are left for add_adjust. Returns the results.'''
+    random.seed(1)
+    np.random.seed(1)
+    server.snapshot_path = server.delta_log_path = None
+    rows = synthetic_rows(num_outputs)
+    blocks = list(server.group_blocks(rows))
+    num_added = min(trials["add_adjust"], max(1, len(blocks) // 10))
+    results = {}
+    results["build"] = bench_build(list(itertools.chain.from_iterable(blocks[:-num_added])))
+    results["add_adjust"] = bench_add_adjust(blocks[-num_added:])
+    c = server.app.test_client()
+    results["getout"], responses = bench_getout(c)
+    results["getouts"] = bench_getouts(c)
+    results["check_path"] = bench_check_path(responses)
+    results["block_verifier"] = bench_block_verifier(num_outputs)
+    return {"num_outputs": len(rows), "blocks": len(blocks), "hash": server.hash_backend,
+        "python": platform.python_version(), "machine": platform.machine(), "time": time.time(), "results": results}
+
+def metrics_overhead(num_outputs, rounds=20):
+    '''Builds the forest over num_outputs synthetic outputs, and runs bench_getout with request
+    metrics on and off in turn over the same outputs, the one that goes first alternating from round
+    to round. Returns, for each round, the cost of metrics as a fraction of the p50 and of the
+    throughput of /getout, along with the median p50 without them; the seconds the metrics hooks take
+    per request, timed on their own; and the time taken by the first and by a later /metrics.'''
+    random.seed(1)
+    np.random.seed(1)
+    server.snapshot_path = server.delta_log_path = None
+    server.merkle_forest = {}
+    server.scan_over_new_blocks(synthetic_rows(num_outputs), workers=1)
+    c = server.app.test_client()
+    metrics = server.RequestMetrics()
+    costs, off_p50s = [], []
+    for i in range(rounds):
+        runs = {}
+        for enabled in ((True, False) if i % 2 == 0 else (False, True)):
+            server.request_metrics = metrics if enabled else None
+            # both runs of a round ask for the same outputs, from a cold proof cache
+            np.random.seed(i)
+            server.proof_cache.clear()
+            gc.collect()
+            result, _ = bench_getout(c)
+            runs[enabled] = (result["p50"], result["per_second"])
+        costs.append((runs[True][0] / runs[False][0] - 1, 1 - runs[True][1] / runs[False][1]))
+        off_p50s.append(runs[False][0])
+    server.request_metrics = metrics
+    with server.app.test_request_context("/getout"):
+        t = time.time()
+        for _ in xrange(100000):
+            server.start_request_timer()
+            server.record_request(None)
+        hooks = (time.time() - t) / 100000
+    scrapes = []
+    for _ in range(2):
+        t = time.time()
+        c.get("/metrics")
+        scrapes.append(time.time() - t)
+    return costs, np.median(off_p50s), hooks, scrapes
+
+def profile_build(num_outputs, workers=1, profile_dir=None, update_batch=100):
+    '''Writes num_outputs synthetic outputs to the out_table of a scratch database, builds the forest
+    from the first nine tenths of them, and adds the rest in batches of update_batch blocks, first
+    with the build profiler and then without it. The profiled run goes first, since the peak RSS that
+    its phases record the growth of would otherwise have been reached already. Returns the profiler's
+    report, along with the seconds the build and the updates took without it.'''
+    rows = synthetic_rows(num_outputs)
+    split = rows[len(rows) * 9 // 10][3]
+    server.snapshot_path = server.delta_log_path = None
+    server.build_workers = workers
+    scratch = tempfile.mkdtemp()
+    try:
+        database = os.path.join(scratch, "out")
+        conn = sqlite3.connect(database + ".db")
+        conn.execute('''CREATE TABLE out_table (block_hash text, tx_hash text, outkey text, idx integer primary key)''')
+        conn.executemany('''INSERT INTO out_table VALUES (?,?,?,?)''', rows)
+        conn.commit()
+        conn.close()
+        del rows
+        seconds = {}
+        report = None
+        for profiler in (build_profile.BuildProfiler(label="benchmark", profile_dir=profile_dir), None):
+            server.merkle_forest = {}
+            gc.collect()
+            server.build_profiler = profiler.start() if profiler is not None else None
+            start = time.time()
+            # the build stops at the end of the block that the split falls in
+            server.scan_over_new_blocks(itertools.takewhile(lambda row: row[3] <= split,
+                server.stream_outkeys(database)), workers=workers)
+            built = time.time()
+            server.queue_new_blocks(server.stream_outkeys(database, start_idx=server.top_root[1]))
+            while server.add_blocks(count=update_batch):
+                pass
+            if profiler is None:
+                seconds["build"], seconds["update"] = built - start, time.time() - built
+            else:
+                server.build_profiler = None
+                report = profiler.stop().report(num_outputs=num_outputs, workers=workers, hash=server.hash_backend)
+        report["unprofiled_seconds"] = seconds
+        return report
+    finally:
+        server.build_profiler = None
+        shutil.rmtree(scratch)
+
+def compare(results, baseline, factor=regression_factor):
+    '''Prints how each benchmark in results compares with the baseline, and returns the names of
+    those whose p50 grew by more than factor.'''
+    if results["num_outputs"] != baseline["num_outputs"]:
+        print "The baseline is over %d outputs, and these results over %d, so they may not compare."%(
+            baseline["num_outputs"], results["num_outputs"])
+    regressed = []
+    for name, new in sorted(results["results"].items()):
+        old = baseline["results"].get(name)
+        if old is None:
+            print "%s: not in the baseline."%(name)
+            continue
+        ratio = new["p50"] / old["p50"]
+        if ratio > factor:
+            regressed.append(name)
+        print "%s: p50 %.6f -> %.6f seconds (x%.2f), %.1f -> %.1f %s per second%s."%(
+            name, old["p50"], new["p50"], ratio, old["per_second"], new["per_second"], new["unit"],
+            ", a regression" if ratio > factor else "")
+    return regressed
+
+def main():
+    if first_arg=="run":
+        num_outputs = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        results_path = sys.argv[3] if len(sys.argv) > 3 else "results.json"
+        print "Benchmarking over %d synthetic outputs..."%(num_outputs)
+        results = run(num_outputs)
+        for name, r in sorted(results["results"].items()):
+            print "%s: p50 %.6f, p95 %.6f, p99 %.6f seconds, %.1f %s per second."%(
+                name, r["p50"], r["p95"], r["p99"], r["per_second"], r["unit"])
+        with open(results_path, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True, separators=(",", ": "))
+        if os.path.isfile(baseline_path) and os.path.abspath(results_path) != baseline_path:
+            with open(baseline_path) as f:
+                baseline = json.load(f)
+            if baseline["num_outputs"] == results["num_outputs"]:
+                compare(results, baseline)
+    elif first_arg=="compare":
+        with open(sys.argv[2]) as f:
+            results = json.load(f)
+        with open(sys.argv[3] if len(sys.argv) > 3 else baseline_path) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, float(sys.argv[4]) if len(sys.argv) > 4 else regression_factor):
+            sys.exit(1)
+    elif first_arg=="metrics":
+        num_outputs = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        print "Timing /getout with and without request metrics over %d synthetic outputs..."%(num_outputs)
+        costs, off_p50, hooks, scrapes = metrics_overhead(num_outputs)
+        p50_costs, rate_costs = 100 * np.array(costs).T
+        print "Over %d interleaved rounds, metrics cost a median %.2f%% of the p50 (%.2f%% to %.2f%%) and %.2f%% of the throughput (%.2f%% to %.2f%%)."%(
+            len(costs), np.median(p50_costs), min(p50_costs), max(p50_costs), np.median(rate_costs), min(rate_costs), max(rate_costs))
+        print "The metrics hooks take %.1f microseconds a request, timed on their own, which is %.2f%% of the p50 of %.6f seconds without metrics."%(
+            hooks * 1e6, 100 * hooks / off_p50, off_p50)
+        print "/metrics took %.6f seconds with a pass over the forest, and %.6f seconds after."%(scrapes[0], scrapes[1])
+    elif first_arg=="profile":
+        num_outputs = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        report_path = sys.argv[3] if len(sys.argv) > 3 else "build_profile.json"
+        workers = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+        print "Profiling the build and updates over %d synthetic outputs in %d workers..."%(num_outputs, workers)
+        report = profile_build(num_outputs, workers, sys.argv[6] if len(sys.argv) > 6 else None)
+        print "\n".join(build_profile.format_report(report))
+        print "Without the profiler, the build took %.3f seconds and the updates %.3f seconds."%(
+            report["unprofiled_seconds"]["build"], report["unprofiled_seconds"]["update"])
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True, separators=(",", ": "))
+        if len(sys.argv) > 4 and sys.argv[4] != "-":
+            with open(sys.argv[4]) as f:
+                print "\n".join(build_profile.compare(report, json.load(f)))
+    elif first_arg=="serve":
+        serve(int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]) if len(sys.argv) > 4 else None)
+    else:
+        print "Please provide a valid argument."
+
+if __name__ == '__main__':
+    main()
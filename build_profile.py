@@ -0,0 +1,250 @@
+'''An opt-in profiler for building and updating the forest, which splits the time taken into phases:
+
+    build         building the forest, with its own time being what no other phase covers
+    update        adding blocks to the forest, likewise
+    sqlite        fetching rows from the out_table
+    pickle        loading or dumping the pickled utxos
+    group         grouping rows into blocks and txs
+    allocate      making the FlatMerkleTrees of the txs in a block
+    hash          building those trees, hashing inline outputs, and building the block's tree over them
+    insert        putting trees into the merkle_forest
+    serialize     serializing trees in a build worker, and deserializing them back
+    workers       waiting on the build workers
+    top           building or extending the top Merkle tree
+    log           appending to the delta log
+    publish       publishing the new snapshot of the forest
+    compact       folding the delta log into a new snapshot, once it has grown long enough
+
+Phases nest, as rows are fetched while they are grouped, so each phase records both its total time
+and its own time, without the phases inside it. For each phase the report gives the number of calls,
+the seconds, and, when tracemalloc is tracing, the peak memory traced while in it above what was
+traced on entering. Python 2 has no tracemalloc unless pytracemalloc is installed, and only Python
+3.9 can reset the traced peak, so without either the report gives the net memory allocated in each
+phase instead, or no memory at all. Whenever memory is traced, with or without tracemalloc, each
+phase also has rss_kb, how much the process's peak RSS grew while in it, summed over its calls. The
+peak only ever grows, so this blames the phases that first needed the memory, as the build phases
+are the ones that take it, and counts the phases inside a phase in its growth too. The process's
+peak RSS is always given.
+
+Entering and leaving a phase costs a few microseconds, and a build enters several phases for every
+block, so a profiled build takes longer than one that is not, by 20-60% over the synthetic outputs.
+Most of that lands in the own time of the phase around the calls, such as build. benchmarks.py
+profile measures it. When build_profiler is None, each phase costs one with statement.
+
+With a profile_dir, each phase also has its own cProfile, which is on only while that phase is the
+innermost one, and is dumped to profile_dir/<phase>.prof.
+
+The phases of one thread nest but those of two threads do not, so only the thread that entered the
+outermost phase is profiled until it leaves it. The server enters build or update for the whole of
+each one, under the update lock, so the rows that a build worker pool is fed from another thread are
+left out, and updates from any thread are profiled one at a time.
+
+A report is plain JSON, so reports from two releases can be compared with compare.'''
+import time, os, platform, resource, threading
+import cProfile
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+# whether the peak that tracemalloc traces can be reset, so that each phase has a peak of its own
+can_reset_peak = hasattr(tracemalloc, "reset_peak")
+
+class Frame(object):
+    __slots__ = ['name', 'start', 'child_seconds', 'start_memory', 'peak_memory', 'start_rss']
+
+    def __init__(self, name, start, start_memory, start_rss):
+        self.name = name
+        self.start = start
+        self.child_seconds = 0.0
+        self.start_memory = start_memory
+        self.peak_memory = start_memory
+        self.start_rss = start_rss
+
+class Phase(object):
+    '''The context manager that BuildProfiler.phase returns, which times one call of a phase.'''
+    __slots__ = ['profiler', 'name']
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.enter(self.name)
+
+    def __exit__(self, *exc):
+        self.profiler.exit()
+
+class NullPhase(object):
+    '''Stands in for a phase when profiling is off, so that it costs one with statement.'''
+    __slots__ = []
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+null_phase = NullPhase()
+
+class BuildProfiler(object):
+    '''Records the calls, seconds and memory of each phase of a build or update. trace_memory starts
+    tracemalloc, if there is one, for as long as the profiler is started, and records the growth of
+    the peak RSS in each phase. Phases can be merged in from
+    the report of a profiler that ran elsewhere, such as in a build worker, in which case their seconds
+    are summed over the workers rather than wall time.'''
+
+    def __init__(self, label=None, trace_memory=True, profile_dir=None):
+        self.label = label
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        # name -> [calls, seconds, own seconds, memory, rss KB]
+        self.phases = {}
+        self.profiles = {}
+        self.stack = []
+        self.started = None
+        self.elapsed = 0.0
+        self.started_tracing = False
+        self.tracing = False
+        self.owner = None
+        # one Phase per name, since a phase can be entered hundreds of thousands of times
+        self.phase_objects = {}
+
+    def phase(self, name):
+        if self.started is None or (self.stack and threading.current_thread() is not self.owner):
+            return null_phase
+        phase = self.phase_objects.get(name)
+        if phase is None:
+            phase = self.phase_objects[name] = Phase(self, name)
+        return phase
+
+    def start(self):
+        if self.trace_memory and tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        self.tracing = self.trace_memory and tracemalloc is not None and tracemalloc.is_tracing()
+        self.started = time.time()
+        return self
+
+    def stop(self):
+        while self.stack:
+            self.exit()
+        if self.started is not None:
+            self.elapsed += time.time() - self.started
+            self.started = None
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        self.tracing = False
+        if self.profile_dir is not None:
+            if not os.path.isdir(self.profile_dir):
+                os.makedirs(self.profile_dir)
+            for name, profile in self.profiles.items():
+                profile.dump_stats(os.path.join(self.profile_dir, name + ".prof"))
+        return self
+
+    def enter(self, name):
+        stack = self.stack
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak_memory = max(stack[-1].peak_memory, peak)
+            if can_reset_peak:
+                tracemalloc.reset_peak()
+        else:
+            current = None
+        if not stack:
+            self.owner = threading.current_thread()
+        elif self.profile_dir is not None:
+            self.profiles[stack[-1].name].disable()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if self.trace_memory else None
+        stack.append(Frame(name, time.time(), current, rss))
+        if self.profile_dir is not None:
+            profile = self.profiles.get(name)
+            if profile is None:
+                profile = self.profiles[name] = cProfile.Profile()
+            profile.enable()
+
+    def exit(self):
+        frame = self.stack.pop()
+        if self.profile_dir is not None:
+            self.profiles[frame.name].disable()
+        seconds = time.time() - frame.start
+        memory = None
+        if self.tracing and frame.start_memory is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            if can_reset_peak:
+                frame.peak_memory = max(frame.peak_memory, peak)
+                memory = frame.peak_memory - frame.start_memory
+                tracemalloc.reset_peak()
+            else:
+                memory = current - frame.start_memory
+        entry = self.phases.get(frame.name)
+        if entry is None:
+            entry = self.phases[frame.name] = [0, 0.0, 0.0, None, None]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += seconds - frame.child_seconds
+        if memory is not None:
+            entry[3] = memory if entry[3] is None else max(entry[3], memory)
+        if frame.start_rss is not None:
+            entry[4] = (entry[4] or 0) + resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - frame.start_rss
+        if self.stack:
+            parent = self.stack[-1]
+            parent.child_seconds += seconds
+            if memory is not None:
+                parent.peak_memory = max(parent.peak_memory, frame.peak_memory)
+            if self.profile_dir is not None:
+                self.profiles[parent.name].enable()
+
+    def merge(self, report):
+        '''Adds the phases of another profiler's report to this one's.'''
+        for name, other in report["phases"].items():
+            entry = self.phases.get(name)
+            if entry is None:
+                entry = self.phases[name] = [0, 0.0, 0.0, None, None]
+            entry[0] += other["calls"]
+            entry[1] += other["seconds"]
+            entry[2] += other["own_seconds"]
+            if other["memory"] is not None:
+                entry[3] = other["memory"] if entry[3] is None else max(entry[3], other["memory"])
+            if other.get("rss_kb") is not None:
+                entry[4] = (entry[4] or 0) + other["rss_kb"]
+
+    def report(self, **extra):
+        '''Returns the phases as a dict that can be written as JSON, along with anything in extra.'''
+        elapsed = self.elapsed + (time.time() - self.started if self.started is not None else 0.0)
+        if tracemalloc is None:
+            memory = None
+        else:
+            memory = "peak" if hasattr(tracemalloc, "reset_peak") else "net"
+        result = {"label": self.label, "seconds": elapsed, "python": platform.python_version(),
+            "machine": platform.machine(), "time": time.time(),
+            "memory": memory if self.trace_memory else None,
+            "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "phases": dict((name, {"calls": calls, "seconds": seconds, "own_seconds": own, "memory": mem, "rss_kb": rss})
+                for name, (calls, seconds, own, mem, rss) in self.phases.items())}
+        result.update(extra)
+        return result
+
+def format_report(report):
+    '''Returns the phases of a report as lines of text, slowest first by their own time.'''
+    lines = ["%-12s %10s %12s %12s %14s %10s" % ("phase", "calls", "seconds", "own seconds", "memory bytes", "rss KB")]
+    for name, p in sorted(report["phases"].items(), key=lambda item: -item[1]["own_seconds"]):
+        lines.append("%-12s %10d %12.3f %12.3f %14s %10s" % (name, p["calls"], p["seconds"], p["own_seconds"],
+            "-" if p["memory"] is None else p["memory"], "-" if p.get("rss_kb") is None else p["rss_kb"]))
+    lines.append("%.3f seconds in all, peak RSS %d KB." % (report["seconds"], report["maxrss_kb"]))
+    return lines
+
+def compare(report, baseline):
+    '''Returns lines comparing the own seconds of each phase in report with those in baseline.'''
+    lines = []
+    for name in sorted(set(report["phases"]) | set(baseline["phases"])):
+        new, old = report["phases"].get(name), baseline["phases"].get(name)
+        if new is None or old is None:
+            lines.append("%s: only in the %s." % (name, "baseline" if new is None else "new report"))
+            continue
+        ratio = new["own_seconds"] / old["own_seconds"] if old["own_seconds"] else float("inf")
+        lines.append("%s: %.3f -> %.3f own seconds (x%.2f), %d -> %d calls." % (
+            name, old["own_seconds"], new["own_seconds"], ratio, old["calls"], new["calls"]))
+    lines.append("in all: %.3f -> %.3f seconds." % (baseline["seconds"], report["seconds"]))
+    return lines
@@ -1,10 +1,14 @@
-import time, sys, requests, os, random, string
+import time, sys, requests, os, random, string, subprocess, json
+import gevent
+from gevent import socket
 import monero_client as client
 import monero_server as server
 import numpy as np
 from multiprocessing import Process
 
 first_arg = sys.argv[1]
+# for conflict, compare this many levels per round trip with subtree_verifier instead of block_verifier
+subtree_depth = int(sys.argv[2]) if len(sys.argv) > 2 else None
 server1, server2 = client.server1, client.server2
 
 def testup():
@@ -49,7 +53,10 @@ def conflict_resolve():
     client.main()
     t1_root, t2_root = client.t1_root, client.t2_root
     start = time.time()
-    client.block_verifier(t1_root, t2_root)
+    if subtree_depth:
+        client.subtree_verifier(t1_root, t2_root, subtree_depth)
+    else:
+        client.block_verifier(t1_root, t2_root)
     end = time.time()
     pid.terminate()
     elapsed = end - start
@@ -83,6 +90,142 @@ def proof_test(server):
     elapsed = end - start
     return elapsed
 
+local_server = "http://127.0.0.1:5000"
+
+def raw_get(path, payload, sse=False):
+    '''Sends a GET with a JSON payload to the local server over a socket of its own, as a simulated
+    client that costs less than requests does. Returns a file to read the response from.'''
+    body = json.dumps(payload)
+    sock = socket.create_connection(("127.0.0.1", 5000))
+    sock.sendall("GET %s HTTP/1.0\r\nContent-Type: application/json\r\nContent-Length: %d\r\n%s\r\n%s"%(
+        path, len(body), "Accept: text/event-stream\r\n" if sse else "", body))
+    response = sock.makefile("rb")
+    sock.close()
+    return response
+
+def raw_json(path, payload):
+    '''Returns the JSON body of the response to raw_get, trying again if the connection is refused
+    or reset, as it is when more clients connect at once than the server has a backlog for.'''
+    while True:
+        try:
+            response = raw_get(path, payload)
+            try:
+                return json.loads(response.read().split("\r\n\r\n", 1)[1])
+            finally:
+                response.close()
+        except (socket.error, IndexError):
+            gevent.sleep(0.1)
+
+class KeptConnection(object):
+    '''A keep-alive connection to the local server, over which a simulated client sends one GET
+    with a JSON payload after another, as a client with a requests.Session does, rather than making a
+    connection for each one. It connects again if the connection is refused or reset.'''
+
+    def __init__(self):
+        self.sock = self.rfile = None
+
+    def get_json(self, path, payload):
+        body = json.dumps(payload)
+        while True:
+            try:
+                if self.sock is None:
+                    self.sock = socket.create_connection(("127.0.0.1", 5000))
+                    self.rfile = self.sock.makefile("rb")
+                self.sock.sendall("GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s"%(
+                    path, len(body), body))
+                length = None
+                line = self.rfile.readline()
+                if not line:
+                    raise socket.error("connection closed")
+                while line not in ("\r\n", ""):
+                    if line.lower().startswith("content-length:"):
+                        length = int(line.split(":", 1)[1])
+                    line = self.rfile.readline()
+                return json.loads(self.rfile.read(length))
+            except (socket.error, TypeError, ValueError):
+                self.close()
+                gevent.sleep(0.1)
+
+    def close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+        self.sock = self.rfile = None
+
+def subscriber_load(num_clients, num_updates, mode, interval=1.0, spacing=2.0):
+    '''Has num_clients simulated clients follow the top root of the local server while it is updated
+    num_updates times, spacing seconds apart. In mode "poll", every client calls /getroot every interval
+    seconds, and otherwise it subscribes to /subscribe, by "longpoll" or "sse". Returns the number of
+    requests the clients made, and the delays from when each root was published to when each client saw it.'''
+    published, seen, ready, made = {}, [], set(), [0]
+    def poller(i):
+        last = None
+        gevent.sleep(random.random() * interval)
+        while True:
+            made[0] += 1
+            root = tuple(raw_json("/getroot", {})["root"])
+            if root != last:
+                seen.append((root, time.time()))
+                last = root
+            ready.add(i)
+            gevent.sleep(interval)
+    def long_poller(i):
+        # the connection is kept alive between polls, so a new root does not set off a burst of
+        # 1000 clients connecting again at once, which delays the responses that are still going out
+        after = 0
+        connection = KeptConnection()
+        while True:
+            made[0] += 1
+            event = connection.get_json("/subscribe", {"after": after})
+            if event["seq"] != after:
+                seen.append((tuple(event["root"]), time.time()))
+                after = event["seq"]
+            ready.add(i)
+    def sse_subscriber(i):
+        made[0] += 1
+        for line in raw_get("/subscribe", {}, sse=True):
+            if line.startswith("data: "):
+                seen.append((tuple(json.loads(line[6:])["root"]), time.time()))
+                ready.add(i)
+    follow = {"poll": poller, "longpoll": long_poller, "sse": sse_subscriber}[mode]
+    clients = [gevent.spawn(follow, i) for i in range(num_clients)]
+    while len(ready) < num_clients:
+        gevent.sleep(0.1)
+    made[0] = 0
+    del seen[:]
+    start = time.time()
+    for _ in range(num_updates):
+        gevent.sleep(spacing)
+        client.session.post(local_server+"/update")
+        event = raw_json("/subscribe", {"after": -1})
+        published[tuple(event["root"])] = event["published"]
+    gevent.sleep(spacing)
+    gevent.killall(clients)
+    elapsed = time.time() - start
+    delays = [when - published[root] for root, when in seen if root in published]
+    return made[0], elapsed, delays
+
+def subscribe_test(num_clients=1000, num_updates=10):
+    '''Compares polling /getroot once a second with subscribing to /subscribe, for num_clients clients
+    of a local server over synthetic blocks that gets a new block every two seconds, in requests made
+    and in how long a new root takes to reach them.'''
+    pid = subprocess.Popen([sys.executable, "server_tests.py", "synthetic"], stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    try:
+        while True:
+            try:
+                requests.get(local_server+"/getroot")
+                break
+            except requests.ConnectionError:
+                time.sleep(0.5)
+        for mode in ("poll", "longpoll", "sse"):
+            made, elapsed, delays = subscriber_load(num_clients, num_updates, mode)
+            print "%s: %d requests in %.1f seconds, %.1f per client per new root, %d of %d roots seen, delay p50 %.3f, p99 %.3f, max %.3f seconds."%(
+                mode, made, elapsed, float(made) / num_clients / num_updates, len(delays), num_clients * num_updates,
+                np.percentile(delays, 50), np.percentile(delays, 99), max(delays))
+    finally:
+        pid.terminate()
+        pid.wait()
+
 def main():
     if first_arg=="query":
         server2.main()
@@ -104,6 +247,9 @@ def main():
         f = open("/data/tests/conflict_1.txt", "a")
         f.write("%.6f\n"%(conflict_resolve()))
         f.close()
+    elif first_arg=="subscribe":
+        print "Following new roots with 1000 clients, by polling and by subscribing..."
+        subscribe_test()
     else:
         print "Please provide a valid argument."
         
@@ -0,0 +1,453 @@
+'''This file is used to persist the Merkle forest of the server, so that it does not have to be
+rebuilt from the database every time the server starts.
+
+The forest is written out whole as a snapshot, and every change made afterwards is appended to a
+delta log. On startup, the snapshot is memory mapped rather than read, so only the trees that are
+queried are ever loaded, and the records in the log are replayed on top of it.
+
+A snapshot file is laid out as follows, with all integers little endian:
+    header      magic, version, idx size, number of trees, offsets of the index sections, and the
+                root digest and greatest global index of the top Merkle tree
+    trees       every tree in the forest, as packed by FlatMerkleTree.serialize, in key order
+    keys        the 32 byte root of every tree, sorted, so a tree can be found by binary search
+    offsets     the offset of every tree in the file, plus one for the end of the last tree
+
+A delta log is a sequence of records, each made of a magic, the length and the crc32 of its payload.
+The payload holds the top root before the change, the trees that were added, the leaves appended to
+the top tree, and the top root after the change. A rollback has a magic of its own, and its payload
+holds the top root before it, the number of leaves the top tree was cut back to, the roots of the
+trees that were removed, and the top root after it.'''
+from merkle import FlatMerkleTree, DIGEST_SIZE, IDX_SIZE
+from array import array
+import bisect, mmap, os, struct, zlib, codecs
+
+SNAPSHOT_MAGIC = b'MADSSNAP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<8sIIQQQ32sq')
+LOG_MAGIC = b'MADL'
+LOG_ROLLBACK_MAGIC = b'MADR'
+LOG_HEADER = struct.Struct('<4sII')
+
+class SnapshotError(Exception):
+    pass
+
+class SortedKeys(object):
+    '''A read only sequence over the sorted key section of a mapped snapshot, for bisect.'''
+    __slots__ = ['buf', 'offset', 'length']
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        start = self.offset + i * DIGEST_SIZE
+        return self.buf[start:start + DIGEST_SIZE]
+
+class ForestImage(object):
+    '''A mapping from the root of each tree to the tree, like the merkle_forest dictionary, that
+    is backed by a memory mapped snapshot. A tree is only deserialized when it is looked up, so
+    opening an image costs the same no matter how many trees it holds. Trees that are added or
+    removed after the snapshot was taken are kept in memory, on top of the mapped file.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < SNAPSHOT_HEADER.size:
+            raise SnapshotError('%s is too short to be a snapshot.' % path)
+        (magic, version, idx_size, self.num_trees, keys_offset, offsets_offset,
+            self.top_root, self.top_idx) = SNAPSHOT_HEADER.unpack_from(self.mm, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError('%s is not a snapshot.' % path)
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError('Snapshot version %d is not supported.' % version)
+        if idx_size != IDX_SIZE:
+            raise SnapshotError('Snapshot was written with %d byte indices.' % idx_size)
+        self.keys = SortedKeys(self.mm, keys_offset, self.num_trees)
+        self.offsets_offset = offsets_offset
+        self.overlay = {}
+        self.deleted = set()
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def _find(self, key):
+        '''Returns the position of a key in the mapped snapshot, or None if it is not there.'''
+        if len(key) != DIGEST_SIZE:
+            return None
+        i = bisect.bisect_left(self.keys, key)
+        if i < self.num_trees and self.keys[i] == key:
+            return i
+        return None
+
+    def _span(self, i):
+        return struct.unpack_from('<QQ', self.mm, self.offsets_offset + 8 * i)
+
+    def blob(self, key):
+        '''Returns the tree stored under key, serialized.'''
+        if key in self.overlay:
+            return self.overlay[key].serialize()
+        i = None if key in self.deleted else self._find(key)
+        if i is None:
+            raise KeyError(key)
+        start, end = self._span(i)
+        return self.mm[start:end]
+
+    def __getitem__(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+        i = None if key in self.deleted else self._find(key)
+        if i is None:
+            raise KeyError(key)
+        start, _ = self._span(i)
+        # read in place, so a lookup maps the tree rather than copying it; _thaw copies it if it changes
+        tree, _ = FlatMerkleTree.deserialize(self.mm, start, copy=False)
+        return tree
+
+    def __setitem__(self, key, tree):
+        self.overlay[key] = tree
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        in_base = key not in self.deleted and self._find(key) is not None
+        if key not in self.overlay and not in_base:
+            raise KeyError(key)
+        self.overlay.pop(key, None)
+        if in_base:
+            self.deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self.overlay:
+            return True
+        return key not in self.deleted and self._find(key) is not None
+
+    def __len__(self):
+        base = self.num_trees - len(self.deleted)
+        return base + sum(1 for key in self.overlay if self._find(key) is None)
+
+    def iterkeys(self):
+        for i in xrange(self.num_trees):
+            key = self.keys[i]
+            if key not in self.deleted and key not in self.overlay:
+                yield key
+        for key in self.overlay:
+            yield key
+
+    __iter__ = iterkeys
+
+    def iteritems(self):
+        for key in self.iterkeys():
+            yield key, self[key]
+
+    def clear(self):
+        self.overlay.clear()
+        self.deleted = set(self.keys[i] for i in xrange(self.num_trees))
+
+def tree_blob(forest, key):
+    '''Returns the serialized tree stored under key, without deserializing it if it is mapped.'''
+    if isinstance(forest, ForestImage):
+        return forest.blob(key)
+    return forest[key].serialize()
+
+def block_trees(forest, block_key):
+    '''Returns the (key, tree) pairs of a block tree and of the tx trees beneath it. A tx that is
+    held inline in the block tree has no tree to return.'''
+    block_merkle = forest[block_key]
+    trees = [(block_key, block_merkle)]
+    for i in range(block_merkle.num_leaves):
+        if block_merkle.leaf_inline(i) is not None:
+            continue
+        tx_key = block_merkle.leaf_key(i)
+        trees.append((tx_key, forest[tx_key]))
+    return trees
+
+def count_nodes(num_leaves):
+    '''The number of nodes in a FlatMerkleTree with num_leaves leaves, counting promoted nodes.'''
+    total = num_leaves
+    while num_leaves > 1:
+        num_leaves = (num_leaves + 1) // 2
+        total += num_leaves
+    return total
+
+def forest_size(forest):
+    '''Returns the number of trees in the forest, the number of nodes in them, and their size in
+    bytes. The trees of a forest image are not deserialized: their leaves are read from the header
+    of each stored tree, and their size is the space they take in the snapshot.'''
+    if not isinstance(forest, ForestImage):
+        trees = forest.values()
+        return len(trees), sum(tree.num_nodes for tree in trees), sum(tree.nbytes for tree in trees)
+    num_trees = num_nodes = num_bytes = 0
+    for i in xrange(forest.num_trees):
+        key = forest.keys[i]
+        if key in forest.deleted or key in forest.overlay:
+            continue
+        start, end = forest._span(i)
+        _, num_leaves = struct.unpack_from('<BI', forest.mm, start)
+        num_trees += 1
+        num_nodes += count_nodes(num_leaves)
+        num_bytes += end - start
+    for tree in forest.overlay.itervalues():
+        num_trees += 1
+        num_nodes += tree.num_nodes
+        num_bytes += tree.nbytes
+    return num_trees, num_nodes, num_bytes
+
+def write_snapshot(path, forest, top_merkle):
+    '''Writes every tree in the forest to a new snapshot at path. The file is written next to path
+    and renamed over it when complete, so a crash never leaves a partial snapshot behind.'''
+    keys = sorted(forest.iterkeys())
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(b'\0' * SNAPSHOT_HEADER.size)
+        offsets = array('L')
+        for key in keys:
+            offsets.append(f.tell())
+            f.write(tree_blob(forest, key))
+        offsets.append(f.tell())
+        keys_offset = f.tell()
+        for key in keys:
+            f.write(key)
+        offsets_offset = f.tell()
+        for offset in offsets:
+            f.write(struct.pack('<Q', offset))
+        f.seek(0)
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, IDX_SIZE, len(keys),
+            keys_offset, offsets_offset, top_merkle.root_val, top_merkle.root_idx))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+def load_forest(path, verify=False):
+    '''Maps the snapshot at path, and returns the forest image and the top Merkle tree. The top
+    tree is loaded into memory, since it is the one that grows. The root stored in the header is
+    checked against the root of the stored top tree, and if verify is set, the top tree is also
+    rebuilt from its leaves to check that it hashes to that root.'''
+    forest = ForestImage(path)
+    if forest.top_root not in forest:
+        raise SnapshotError('The top root of the snapshot is not in its forest.')
+    top_merkle = forest[forest.top_root]
+    if top_merkle.root_val != forest.top_root or top_merkle.root_idx != forest.top_idx:
+        raise SnapshotError('The top tree of the snapshot does not match its top root.')
+    if verify and top_merkle.build() != forest.top_root:
+        raise SnapshotError('The top tree of the snapshot does not hash to its top root.')
+    forest[forest.top_root] = top_merkle
+    return forest, top_merkle
+
+class DeltaLog(object):
+    '''An append only log of the updates made to the forest since the last snapshot. It counts the
+    records and bytes it holds, so that it can be folded into a new snapshot once it grows too long.
+    An existing log is opened with the number of records that were replayed from it.'''
+
+    def __init__(self, path, truncate=False, records=0):
+        self.path = path
+        self.file = open(path, 'wb' if truncate else 'ab')
+        self.records = 0 if truncate else records
+        self.size = os.path.getsize(path)
+
+    def close(self):
+        self.file.close()
+
+    def append(self, prev_root, trees, top_leaves, top_merkle):
+        '''Appends a record of an update that took the top root from prev_root to the current root
+        of top_merkle, by adding trees to the forest and top_leaves to the top tree.'''
+        parts = [prev_root, struct.pack('<I', len(trees))]
+        for key, tree in trees:
+            blob = tree.serialize()
+            parts.extend((key, struct.pack('<I', len(blob)), blob))
+        parts.append(struct.pack('<I', len(top_leaves)))
+        for key, idx in top_leaves:
+            parts.extend((key, struct.pack('<q', idx)))
+        parts.extend((top_merkle.root_val, struct.pack('<q', top_merkle.root_idx)))
+        self._write(LOG_MAGIC, b''.join(parts))
+
+    def rollback(self, prev_root, num_leaves, removed, top_merkle):
+        '''Appends a record of a rollback that took the top root from prev_root to the current root
+        of top_merkle, by truncating the top tree to num_leaves and removing the trees keyed by removed.'''
+        parts = [prev_root, struct.pack('<qI', num_leaves, len(removed))]
+        parts.extend(removed)
+        parts.extend((top_merkle.root_val, struct.pack('<q', top_merkle.root_idx)))
+        self._write(LOG_ROLLBACK_MAGIC, b''.join(parts))
+
+    def _write(self, magic, payload):
+        self.file.write(LOG_HEADER.pack(magic, len(payload), zlib.crc32(payload) & 0xffffffff))
+        self.file.write(payload)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records += 1
+        self.size += LOG_HEADER.size + len(payload)
+
+def read_log(path, start=0, end=None):
+    '''Yields the offset just past each complete record in the log at path, along with its fields.
+    The last field is None, except for a rollback, where it is the number of leaves the top tree was
+    cut back to and the keys of the trees removed, and which has no trees or top leaves of its own.
+    Only the records between the start and end offsets are read. A torn record at the end of the
+    log, left by a crash, is ignored.'''
+    if not os.path.isfile(path):
+        return
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read() if end is None else f.read(end - start)
+    offset = 0
+    while offset + LOG_HEADER.size <= len(data):
+        magic, length, crc = LOG_HEADER.unpack_from(data, offset)
+        body = offset + LOG_HEADER.size
+        payload = data[body:body + length]
+        if magic not in (LOG_MAGIC, LOG_ROLLBACK_MAGIC) or len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+            break
+        prev_root, pos = payload[:DIGEST_SIZE], DIGEST_SIZE
+        offset = body + length
+        if magic == LOG_ROLLBACK_MAGIC:
+            num_leaves, num_removed = struct.unpack_from('<qI', payload, pos)
+            pos += 12
+            removed = [payload[pos + i * DIGEST_SIZE:pos + (i + 1) * DIGEST_SIZE] for i in range(num_removed)]
+            pos += num_removed * DIGEST_SIZE
+            top_root = payload[pos:pos + DIGEST_SIZE]
+            top_idx, = struct.unpack_from('<q', payload, pos + DIGEST_SIZE)
+            yield start + offset, prev_root, [], [], (top_root, top_idx), (num_leaves, removed)
+            continue
+        num_trees, = struct.unpack_from('<I', payload, pos)
+        pos += 4
+        trees = []
+        for _ in range(num_trees):
+            key = payload[pos:pos + DIGEST_SIZE]
+            blob_length, = struct.unpack_from('<I', payload, pos + DIGEST_SIZE)
+            pos += DIGEST_SIZE + 4
+            trees.append((key, payload[pos:pos + blob_length]))
+            pos += blob_length
+        num_leaves, = struct.unpack_from('<I', payload, pos)
+        pos += 4
+        top_leaves = []
+        for _ in range(num_leaves):
+            key = payload[pos:pos + DIGEST_SIZE]
+            idx, = struct.unpack_from('<q', payload, pos + DIGEST_SIZE)
+            top_leaves.append((key, idx))
+            pos += DIGEST_SIZE + 8
+        top_root = payload[pos:pos + DIGEST_SIZE]
+        top_idx, = struct.unpack_from('<q', payload, pos + DIGEST_SIZE)
+        yield start + offset, prev_root, trees, top_leaves, (top_root, top_idx), None
+
+def replay_log(path, forest, top_merkle):
+    '''Applies the records of the log at path to a forest loaded from a snapshot, and returns
+    how many were applied. Records from before the snapshot are skipped, since their starting root
+    does not match. The root reached by every record is checked against the one it stored. A torn
+    record at the end of the log is cut off, so that new records can be appended after it.'''
+    applied, good_offset = 0, 0
+    for offset, prev_root, trees, top_leaves, top_root, rollback in read_log(path):
+        good_offset = offset
+        if prev_root != top_merkle.root_val:
+            if applied:
+                raise SnapshotError('The delta log does not follow on from the snapshot.')
+            continue
+        for key, blob in trees:
+            forest[key], _ = FlatMerkleTree.deserialize(blob)
+        del forest[top_merkle.root_val]
+        if rollback:
+            num_leaves, removed = rollback
+            for key in removed:
+                del forest[key]
+            top_merkle.truncate(num_leaves)
+        for leaf in top_leaves:
+            top_merkle.add_adjust(leaf)
+        forest[top_merkle.root_val] = top_merkle
+        if (top_merkle.root_val, top_merkle.root_idx) != top_root:
+            raise SnapshotError('Replaying the delta log gave the top root %s instead of %s.' % (
+                codecs.encode(top_merkle.root_val, 'hex_codec'), codecs.encode(top_root[0], 'hex_codec')))
+        applied += 1
+    if os.path.isfile(path) and os.path.getsize(path) > good_offset:
+        with open(path, 'r+b') as f:
+            f.truncate(good_offset)
+    return applied
+
+class ImagePublisher(object):
+    '''Publishes generations of the forest image for readers in other processes. A generation is
+    the snapshot, the delta log up to some offset, and a file holding the top Merkle tree as of that
+    offset. The generation that is current is named in a small file next to the snapshot, which is
+    replaced atomically, so readers always see a complete generation.'''
+
+    def __init__(self, snapshot_path, log_path):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.current_path = snapshot_path + '.current'
+        self.generation = read_current(self.current_path)[0]
+        self.top_path = None
+
+    def publish(self, top_merkle):
+        '''Publishes a new generation made of the snapshot, the delta log as it is now, and the
+        given top tree.'''
+        self.generation += 1
+        top_path = '%s.top.%d' % (self.snapshot_path, self.generation)
+        write_atomic(top_path, top_merkle.serialize())
+        log_offset = os.path.getsize(self.log_path) if os.path.isfile(self.log_path) else 0
+        write_atomic(self.current_path, '%d %d %d\n' % (self.generation, os.stat(self.snapshot_path).st_ino, log_offset))
+        # readers that still map the last top tree keep it alive after it is unlinked
+        if self.top_path and os.path.isfile(self.top_path):
+            os.remove(self.top_path)
+        self.top_path = top_path
+
+class SharedImage(object):
+    '''The reading side of an ImagePublisher. The snapshot and the top tree of the current
+    generation are memory mapped, so every reader process shares the same pages. Only the trees
+    added to the delta log since the snapshot are read into memory.'''
+
+    def __init__(self, snapshot_path, log_path):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.current_path = snapshot_path + '.current'
+        self.generation = None
+        self.snapshot_id = None
+        self.log_offset = 0
+        self.forest = None
+        self.top_merkle = None
+
+    def refresh(self):
+        '''Switches to the current generation if it is newer than the one in use, and returns
+        the forest and the top tree of the generation in use.'''
+        generation, snapshot_id, log_offset = read_current(self.current_path)
+        if generation == self.generation:
+            return self.forest, self.top_merkle
+        try:
+            with open('%s.top.%d' % (self.snapshot_path, generation), 'rb') as f:
+                top_mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError):
+            # a newer generation replaced this one while it was being read, so wait for that one
+            return self.forest, self.top_merkle
+        if snapshot_id != self.snapshot_id:
+            forest = ForestImage(self.snapshot_path)
+            if os.fstat(forest.file.fileno()).st_ino != snapshot_id:
+                forest.close()
+                return self.forest, self.top_merkle
+            self.forest, self.snapshot_id, self.log_offset = forest, snapshot_id, 0
+            del forest[forest.top_root]
+        else:
+            del self.forest[self.top_merkle.root_val]
+        for offset, _, trees, _, _, rollback in read_log(self.log_path, self.log_offset, log_offset):
+            for key, blob in trees:
+                self.forest[key], _ = FlatMerkleTree.deserialize(blob)
+            for key in (rollback[1] if rollback else ()):
+                del self.forest[key]
+            self.log_offset = offset
+        self.top_merkle, _ = FlatMerkleTree.deserialize(top_mm, 0, copy=False)
+        self.forest[self.top_merkle.root_val] = self.top_merkle
+        self.generation = generation
+        return self.forest, self.top_merkle
+
+def read_current(path):
+    '''Returns the generation, snapshot inode and log offset named in the current generation file.'''
+    if not os.path.isfile(path):
+        return 0, None, 0
+    with open(path, 'rb') as f:
+        generation, snapshot_id, log_offset = f.read().split()
+    return int(generation), int(snapshot_id), int(log_offset)
+
+def write_atomic(path, data):
+    '''Writes data to a file next to path, and renames it over path.'''
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
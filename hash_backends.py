@@ -0,0 +1,289 @@
+'''The hash functions that the Merkle trees can be built with, each chosen per tree by name:
+
+    sha256      hashlib's SHA-256, which every tree has used so far and which stays the default
+    blake2b     BLAKE2b with a 32 byte digest
+    sha3_256    SHA3-256
+    keccak256   Keccak-256 with the original Keccak padding, which is Monero's own cn_fast_hash
+
+hashlib only has BLAKE2b and SHA3 from Python 3.6, and never has Keccak-256, so those are taken from
+pyblake2, pysha3 or pycryptodome if one is installed, and otherwise from the pure Python versions in
+this file, which give the same digests, only much slower.
+
+A backend also hashes a whole level of pairs at once with hash_pairs, which is what building and
+adjusting a tree spends its time in, so that a faster implementation of a backend only has to
+replace that one call.
+'''
+import hashlib, struct, codecs
+
+DIGEST_SIZE = 32
+MASK = (1 << 64) - 1
+
+KECCAK_ROUND_CONSTANTS = [
+    0x0000000000000001, 0x0000000000008082, 0x800000000000808A, 0x8000000080008000,
+    0x000000000000808B, 0x0000000080000001, 0x8000000080008081, 0x8000000000008009,
+    0x000000000000008A, 0x0000000000000088, 0x0000000080008009, 0x000000008000000A,
+    0x000000008000808B, 0x800000000000008B, 0x8000000000008089, 0x8000000000008003,
+    0x8000000000008002, 0x8000000000000080, 0x000000000000800A, 0x800000008000000A,
+    0x8000000080008081, 0x8000000000008080, 0x0000000080000001, 0x8000000080008008]
+# the rotation of the lane at (x, y), indexed as [x][y]
+KECCAK_ROTATIONS = [
+    [0, 36, 3, 41, 18], [1, 44, 10, 45, 2], [62, 6, 43, 15, 61], [28, 55, 25, 21, 56], [27, 20, 39, 8, 14]]
+# the rho and pi steps together, as (source lane, destination lane, rotation), with lane (x, y) at x + 5*y
+KECCAK_MOVES = [(x + 5 * y, y + 5 * ((2 * x + 3 * y) % 5), KECCAK_ROTATIONS[x][y]) for x in range(5) for y in range(5)]
+
+def as_bytes(data):
+    '''Encodes text as ascii, like hashlib does, since hex keys often come back from json as unicode.'''
+    if isinstance(data, unicode):
+        return data.encode('ascii')
+    return data
+
+def keccak_f(lanes):
+    '''Applies the Keccak-f[1600] permutation in place to a state of 25 lanes of 64 bits.'''
+    moved = [0] * 25
+    for round_constant in KECCAK_ROUND_CONSTANTS:
+        columns = [lanes[x] ^ lanes[x + 5] ^ lanes[x + 10] ^ lanes[x + 15] ^ lanes[x + 20] for x in range(5)]
+        for x in range(5):
+            right = columns[(x + 1) % 5]
+            d = columns[x - 1] ^ ((right << 1 | right >> 63) & MASK)
+            for y in range(x, 25, 5):
+                lanes[y] ^= d
+        for source, dest, rotation in KECCAK_MOVES:
+            lane = lanes[source]
+            moved[dest] = (lane << rotation | lane >> (64 - rotation)) & MASK if rotation else lane
+        for y in range(0, 25, 5):
+            b0, b1, b2, b3, b4 = moved[y:y + 5]
+            lanes[y] = b0 ^ (~b1 & b2)
+            lanes[y + 1] = b1 ^ (~b2 & b3)
+            lanes[y + 2] = b2 ^ (~b3 & b4)
+            lanes[y + 3] = b3 ^ (~b4 & b0)
+            lanes[y + 4] = b4 ^ (~b0 & b1)
+        lanes[0] ^= round_constant
+
+class Keccak256(object):
+    '''A pure Python Keccak-256 with a hashlib style interface. The padding byte is what tells it
+    apart from SHA3-256.'''
+    digest_size = DIGEST_SIZE
+    block_size = 136
+    padding = 0x01
+    name = 'keccak256'
+
+    def __init__(self, data=b''):
+        self.lanes = [0] * 25
+        self.pending = bytearray()
+        if data:
+            self.update(data)
+
+    def _absorb(self, lanes, block):
+        for i, lane in enumerate(struct.unpack('<17Q', bytes(block))):
+            lanes[i] ^= lane
+        keccak_f(lanes)
+
+    def update(self, data):
+        self.pending += as_bytes(data)
+        while len(self.pending) >= self.block_size:
+            self._absorb(self.lanes, self.pending[:self.block_size])
+            del self.pending[:self.block_size]
+
+    def copy(self):
+        other = self.__class__()
+        other.lanes, other.pending = list(self.lanes), bytearray(self.pending)
+        return other
+
+    def digest(self):
+        lanes = list(self.lanes)
+        block = self.pending + bytearray(self.block_size - len(self.pending))
+        block[len(self.pending)] ^= self.padding
+        block[-1] ^= 0x80
+        self._absorb(lanes, block)
+        return struct.pack('<4Q', *lanes[:4])
+
+    def hexdigest(self):
+        return codecs.encode(self.digest(), 'hex_codec')
+
+class SHA3_256(Keccak256):
+    '''A pure Python SHA3-256, which is Keccak-256 with the padding that FIPS 202 settled on.'''
+    padding = 0x06
+    name = 'sha3_256'
+
+BLAKE2B_IV = [
+    0x6a09e667f3bcc908, 0xbb67ae8584caa73b, 0x3c6ef372fe94f82b, 0xa54ff53a5f1d36f1,
+    0x510e527fade682d1, 0x9b05688c2b3e6c1f, 0x1f83d9abfb41bd6b, 0x5be0cd19137e2179]
+BLAKE2B_SIGMA = [
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15],
+    [14, 10, 4, 8, 9, 15, 13, 6, 1, 12, 0, 2, 11, 7, 5, 3],
+    [11, 8, 12, 0, 5, 2, 15, 13, 10, 14, 3, 6, 7, 1, 9, 4],
+    [7, 9, 3, 1, 13, 12, 11, 14, 2, 6, 5, 10, 4, 0, 15, 8],
+    [9, 0, 5, 7, 2, 4, 10, 15, 14, 1, 11, 12, 6, 8, 3, 13],
+    [2, 12, 6, 10, 0, 11, 8, 3, 4, 13, 7, 5, 15, 14, 1, 9],
+    [12, 5, 1, 15, 14, 13, 4, 10, 0, 7, 6, 3, 9, 2, 8, 11],
+    [13, 11, 7, 14, 12, 1, 3, 9, 5, 0, 15, 4, 8, 6, 2, 10],
+    [6, 15, 14, 9, 11, 3, 0, 8, 12, 2, 13, 7, 1, 4, 10, 5],
+    [10, 2, 8, 4, 7, 6, 1, 5, 15, 11, 9, 14, 3, 12, 13, 0]]
+# the four columns and then the four diagonals that each round mixes
+BLAKE2B_MIXES = [(0, 4, 8, 12), (1, 5, 9, 13), (2, 6, 10, 14), (3, 7, 11, 15),
+                 (0, 5, 10, 15), (1, 6, 11, 12), (2, 7, 8, 13), (3, 4, 9, 14)]
+
+def blake2b_compress(h, block, counter, last):
+    '''Mixes a block of 128 bytes into the chain value h of BLAKE2b, in place. counter is the number
+    of bytes hashed so far, including this block.'''
+    m = struct.unpack('<16Q', bytes(block))
+    v = h + BLAKE2B_IV
+    v[12] ^= counter & MASK
+    v[13] ^= counter >> 64
+    if last:
+        v[14] ^= MASK
+    for r in range(12):
+        sigma = BLAKE2B_SIGMA[r % 10]
+        for i, (a, b, c, d) in enumerate(BLAKE2B_MIXES):
+            x, y = m[sigma[2 * i]], m[sigma[2 * i + 1]]
+            va, vb, vc, vd = v[a], v[b], v[c], v[d]
+            va = (va + vb + x) & MASK
+            vd ^= va
+            vd = (vd >> 32 | vd << 32) & MASK
+            vc = (vc + vd) & MASK
+            vb ^= vc
+            vb = (vb >> 24 | vb << 40) & MASK
+            va = (va + vb + y) & MASK
+            vd ^= va
+            vd = (vd >> 16 | vd << 48) & MASK
+            vc = (vc + vd) & MASK
+            vb ^= vc
+            vb = (vb >> 63 | vb << 1) & MASK
+            v[a], v[b], v[c], v[d] = va, vb, vc, vd
+    for i in range(8):
+        h[i] ^= v[i] ^ v[i + 8]
+
+class Blake2b256(object):
+    '''A pure Python BLAKE2b with a 32 byte digest and no key, with a hashlib style interface.'''
+    digest_size = DIGEST_SIZE
+    block_size = 128
+    name = 'blake2b'
+
+    def __init__(self, data=b''):
+        self.h = list(BLAKE2B_IV)
+        self.h[0] ^= 0x01010000 ^ self.digest_size
+        self.counter = 0
+        self.pending = bytearray()
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        self.pending += as_bytes(data)
+        # the last block is only compressed by digest, since it has to be marked as the last
+        while len(self.pending) > self.block_size:
+            self.counter += self.block_size
+            blake2b_compress(self.h, self.pending[:self.block_size], self.counter, False)
+            del self.pending[:self.block_size]
+
+    def copy(self):
+        other = self.__class__()
+        other.h, other.counter, other.pending = list(self.h), self.counter, bytearray(self.pending)
+        return other
+
+    def digest(self):
+        h = list(self.h)
+        block = self.pending + bytearray(self.block_size - len(self.pending))
+        blake2b_compress(h, block, self.counter + len(self.pending), True)
+        return struct.pack('<8Q', *h)[:self.digest_size]
+
+    def hexdigest(self):
+        return codecs.encode(self.digest(), 'hex_codec')
+
+def find_blake2b():
+    if hasattr(hashlib, 'blake2b'):
+        return lambda data=b'': hashlib.blake2b(data, digest_size=DIGEST_SIZE), True
+    try:
+        import pyblake2
+        return lambda data=b'': pyblake2.blake2b(data, digest_size=DIGEST_SIZE), True
+    except ImportError:
+        return Blake2b256, False
+
+def find_sha3_256():
+    if hasattr(hashlib, 'sha3_256'):
+        return hashlib.sha3_256, True
+    try:
+        import sha3
+        return sha3.sha3_256, True
+    except ImportError:
+        return SHA3_256, False
+
+def find_keccak256():
+    try:
+        import sha3
+        return sha3.keccak_256, True
+    except ImportError:
+        pass
+    try:
+        from Cryptodome.Hash import keccak
+    except ImportError:
+        try:
+            from Crypto.Hash import keccak
+        except ImportError:
+            return Keccak256, False
+    return lambda data=b'': keccak.new(data=data, digest_bits=256), True
+
+class HashBackend(object):
+    '''A hash function for Merkle trees. new is a hashlib style constructor, and code is the number
+    that a serialized tree records the backend by. native says whether new is implemented in C.
+    hashed counts the hashes computed through hash and hash_pairs in this process, which is every
+    hash that goes into building or updating a FlatMerkleTree.'''
+    __slots__ = ['name', 'code', 'new', 'native', 'hashed']
+
+    def __init__(self, name, code, new, native=True):
+        self.name = name
+        self.code = code
+        self.new = new
+        self.native = native
+        self.hashed = 0
+
+    def __repr__(self):
+        return 'HashBackend(%r)' % self.name
+
+    def hash(self, data):
+        self.hashed += 1
+        return self.new(data).digest()
+
+    def hexhash(self, data):
+        return self.new(data).hexdigest()
+
+    def hash_pairs(self, digests, start, stop, out):
+        '''Appends to out the parent of each pair of nodes on a level packed into digests, from the
+        pair that starts at node position start to the last whole pair before node position stop. The
+        pairs are read through one memoryview of the level rather than sliced out of it, and the parents
+        are appended to out at once.'''
+        view, new = memoryview(digests), self.new
+        offsets = xrange(start * DIGEST_SIZE, (stop - 1) * DIGEST_SIZE, 2 * DIGEST_SIZE)
+        self.hashed += len(offsets)
+        out += b''.join([new(view[offset:offset + 2 * DIGEST_SIZE]).digest() for offset in offsets])
+
+BACKENDS = {}
+BACKEND_CODES = {}
+
+def register(backend):
+    '''Makes a backend available by its name and its code.'''
+    BACKENDS[backend.name] = backend
+    BACKEND_CODES[backend.code] = backend
+    return backend
+
+register(HashBackend('sha256', 0, hashlib.sha256))
+register(HashBackend('blake2b', 1, *find_blake2b()))
+register(HashBackend('sha3_256', 2, *find_sha3_256()))
+register(HashBackend('keccak256', 3, *find_keccak256()))
+
+DEFAULT = 'sha256'
+
+def get(backend=None):
+    '''Returns the backend with the given name, or the default one for None. A backend is returned
+    as it is. Raises ValueError for a name that is not known.'''
+    if isinstance(backend, HashBackend):
+        return backend
+    try:
+        return BACKENDS[backend or DEFAULT]
+    except KeyError:
+        raise ValueError('Unknown hash backend: %r' % (backend,))
+
+def from_code(code):
+    try:
+        return BACKEND_CODES[code]
+    except KeyError:
+        raise ValueError('Unknown hash backend code: %d' % code)
@@ -5,10 +5,35 @@
 #   Question that remains is: Are the leaves global indices or transactions????
 
 from hashlib import sha256
-from math import log
-import codecs
+from array import array
+import codecs, struct, bisect, sys
+import hash_backends
 
 hash_function = sha256
+DIGEST_SIZE = 32
+# idx values are kept in memory in array('l'), but are always serialized as 8 byte little endian
+# integers, so that a tree packed on one machine can be read on any other
+IDX = struct.Struct('<q')
+IDX_SIZE = IDX.size
+# whether array('l') already has the serialized layout, so it can be packed and unpacked as it is
+NATIVE_IDX = array('l').itemsize == IDX_SIZE and sys.byteorder == 'little'
+
+def pack_idxs(idxs):
+    """Returns an array('l') of idx values, or a PackedIdx or SharedIdx, in the serialized layout.
+    """
+    if NATIVE_IDX or not isinstance(idxs, array):
+        return idxs.tostring()
+    return struct.pack('<%dq' % len(idxs), *idxs)
+
+def unpack_idxs(buf):
+    """Returns an array('l') of the idx values in a string in the serialized layout.
+    """
+    idxs = array('l')
+    if NATIVE_IDX:
+        idxs.fromstring(buf)
+    else:
+        idxs.extend(struct.unpack('<%dq' % (len(buf) // IDX_SIZE), buf))
+    return idxs
 
 
 class MerkleError(Exception):
@@ -19,16 +44,17 @@ class Node(object):
     """Each node has, as attributes, references to left (l) and right (r) child nodes, parent (p),
     and sibling (sib) node. It can also be aware of whether it is on the left or right hand side (side).
     data is hashed automatically by default, but does not have to be, if prehashed param is set to True.
+    It is hashed with hasher, a hashlib style constructor, or else with hash_function.
     """
     # The leaf node in here can be the block, and whatever is inside are the output keys generated
     __slots__ = ['l', 'r', 'p', 'sib', 'side', 'val', 'idx', 'data']
 
-    def __init__(self, data, prehashed=False, isleaf=False, ):
+    def __init__(self, data, prehashed=False, isleaf=False, hasher=None):
         if prehashed:
             # this can be anything, val will be the hash
             self.val = data[0] 
         else:
-            self.val = hash_function(data[0]).digest()
+            self.val = (hasher or hash_function)(data[0]).digest()
 
         # if it is a leaf, we need to keep track of the data in the leaf, which will be the hash
         if isleaf:
@@ -50,15 +76,20 @@ class MerkleTree(object):
     A list of data elements for Node values can be optionally supplied to the constructor.
     Data supplied to the constructor is hashed by default, but this can be overridden by
     providing prehashed=True in which case, node values should be hex encoded.
+    Every node is hashed with the named hash backend, which is sha256 by default.
     """
-    def __init__(self, leaves=[], prehashed=False, raw_digests=False):
+    def __init__(self, leaves=[], prehashed=False, raw_digests=False, backend=None):
+        self.backend = hash_backends.get(backend)
+        hasher = self.backend.new
         if prehashed and raw_digests:
             self.leaves = [Node(leaf, prehashed=True, isleaf=True) for leaf in leaves]
         elif prehashed:
             self.leaves = [Node(codecs.decode(leaf, 'hex_codec'), prehashed=True, isleaf=True) for leaf in leaves]
         else:
-            self.leaves = [Node(leaf, isleaf=True) for leaf in leaves]
+            self.leaves = [Node(leaf, isleaf=True, hasher=hasher) for leaf in leaves]
         self.root = None
+        # roots of the perfect subtrees along the right edge, kept up to date by add_adjust
+        self.frontier = None
 
     def __eq__(self, obj):
         return (self.root.val == obj.root.val) and (self.__class__ == obj.__class__)
@@ -66,12 +97,14 @@ class MerkleTree(object):
     def add(self, data):
         """Add a Node to the tree, providing data, which is hashed automatically.
         """
-        self.leaves.append(Node(data))
+        self.leaves.append(Node(data, hasher=self.backend.new))
+        self.frontier = None
 
     def add_hash(self, value):
         """Add a Node based on a precomputed, hex encoded, hash value.
         """
         self.leaves.append(Node(((codecs.decode(value[0][0], 'hex_codec'),value[0][1]),value[1]), prehashed=True))
+        self.frontier = None
 
     def clear(self):
         """Clears the Merkle Tree by releasing the Merkle root and each leaf's references, the rest
@@ -81,6 +114,7 @@ class MerkleTree(object):
         a new tree.
         """
         self.root = None
+        self.frontier = None
         for leaf in self.leaves:
             leaf.p, leaf.sib, leaf.side = (None, ) * 3
 
@@ -93,17 +127,19 @@ class MerkleTree(object):
         while len(layer) != 1:
             layer = self._build(layer)
         self.root = layer[0]
+        self.frontier = None
         return self.root.val
 
     def _build(self, leaves):
         """Private helper function to create the next aggregation level and put all references in place.
         """
         new, odd = [], None
+        hasher = self.backend.new
         # check if even number of leaves, promote odd leaf to next level, if not
         if len(leaves) % 2 == 1:
             odd = leaves.pop(-1)
         for i in range(0, len(leaves), 2):
-            newnode = Node((leaves[i].val + leaves[i + 1].val, max(leaves[i].idx, leaves[i+1].idx)))
+            newnode = Node((leaves[i].val + leaves[i + 1].val, max(leaves[i].idx, leaves[i+1].idx)), hasher=hasher)
             newnode.l, newnode.r = leaves[i], leaves[i + 1]
             leaves[i].side, leaves[i + 1].side, leaves[i].p, leaves[i + 1].p = 'L', 'R', newnode, newnode
             leaves[i].sib, leaves[i + 1].sib = leaves[i + 1], leaves[i]
@@ -141,7 +177,7 @@ class MerkleTree(object):
         """Assemble and return the chain leading from a given node to the merkle root of this tree
         with hash values in hex form
         """
-        return [((codecs.encode(i[0][0], 'hex_codec'), i[0][1]), i[1]) for i in self._get_proof(index)]
+        return hex_chain(self._get_proof(index))
 
     def get_all_proofs(self):
         """Assemble and return a list of all chains for all nodes to the merkle root, hex encoded.
@@ -150,42 +186,669 @@ class MerkleTree(object):
 
     def _get_whole_subtrees(self):
         """Returns an array of nodes in the tree that have balanced subtrees beneath them,
-        moving from left to right.
+        moving from left to right. Their sizes are the binary digits of the number of leaves.
         """
         subtrees = []
-        loose_leaves = len(self.leaves) - 2**int(log(len(self.leaves), 2))
+        loose_leaves = len(self.leaves) - (1 << (len(self.leaves).bit_length() - 1))
         the_node = self.root
         while loose_leaves:
             subtrees.append(the_node.l)
             the_node = the_node.r
-            loose_leaves = loose_leaves - 2**int(log(loose_leaves, 2))
+            loose_leaves = loose_leaves - (1 << (loose_leaves.bit_length() - 1))
         subtrees.append(the_node)
         return subtrees
 
     def add_adjust(self, data, prehashed=False):
         """Add a new leaf, and adjust the tree, without rebuilding the whole thing.
+        The balanced subtrees along the right edge are kept between calls. The new leaf is merged
+        into them like a binary counter, which costs one hash per leaf when amortized, and then the
+        subtrees are joined from right to left into a new root, which costs O(log n) hashes.
+        The result is the same tree that build() would make over the same leaves.
         """
-        subtrees = self._get_whole_subtrees()
-        new_node = Node(data, prehashed=prehashed, isleaf=True)
-        self.leaves.append(new_node)
-        for node in reversed(subtrees):
-            new_parent = Node( (node.val + new_node.val , max(node.idx, new_node.idx)))
-            node.p, new_node.p = new_parent, new_parent
-            new_parent.l, new_parent.r = node, new_node
-            node.sib, new_node.sib = new_node, node
-            node.side, new_node.side = 'L', 'R'
-            new_node = new_node.p
+        self.extend([data], prehashed=prehashed)
+
+    def extend(self, leaves, prehashed=False):
+        """Add many new leaves, and adjust the tree once for all of them. Each leaf is merged into
+        the subtrees along the right edge as add_adjust does, but they are only joined into a new root
+        at the end, so no intermediate roots are made.
+        """
+        if self.frontier is None:
+            self.frontier = self._get_whole_subtrees()
+        for data in leaves:
+            new_node = Node(data, prehashed=prehashed, isleaf=True, hasher=self.backend.new)
+            self.leaves.append(new_node)
+            # a run of trailing ones in the old leaf count is a run of equal sized subtrees to merge
+            carries = len(self.leaves) - 1
+            while carries & 1:
+                new_node = self._join(self.frontier.pop(), new_node)
+                carries >>= 1
+            self.frontier.append(new_node)
+        new_node = self.frontier[-1]
+        for node in reversed(self.frontier[:-1]):
+            new_node = self._join(node, new_node)
         self.root = new_node
 
-def _check_proof(chain):
-    """Verify a merkle chain to see if the Merkle root can be reproduced.
+    def truncate(self, num_leaves):
+        """Drop every leaf after the first num_leaves, and adjust the tree to the one it was when it
+        had that many leaves. The balanced subtrees along the right edge of the smaller tree are still
+        in the tree, since leaves are only ever added to the right of them, so the frontier is found by
+        walking up from the first leaf of each, and joined into a new root. This costs O(log n) hashes,
+        however many leaves are dropped.
+        """
+        if not 0 < num_leaves <= len(self.leaves):
+            raise MerkleError('Cannot truncate a tree of %d leaves to %d.' % (len(self.leaves), num_leaves))
+        if self.root is None:
+            del self.leaves[num_leaves:]
+            return
+        frontier, start = [], 0
+        for bit in reversed(range(num_leaves.bit_length())):
+            if num_leaves >> bit & 1:
+                node = self.leaves[start]
+                for _ in range(bit):
+                    node = node.p
+                frontier.append(node)
+                start += 1 << bit
+        del self.leaves[num_leaves:]
+        self.frontier = frontier
+        self.extend([])
+        self.root.p, self.root.sib, self.root.side = (None, ) * 3
+
+    def _join(self, left, right):
+        """Private helper function to make a parent for two nodes and put all references in place.
+        """
+        new_parent = Node( (left.val + right.val , max(left.idx, right.idx)), hasher=self.backend.new)
+        left.p, right.p = new_parent, new_parent
+        new_parent.l, new_parent.r = left, right
+        left.sib, right.sib = right, left
+        left.side, right.side = 'L', 'R'
+        return new_parent
+
+def level_widths(num_leaves):
+    """Returns the number of nodes on each level of a tree with the given number of leaves,
+    from the leaves up to the root.
+    """
+    widths = [num_leaves]
+    while widths[-1] > 1:
+        widths.append((widths[-1] + 1) >> 1)
+    return widths
+
+class PackedIdx(object):
+    """A read only array of the idx values of one level of a FlatMerkleTree, read in place from a
+    buffer such as a memory mapped file, instead of being copied into an array.
+    """
+    __slots__ = ['buf', 'offset', 'length']
+    itemsize = IDX_SIZE
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('idx index out of range')
+        return IDX.unpack_from(self.buf, self.offset + i * IDX_SIZE)[0]
+
+    def tostring(self):
+        return self.buf[self.offset:self.offset + self.length * IDX_SIZE]
+
+class SharedLevel(object):
+    """A read only level of an earlier version of a FlatMerkleTree that has since been appended to.
+    Only the last node of a level can have changed, since every other node covers a run of leaves
+    that is complete, so the level is read from the first width - 1 nodes of the same level of the
+    current tree, and only the last digest is kept.
+    """
+    __slots__ = ['tree', 'level', 'width', 'last']
+
+    def __init__(self, tree, level, width, last):
+        self.tree = tree
+        self.level = level
+        self.width = width
+        self.last = last
+
+    def __len__(self):
+        return self.width * DIGEST_SIZE
+
+    def __getitem__(self, span):
+        start, stop, _ = span.indices(self.width * DIGEST_SIZE)
+        cut = (self.width - 1) * DIGEST_SIZE
+        if stop <= cut:
+            return self.tree.levels[self.level][start:stop]
+        head = bytes(self.tree.levels[self.level][start:cut]) if start < cut else b''
+        return head + self.last[max(start, cut) - cut:stop - cut]
+
+    def __str__(self):
+        return self[0:len(self)]
+
+class SharedIdx(object):
+    """The idx values of a SharedLevel, read from the same level of the current tree but for the last.
     """
+    __slots__ = ['tree', 'level', 'width', 'last']
+
+    def __init__(self, tree, level, width, last):
+        self.tree = tree
+        self.level = level
+        self.width = width
+        self.last = last
+
+    def __len__(self):
+        return self.width
+
+    def __getitem__(self, i):
+        if 0 <= i < self.width - 1:
+            return self.tree.idxs[self.level][i]
+        if i == self.width - 1 or i == -1:
+            return self.last
+        if i < 0:
+            return self[i + self.width]
+        raise IndexError('idx index out of range')
+
+    def bisect_left(self, idx):
+        """bisect.bisect_left over the values, searching the current tree in place for all but the last.
+        """
+        pos = bisect.bisect_left(self.tree.idxs[self.level], idx, 0, self.width - 1)
+        if pos == self.width - 1 and self.last < idx:
+            return self.width
+        return pos
+
+    def tostring(self):
+        return struct.pack('<%dq' % self.width, *[self[i] for i in range(self.width)])
+
+class FlatMerkleTree(object):
+    """A Merkle tree that keeps each level in one contiguous buffer instead of a graph of Node objects.
+    levels[0] holds the packed leaf digests and levels[-1] holds the root, while idxs keeps the greatest
+    index under each node in a parallel array('l'), serialized as 8 byte little endian integers. A node is addressed by its level and
+    position, and its children sit at 2*pos and 2*pos+1 on the level below. As in MerkleTree, an odd node
+    at the end of a level is promoted unchanged, so both trees have the same root and the same proofs.
+    If keyed is set, leaves are the raw roots of lower level trees. They are packed into a single buffer
+    and hashed in hex encoded form, which is what a MerkleTree built over the hex roots would hash.
+    A lower tree with a single leaf has that leaf's digest as its root, so a keyed tree can hold the
+    leaf data itself in inline, a dict from the position of such a root to the data, instead of there
+    being a tree for it at all.
+    Nodes are hashed with the named hash backend, sha256 by default, which hashes each level of pairs
+    in one call to its hash_pairs.
+    """
+    __slots__ = ['levels', 'idxs', 'data', 'keyed', 'inline', 'backend']
+
+    def __init__(self, leaves=[], prehashed=False, raw_digests=False, keyed=False, inline=None, backend=None):
+        self.backend = hash_backends.get(backend)
+        self.keyed = keyed
+        self.levels = [bytearray()]
+        self.idxs = [array('l')]
+        self.data = bytearray() if keyed else []
+        self.inline = inline or None
+        for leaf in leaves:
+            self._append_leaf(leaf, prehashed=prehashed, raw_digests=raw_digests)
+
+    def __eq__(self, obj):
+        return (self.root_val == obj.root_val) and (self.__class__ == obj.__class__)
+
+    def _append_leaf(self, data, prehashed=False, raw_digests=False):
+        """Private helper function to put a (data, idx) pair on the leaf level, hashing it if needed.
+        """
+        if self.keyed:
+            self.data += data[0]
+            val = self.backend.hash(codecs.encode(data[0], 'hex_codec'))
+        elif prehashed:
+            val = data[0] if raw_digests else codecs.decode(data[0], 'hex_codec')
+            self.data.append(val)
+        else:
+            val = self.backend.hash(data[0])
+            self.data.append(data[0])
+        self.levels[0] += val
+        self.idxs[0].append(data[1])
+
+    @property
+    def num_leaves(self):
+        return len(self.idxs[0])
+
+    @property
+    def height(self):
+        return len(self.levels)
+
+    @property
+    def num_nodes(self):
+        return sum(len(idxs) for idxs in self.idxs)
+
+    @property
+    def nbytes(self):
+        """The bytes held by the level buffers, the idx arrays and the leaf data, which is about the
+        size of the serialized tree.
+        """
+        total = sum(len(level) for level in self.levels) + sum(len(idxs) for idxs in self.idxs) * self.idxs[0].itemsize
+        if self.keyed:
+            return total + len(self.data)
+        return total + sum(len(item) for item in self.data)
+
+    @property
+    def root_val(self):
+        """The root digest, or None if the tree has not been built.
+        """
+        if len(self.idxs[-1]) != 1:
+            return None
+        return bytes(self.levels[-1])
+
+    @property
+    def root_idx(self):
+        if len(self.idxs[-1]) != 1:
+            return None
+        return self.idxs[-1][0]
+
+    def digest(self, level, pos):
+        return bytes(self.levels[level][pos * DIGEST_SIZE:(pos + 1) * DIGEST_SIZE])
+
+    def leaf_idx(self, pos):
+        return self.idxs[0][pos]
+
+    def leaf_key(self, pos):
+        """The data of a leaf as it is stored, which for a keyed tree is the raw root of the lower tree.
+        """
+        if self.keyed:
+            return bytes(self.data[pos * DIGEST_SIZE:(pos + 1) * DIGEST_SIZE])
+        return self.data[pos]
+
+    def leaf_data(self, pos):
+        """The data of a leaf in the form that was hashed, so hex encoded for a keyed tree.
+        """
+        if self.keyed:
+            return codecs.encode(self.leaf_key(pos), 'hex_codec')
+        return self.data[pos]
+
+    def leaf_entry(self, pos):
+        return (self.leaf_key(pos), self.idxs[0][pos])
+
+    def leaf_inline(self, pos):
+        """The data of the single leaf of the lower tree at pos, if it is held inline, or else None.
+        """
+        if self.inline is None:
+            return None
+        return self.inline.get(pos)
+
+    def leaf_entries(self):
+        """Returns a list of (key, idx) pairs for all the leaves, in order.
+        """
+        return [self.leaf_entry(i) for i in range(self.num_leaves)]
+
+    def find_leaf(self, idx):
+        """Returns the position of the leftmost leaf whose idx is greater than or equal to idx, or
+        num_leaves if there is none. Leaves are added in idx order, so idxs[0] is already a sorted
+        array and is bisected in place.
+        """
+        if isinstance(self.idxs[0], SharedIdx):
+            return self.idxs[0].bisect_left(idx)
+        return bisect.bisect_left(self.idxs[0], idx)
+
+    def add(self, data):
+        """Add a leaf to the tree, providing data, which is hashed automatically. The tree has to
+        be built again afterwards.
+        """
+        self._thaw()
+        self.clear()
+        self._append_leaf(data)
+
+    def clear(self):
+        """Drops every level above the leaves.
+        """
+        del self.levels[1:]
+        del self.idxs[1:]
+
+    def build(self):
+        """Calculate every level of the tree from the leaves, and return the merkle root.
+        """
+        if not self.num_leaves:
+            raise MerkleError('The tree has no leaves and cannot be calculated.')
+        self._thaw()
+        self.clear()
+        while len(self.idxs[-1]) != 1:
+            self._build()
+        return self.root_val
+
+    def _build(self):
+        """Private helper function to compute the level above the current top level.
+        """
+        digests, idxs = self.levels[-1], self.idxs[-1]
+        parents, parent_idxs = bytearray(), array('l')
+        width = len(idxs)
+        self.backend.hash_pairs(digests, 0, width, parents)
+        for pos in range(0, width - 1, 2):
+            parent_idxs.append(max(idxs[pos], idxs[pos + 1]))
+        # promote odd node to next level
+        if width % 2 == 1:
+            parents += digests[-DIGEST_SIZE:]
+            parent_idxs.append(idxs[-1])
+        self.levels.append(parents)
+        self.idxs.append(parent_idxs)
+
+    def _adjust(self, level, start=None):
+        """Private helper function to recompute every node above the nodes of the given level from
+        position start on, after they have changed or been added. By default only the last node has.
+        Nodes to the left of those are kept, so each level only hashes its changed right end.
+        """
+        levels, all_idxs = self.levels, self.idxs
+        width = len(all_idxs[level])
+        if start is None:
+            start = width - 1
+        while width > 1:
+            digests, idxs = levels[level], all_idxs[level]
+            if level + 1 == len(levels):
+                levels.append(bytearray())
+                all_idxs.append(array('l'))
+            parents, parent_idxs = levels[level + 1], all_idxs[level + 1]
+            start >>= 1
+            del parents[start * DIGEST_SIZE:]
+            del parent_idxs[start:]
+            self.backend.hash_pairs(digests, start << 1, width, parents)
+            for pos in range(start << 1, width - 1, 2):
+                parent_idxs.append(max(idxs[pos], idxs[pos + 1]))
+            # promote odd node to next level
+            if width % 2 == 1:
+                parents += digests[-DIGEST_SIZE:]
+                parent_idxs.append(idxs[-1])
+            width = len(parent_idxs)
+            level += 1
+        del levels[level + 1:]
+        del all_idxs[level + 1:]
+
+    def _adjust_last(self):
+        """Private helper function to recompute the right edge after one leaf has been appended to a
+        built tree. Every level above has either gained a node at its end or had its last node change,
+        so that node is set in place, rather than each level being cut back and hashed again from its
+        last pair as _adjust does, which costs more per level than the one hash it saves. The pair is
+        hashed through the backend, like every other hash of the tree, so the backend counts it.
+        """
+        levels, all_idxs, hash = self.levels, self.idxs, self.backend.hash
+        level, width = 0, len(all_idxs[0])
+        while width > 1:
+            digests, idxs = levels[level], all_idxs[level]
+            if level + 1 == len(levels):
+                levels.append(bytearray())
+                all_idxs.append(array('l'))
+            if width & 1:
+                # promote odd node to next level
+                digest, idx = digests[-DIGEST_SIZE:], idxs[-1]
+            else:
+                digest = hash(buffer(digests, len(digests) - 2 * DIGEST_SIZE))
+                idx = max(idxs[-2], idxs[-1])
+            width = (width + 1) >> 1
+            level += 1
+            if len(all_idxs[level]) == width:
+                levels[level][-DIGEST_SIZE:] = digest
+                all_idxs[level][-1] = idx
+            else:
+                levels[level] += digest
+                all_idxs[level].append(idx)
+
+    def add_adjust(self, data, prehashed=False):
+        """Add a new leaf, and adjust the tree, without rebuilding the whole thing.
+        """
+        built = len(self.idxs[-1]) == 1
+        self._thaw()
+        self._append_leaf(data, prehashed=prehashed, raw_digests=True)
+        if built:
+            self._adjust_last()
+        else:
+            self.build()
+
+    def extend(self, leaves, prehashed=False):
+        """Add many new leaves, and adjust the tree once for all of them, so that every new node is
+        hashed once, instead of the right edge being hashed again after each leaf.
+        """
+        built = len(self.idxs[-1]) == 1
+        self._thaw()
+        start = self.num_leaves
+        for data in leaves:
+            self._append_leaf(data, prehashed=prehashed, raw_digests=True)
+        if not built:
+            self.build()
+        elif start < self.num_leaves:
+            self._adjust(0, start)
+
+    def spine(self):
+        """Returns the (digest, idx) of the last node on each level, from the leaves up to the root.
+        With the number of leaves, this is all that version needs to give back the tree as it is now,
+        once more leaves have been added.
+        """
+        return [(self.digest(level, len(idxs) - 1), idxs[-1]) for level, idxs in enumerate(self.idxs)]
+
+    def siblings(self):
+        """Returns the (level, digest) of the left sibling of each node on the spine that has one.
+        Together with the last leaf, the siblings cover every leaf of the tree, so a tree with more
+        leaves that has the same nodes at the same places starts with the same leaves as this one.
+        """
+        return [(level, self.digest(level, len(idxs) - 2)) for level, idxs in enumerate(self.idxs) if len(idxs) % 2 == 0]
+
+    def version(self, num_leaves, spine):
+        """Returns a read only view of this tree as it was when it had num_leaves leaves and the
+        given spine. Appending leaves only changes the last node of each level, so every other node
+        is shared with this tree, and the view holds just the spine. The view stays valid as long as
+        this tree is only appended to. Changing it, as with add_adjust, makes a copy first.
+        """
+        if not 0 < num_leaves <= self.num_leaves or len(spine) != len(level_widths(num_leaves)):
+            raise MerkleError('The tree never had %d leaves with this spine.' % num_leaves)
+        m = self.__class__.__new__(self.__class__)
+        m.keyed, m.inline, m.backend = self.keyed, self.inline, self.backend
+        m.data = buffer(self.data, 0, num_leaves * DIGEST_SIZE) if self.keyed else self.data[:num_leaves]
+        m.levels, m.idxs = [], []
+        for level, (width, (digest, idx)) in enumerate(zip(level_widths(num_leaves), spine)):
+            m.levels.append(SharedLevel(self, level, width, digest))
+            m.idxs.append(SharedIdx(self, level, width, idx))
+        return m
+
+    def truncate(self, num_leaves):
+        """Drop every leaf after the first num_leaves, and adjust the tree to the one it was when it
+        had that many leaves. Only the last node of each level can differ between the two, so the
+        levels are cut down to size and their last nodes hashed again, which costs O(log n) hashes.
+        """
+        if not 0 < num_leaves <= self.num_leaves:
+            raise MerkleError('Cannot truncate a tree of %d leaves to %d.' % (self.num_leaves, num_leaves))
+        built = len(self.idxs[-1]) == 1
+        self._thaw()
+        del self.levels[0][num_leaves * DIGEST_SIZE:]
+        del self.idxs[0][num_leaves:]
+        if self.keyed:
+            del self.data[num_leaves * DIGEST_SIZE:]
+        else:
+            del self.data[num_leaves:]
+        if self.inline:
+            self.inline = dict((pos, item) for pos, item in self.inline.iteritems() if pos < num_leaves) or None
+        if built:
+            self._adjust(0, num_leaves - 1)
+        else:
+            self.clear()
+
+    def _get_proof(self, index):
+        """Assemble and return the chain leading from a given leaf to the merkle root of this tree.
+        """
+        chain = [((self.digest(0, index), self.idxs[0][index]), 'SELF')]
+        pos = index
+        for level in range(len(self.levels) - 1):
+            sib = pos ^ 1
+            # a promoted node has no sibling on this level
+            if sib < len(self.idxs[level]):
+                chain.append(((self.digest(level, sib), self.idxs[level][sib]), 'L' if sib < pos else 'R'))
+            pos >>= 1
+        chain.append(((self.root_val, self.root_idx), 'ROOT'))
+        return chain
+
+    def _get_all_proofs(self):
+        """Assemble and return a list of all chains for all leaf nodes to the merkle root.
+        """
+        return [self._get_proof(i) for i in range(self.num_leaves)]
+
+    def get_proof(self, index):
+        """Assemble and return the chain leading from a given leaf to the merkle root of this tree
+        with hash values in hex form
+        """
+        return hex_chain(self._get_proof(index))
+
+    def get_all_proofs(self):
+        """Assemble and return a list of all chains for all nodes to the merkle root, hex encoded.
+        """
+        return [self.get_proof(i) for i in range(self.num_leaves)]
+
+    def _get_multiproof(self, positions):
+        """Assemble the nodes needed to get from the given leaves to the merkle root, as a sorted
+        list of (level, pos, digest). Each node is included once, however many of the leaves need
+        it, and nodes that can be computed from the given leaves are left out.
+        """
+        nodes = []
+        known = set(positions)
+        for level in range(len(self.levels) - 1):
+            width = len(self.idxs[level])
+            for pos in sorted(known):
+                sib = pos ^ 1
+                if sib < width and sib not in known:
+                    nodes.append((level, sib, self.digest(level, sib)))
+            known = set(pos >> 1 for pos in known)
+        return nodes
+
+    def get_multiproof(self, positions):
+        """Assemble the nodes needed to get from the given leaves to the merkle root, with hash
+        values in hex form.
+        """
+        return [(level, pos, codecs.encode(digest, 'hex_codec')) for level, pos, digest in self._get_multiproof(positions)]
+
+    def serialize(self):
+        """Packs the built tree into a string, so that it can be sent to another process or written
+        to disk, and restored by deserialize without hashing anything again.
+        """
+        if self.root_val is None:
+            raise MerkleError('The tree has not been built and cannot be serialized.')
+        parts = [struct.pack('<BI', self.keyed | bool(self.inline) << 1 | self.backend.code << 2, self.num_leaves)]
+        parts.extend(bytes(level) for level in self.levels)
+        parts.extend(pack_idxs(idxs) for idxs in self.idxs)
+        if self.keyed:
+            parts.append(bytes(self.data))
+        else:
+            for item in self.data:
+                if isinstance(item, unicode):
+                    item = item.encode('utf-8')
+                parts.append(struct.pack('<I', len(item)))
+                parts.append(item)
+        if self.inline:
+            parts.append(struct.pack('<I', len(self.inline)))
+            for pos, item in sorted(self.inline.iteritems()):
+                if isinstance(item, unicode):
+                    item = item.encode('utf-8')
+                parts.append(struct.pack('<II', pos, len(item)))
+                parts.append(item)
+        return b''.join(parts)
+
+    @classmethod
+    def deserialize(cls, buf, offset=0, copy=True):
+        """Restores a tree packed by serialize, starting at offset in buf. Returns the tree and
+        the offset just past it. If copy is not set, the digests and idx values are read in place
+        from buf, so a tree in a memory mapped file takes no memory of its own. Such a tree is
+        copied the first time it is changed.
+        """
+        flags, num_leaves = struct.unpack_from('<BI', buf, offset)
+        offset += 5
+        m = cls.__new__(cls)
+        m.keyed = bool(flags & 1)
+        m.inline = None
+        m.backend = hash_backends.from_code(flags >> 2 & 7)
+        m.levels, m.idxs = [], []
+        widths = level_widths(num_leaves)
+        for width in widths:
+            if copy:
+                m.levels.append(bytearray(buf[offset:offset + width * DIGEST_SIZE]))
+            else:
+                m.levels.append(buffer(buf, offset, width * DIGEST_SIZE))
+            offset += width * DIGEST_SIZE
+        for width in widths:
+            if copy:
+                idxs = unpack_idxs(buf[offset:offset + width * IDX_SIZE])
+            else:
+                idxs = PackedIdx(buf, offset, width)
+            m.idxs.append(idxs)
+            offset += width * IDX_SIZE
+        if m.keyed:
+            if copy:
+                m.data = bytearray(buf[offset:offset + num_leaves * DIGEST_SIZE])
+            else:
+                m.data = buffer(buf, offset, num_leaves * DIGEST_SIZE)
+            offset += num_leaves * DIGEST_SIZE
+        else:
+            m.data = []
+            for _ in range(num_leaves):
+                length, = struct.unpack_from('<I', buf, offset)
+                m.data.append(bytes(buf[offset + 4:offset + 4 + length]))
+                offset += 4 + length
+        if flags & 2:
+            num_inline, = struct.unpack_from('<I', buf, offset)
+            offset += 4
+            m.inline = {}
+            for _ in range(num_inline):
+                pos, length = struct.unpack_from('<II', buf, offset)
+                m.inline[pos] = bytes(buf[offset + 8:offset + 8 + length])
+                offset += 8 + length
+        return m, offset
+
+    def _thaw(self):
+        """Private helper function to copy a tree that is read in place from a buffer into memory
+        of its own, before it is changed. A tree is read in place either whole or not at all, so the
+        leaves tell which, and a tree of its own costs no more than that to check, once per leaf appended.
+        """
+        if type(self.idxs[0]) is array and type(self.levels[0]) is bytearray:
+            return
+        if isinstance(self.data, buffer):
+            self.data = bytearray(self.data)
+        for level in range(len(self.levels)):
+            if isinstance(self.levels[level], (buffer, SharedLevel)):
+                self.levels[level] = bytearray(bytes(self.levels[level]))
+            if isinstance(self.idxs[level], (PackedIdx, SharedIdx)):
+                self.idxs[level] = unpack_idxs(self.idxs[level].tostring())
+
+    def resolve(self, level, pos):
+        """Follows a promoted node down to the level where it was created, which is where its
+        children are.
+        """
+        while level and pos << 1 == len(self.idxs[level - 1]) - 1:
+            level, pos = level - 1, pos << 1
+        return level, pos
+
+    def get_subtree(self, level, pos, depth):
+        """Return the hashes, in hex form, of the node at (level, pos) and of every node down to
+        depth levels below it, as one list per level from the node down. The nodes under a node on
+        some level are a run of positions, so no walk from the root is needed. If the leaves are
+        reached, their data is returned as well, otherwise None.
+        """
+        rows = []
+        lo, hi = pos, pos + 1
+        for row_level in range(level, max(level - depth, 0) - 1, -1):
+            hi = min(hi, len(self.idxs[row_level]))
+            rows.append([codecs.encode(self.digest(row_level, p), 'hex_codec') for p in range(lo, hi)])
+            if row_level:
+                lo, hi = lo << 1, hi << 1
+        data = [self.leaf_data(p) for p in range(lo, hi)] if level - depth <= 0 else None
+        return rows, data
+
+    def children(self, level, pos):
+        """Returns the resolved (level, pos) handles of the left and right children of a node,
+        or None for a leaf.
+        """
+        level, pos = self.resolve(level, pos)
+        if not level:
+            return None
+        return self.resolve(level - 1, pos << 1), self.resolve(level - 1, (pos << 1) + 1)
+
+
+def _check_proof(chain, backend=None):
+    """Verify a merkle chain to see if the Merkle root can be reproduced, hashing with the named
+    hash backend that the tree was built with.
+    """
+    hasher = hash_backends.get(backend).new
     link = chain[0][0]
     for i in range(1, len(chain) - 1):
         if chain[i][1] == 'R':
-            link = hash_function(link + chain[i][0]).digest()
+            link = hasher(link + chain[i][0]).digest()
         elif chain[i][1] == 'L':
-            link = hash_function(chain[i][0] + link).digest()
+            link = hasher(chain[i][0] + link).digest()
         else:
             raise MerkleError('Link %s has no side value: %s' % (str(i), str(codecs.encode(chain[i][0], 'hex_codec'))))
     if link == chain[-1][0]:
@@ -194,10 +857,58 @@ def _check_proof(chain):
         raise MerkleError('The Merkle Chain is not valid.')
 
 
-def check_proof(chain):
+def check_proof(chain, backend=None):
     """Verify a merkle chain, with hashes hex encoded, to see if the Merkle root can be reproduced.
     """
-    return codecs.encode(_check_proof([(codecs.decode(i[0][0], 'hex_codec'), i[1]) for i in chain]), 'hex_codec')
+    return codecs.encode(_check_proof([(codecs.decode(i[0][0], 'hex_codec'), i[1]) for i in chain], backend), 'hex_codec')
+
+
+def _check_multiproof(num_leaves, leaves, nodes, backend=None):
+    """Recompute the merkle root of a tree with num_leaves leaves from some of its leaves, given
+    as a dict of position to digest, and the nodes returned by get_multiproof, given as a dict of
+    (level, position) to digest. Nodes shared by the paths of several leaves are computed once.
+    """
+    hasher = hash_backends.get(backend).new
+    known = dict(leaves)
+    if not known or min(known) < 0 or max(known) >= num_leaves:
+        raise MerkleError('The leaves are not in a tree of %d leaves.' % num_leaves)
+    for level, width in enumerate(level_widths(num_leaves)[:-1]):
+        parents = {}
+        for pos in sorted(known):
+            if pos >> 1 in parents:
+                continue
+            sib = pos ^ 1
+            if sib >= width:
+                # promoted unchanged
+                parents[pos >> 1] = known[pos]
+                continue
+            if sib in known:
+                sib_val = known[sib]
+            elif (level, sib) in nodes:
+                sib_val = nodes[(level, sib)]
+            else:
+                raise MerkleError('The multiproof is missing node %d on level %d.' % (sib, level))
+            if sib < pos:
+                parents[pos >> 1] = hasher(sib_val + known[pos]).digest()
+            else:
+                parents[pos >> 1] = hasher(known[pos] + sib_val).digest()
+        known = parents
+    return known[0]
+
+
+def check_multiproof(num_leaves, leaves, nodes, backend=None):
+    """Recompute the merkle root from leaves and multiproof nodes given with hashes hex encoded,
+    with the nodes as returned by get_multiproof.
+    """
+    leaves = dict((pos, codecs.decode(digest, 'hex_codec')) for pos, digest in leaves.items())
+    nodes = dict(((level, pos), codecs.decode(digest, 'hex_codec')) for level, pos, digest in nodes)
+    return codecs.encode(_check_multiproof(num_leaves, leaves, nodes, backend), 'hex_codec')
+
+
+def hex_chain(chain):
+    """Hex encode the hashes of a chain returned by _get_proof, as get_proof returns them.
+    """
+    return [((codecs.encode(i[0][0], 'hex_codec'), i[0][1]), i[1]) for i in chain]
 
 
 def join_chains(low, high):
@@ -212,6 +923,8 @@ def join_chains(low, high):
 def print_tree(m):
     if isinstance(m, MerkleTree):
         print_tree_helper(m.root, level=0)
+    elif isinstance(m, FlatMerkleTree):
+        print_flat_tree_helper(m, m.height - 1, 0, level=0)
     else:
         raise TypeError("Input must be a MerkleTree object!")
 
@@ -225,9 +938,18 @@ def print_tree_helper(root, level=0):
         assert child != None
         print_tree_helper(child, level=level+1)
 
+def print_flat_tree_helper(m, height, pos, level=0):
+    print '\t' * level + str((codecs.encode(m.digest(height, pos), 'hex_codec'), m.idxs[height][pos]))
+    children = m.children(height, pos)
+    if children:
+        for child in children:
+            print_flat_tree_helper(m, child[0], child[1], level=level+1)
+
 def get_num_leaves(m):
     if isinstance(m, MerkleTree):
         return len(m.leaves)
+    elif isinstance(m, FlatMerkleTree):
+        return m.num_leaves
     else:
         raise TypeError("Input must be a MerkleTree object!")
 
@@ -236,6 +958,8 @@ def fetch_children_hash(m, path=[]):
     """When a client makes a call, we will return the hashes of the left and right children of
     the tree, following the path provided. If none provided, just return the two subtree nodes
     of the top of the tree"""
+    if isinstance(m, FlatMerkleTree):
+        return _fetch_flat_children_hash(m, path)
     the_node = m.root
     if get_num_leaves(m) == 1:
         lhash=rhash=codecs.encode(the_node.val, 'hex_codec')
@@ -265,4 +989,28 @@ def fetch_children_hash(m, path=[]):
         else:
             rhash = None
             rdata = None
-    return (lhash, rhash, ldata, rdata) 
\ No newline at end of file
+    return (lhash, rhash, ldata, rdata) 
+
+
+def _fetch_flat_children_hash(m, path):
+    """fetch_children_hash for a FlatMerkleTree, where the walk follows (level, pos) handles."""
+    if m.num_leaves == 1:
+        lhash=rhash=codecs.encode(m.root_val, 'hex_codec')
+        ldata=rdata=m.leaf_data(0)
+        return (lhash, rhash, ldata, rdata)
+    handle = (m.height - 1, 0)
+    for direction in path:
+        assert direction in ['l','r']
+        children = m.children(*handle)
+        if children is None:
+            break
+        handle = children[0] if direction == 'l' else children[1]
+    children = m.children(*handle)
+    if children is None:
+        return (None, None, None, None)
+    (llevel, lpos), (rlevel, rpos) = children
+    lhash = codecs.encode(m.digest(llevel, lpos), 'hex_codec')
+    rhash = codecs.encode(m.digest(rlevel, rpos), 'hex_codec')
+    ldata = m.leaf_data(lpos) if llevel == 0 else None
+    rdata = m.leaf_data(rpos) if rlevel == 0 else None
+    return (lhash, rhash, ldata, rdata)
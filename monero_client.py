@@ -1,15 +1,21 @@
-from merkle import Node, MerkleTree, _check_proof, check_proof, print_tree, fetch_children_hash, get_num_leaves
-import codecs, string, random, bisect, sqlite3, os.path, requests, grequests
+from merkle import Node, MerkleTree, MerkleError, _check_proof, check_proof, _check_multiproof, print_tree, fetch_children_hash, get_num_leaves
+import codecs, string, random, bisect, sqlite3, os.path, requests, grequests, multiprocessing, json
+import gevent, gevent.pool
+from collections import OrderedDict
+import proof_wire, hash_backends
 import numpy as np
 from random import randint
-from hashlib import sha256
 
 t1_root=t2_root=None
-hash_function = sha256
+# the hash backend that the servers build their trees with, by name, which setup learns from /getroot
+hash_backend = "sha256"
 
 server1 = "SET ADDRESS HERE"
 server2 = "SET ADDRESS HERE"
 
+# keeps connections to the servers alive between the calls below
+session = requests.Session()
+
 def block_verifier(m1, m2):
 	'''Searches for the block that is different in two servers. It will start by
 	sending challenges to the servers, asking the servers to return the left and right
@@ -23,7 +29,7 @@ def block_verifier(m1, m2):
 		raise ValueError("These roots are the same; there is no conflict.")
 	search = []
 	while True:
-		rs = [grequests.get(server1+"/getchildren", json={"root":m1[0],"path":search[:]}) , grequests.get(server2+"/getchildren", json={"root":m2[0], "path":search[:]})]
+		rs = [grequests.get(server1+"/getchildren", json={"root":m1[0],"path":search[:]}, session=session) , grequests.get(server2+"/getchildren", json={"root":m2[0], "path":search[:]}, session=session)]
 		r1, r2 = grequests.map(rs)
 		# r1 = requests.get(server1+"/getchildren", json={"root":m1[0], "path":search[:]})
 		# r2 = requests.get(server2+"/getchildren", json={"root":m2[0], "path":search[:]})
@@ -73,7 +79,7 @@ def block_verifier(m1, m2):
 	# empty the list to do a search for the transaction-level now
 	search[:] = []
 	while True:
-		rs = [grequests.get(server1+"/getchildren", json={"root":block_root_1, "path":search[:]}), grequests.get(server2+"/getchildren", json={"root":block_root_2, "path":search[:]})]
+		rs = [grequests.get(server1+"/getchildren", json={"root":block_root_1, "path":search[:]}, session=session), grequests.get(server2+"/getchildren", json={"root":block_root_2, "path":search[:]}, session=session)]
 		r1, r2 = grequests.map(rs)
 		# r1 = requests.get(server1+"/getchildren", json={"root":block_root_1, "path":search[:]})
 		# r2 = requests.get(server2+"/getchildren", json={"root":block_root_2, "path":search[:]})
@@ -109,7 +115,7 @@ def block_verifier(m1, m2):
 			tx_root_2 = ldata_2
 	# print tx_root_1
 	# print tx_root_2
-	rs = [grequests.get(server1+"/getnumleaves", json={"root":tx_root_1}), grequests.get(server2+"/getnumleaves", json={"root":tx_root_2})]
+	rs = [grequests.get(server1+"/getnumleaves", json={"root":tx_root_1, "block":block_root_1}, session=session), grequests.get(server2+"/getnumleaves", json={"root":tx_root_2, "block":block_root_2}, session=session)]
 	r1, r2 = grequests.map(rs)
 	# r1 = requests.get(server1+"/getnumleaves", json={"root":tx_root_1})
 	# r2 = requests.get(server2+"/getnumleaves", json={"root":tx_root_2})
@@ -121,7 +127,103 @@ def block_verifier(m1, m2):
 	# print "Server 2 has %d outputs at this transaction." %(r2["data"])
 	return r1["data"], r2["data"]
 
-def check_path(found_output, path_proof, top_root):
+def subtree_verifier(m1, m2, k=4):
+	'''Searches for the transaction that is different in two servers, as block_verifier does, but
+	compares k levels of the two trees at each round trip through /getsubtree, instead of one. First
+	the block that differs is found in the top Merkle trees, and then the transaction in the block
+	Merkle trees. Returns the number of outputs in that transaction at each server.'''
+	if m1 == m2:
+		raise ValueError("These roots are the same; there is no conflict.")
+	conflict = resolve_conflicts({server1: m1, server2: m2}, k)[0]
+	return conflict[server1][2], conflict[server2][2]
+
+def resolve_conflicts(roots, k=4):
+	'''Finds where any number of servers disagree, given a dict of each server to its top root.
+	Servers are grouped by the hashes they agree on, and only one server of each group is asked for
+	the next k levels, with the requests for all groups sent at once. The search goes down to the
+	leftmost block where the groups differ, and then to the leftmost transaction in it. Servers that
+	agree there but still have different roots disagree somewhere else, so each such group is searched
+	again, concurrently. Returns a list of conflicts, each a dict of every server involved to the
+	(block root, tx root, number of outputs) that it has there. A server whose tree has no block or
+	transaction there, such as one that is missing the last blocks, has None for that root, and 0
+	outputs, and is not searched any further at that place.'''
+	if len(set(root[0] for root in roots.values())) < 2:
+		raise ValueError("These roots are the same; there is no conflict.")
+	conflicts = []
+	def resolve(group):
+		classes = {}
+		for server, root in group.items():
+			classes.setdefault(root[0], []).append(server)
+		if len(classes) < 2:
+			return
+		blocks = find_conflicting_leaves([(servers, root) for root, servers in classes.items()], k)
+		present = [(servers, block_root) for servers, block_root in blocks if block_root is not None]
+		txs = find_conflicting_leaves(present, k) if present else []
+		block_roots = dict((server, block_root) for servers, block_root in blocks for server in servers)
+		found = [(servers, tx_root) for servers, tx_root in txs if tx_root is not None]
+		rs = [grequests.get(servers[0]+"/getnumleaves", json={"root":tx_root, "block":block_roots[servers[0]]}, session=session) for servers, tx_root in found]
+		conflict = {}
+		for (servers, tx_root), r in zip(found, grequests.map(rs)):
+			for server in servers:
+				conflict[server] = (block_roots[server], tx_root, r.json()["data"])
+		for servers, _ in [(servers, None) for servers, block_root in blocks if block_root is None] + [
+				(servers, None) for servers, tx_root in txs if tx_root is None]:
+			for server in servers:
+				conflict[server] = (block_roots[server], None, 0)
+		conflicts.append(conflict)
+		groups = [servers for servers, tx_root in txs] + [servers for servers, block_root in blocks if block_root is None]
+		gevent.joinall([gevent.spawn(resolve, dict((server, group[server]) for server in servers)) for servers in groups])
+	resolve(roots)
+	return conflicts
+
+def find_conflicting_leaves(classes, k):
+	'''Descends the trees of several groups of servers, given as a list of (servers, root) where
+	the root differs between groups, k levels at a time towards the leftmost leaf where they do not
+	all agree. Each round compares the deepest level that every group returned, and groups that agree
+	on the node where the search carries on are merged. A group whose tree has no node there, as when
+	it has fewer leaves, differs from the others by that alone, so it is set aside rather than searched.
+	Once one group is left, the search carries on to the leftmost leaf below that node. Returns a list
+	of (servers, leaf data) for the groups that differ at that leaf, where the data is None for the
+	groups that have no such leaf.'''
+	classes = [(servers, root, None) for servers, root in classes]
+	missing = []
+	while True:
+		rs = []
+		for servers, root, node in classes:
+			payload = {"root":root, "depth":k}
+			if node is not None:
+				payload["node"] = node
+			rs.append(grequests.get(servers[0]+"/getsubtree", json=payload, session=session))
+		responses = [r.json() for r in grequests.map(rs)]
+		nodes = [node if node is not None else (r["height"] - 1, 0) for (_, _, node), r in zip(classes, responses)]
+		depth = min(len(r["levels"]) for r in responses) - 1
+		rows = [r["levels"][depth] for r in responses]
+		diff = [i for i in range(max(len(row) for row in rows)) if len(set(tuple(row[i:i + 1]) for row in rows)) > 1]
+		if len(classes) == 1:
+			diff = [0]
+		if not diff:
+			raise ValueError("The trees have no leaf that differs.")
+		i = diff[0]
+		merged = OrderedDict()
+		for (servers, root, _), (level, pos), row, r in zip(classes, nodes, rows, responses):
+			node = (level - depth, (pos << depth) + i)
+			if i >= len(row):
+				missing.append(list(servers))
+				continue
+			if node[0] == 0 and i < len(r["data"]):
+				key = r["data"][i]
+			else:
+				key = tuple(row[i:i + 1])
+			if key in merged:
+				merged[key][0].extend(servers)
+			else:
+				merged[key] = (list(servers), root, node)
+		classes = merged.values()
+		if not classes or any(node[0] == 0 for _, _, node in classes):
+			return [(servers, data if node[0] == 0 else None) for data, (servers, _, node) in merged.items()] + [
+				(servers, None) for servers in missing]
+
+def check_path(found_output, path_proof, top_root, backend=None):
     '''This function, which is stored and run by the client, will check the Merkle proof returned
     by the server. The proof involves the following steps:
         1-  The requested output key is hashed to verify it matches the first part of the outkey proof.
@@ -132,62 +234,257 @@ def check_path(found_output, path_proof, top_root):
         6-  The top_merkle proof is run.
         7-  Finally, the last part of the proof, which should contain the top merkle root, is verified.
     If all steps pass, then we have successfully checked that our query was returned correctly.
-    If any of the checks fail, then the query was not returned correctly, and we need to run the verifier.'''
+    If any of the checks fail, then the query was not returned correctly, and we need to run the verifier.
+    An output whose tx has no other outputs is held inline in its block tree, and its proof has no
+    outkey proof, since the hash of the output is the root of its tx. The outkey proof is then None,
+    as json_path gives it, or left out, and it is taken to be the one a tree with that single leaf
+    would give.
+    Everything is hashed with the named hash backend, or else hash_backend, which has to be the one
+    the server built its trees with.'''
+    hash_function = hash_backends.get(backend or hash_backend).new
+    if len(path_proof) == 2 or path_proof[0] is None:
+        leaf = [hash_function(found_output[0]).hexdigest(), found_output[1]]
+        path_proof = [[[leaf, 'SELF'], [leaf, 'ROOT']]] + list(path_proof[-2:])
     outproof, txproof, blkproof = path_proof
     leaf_hashed, _ = outproof[0]
     if [hash_function(found_output[0]).hexdigest(),found_output[1]] == leaf_hashed:
-    	if check_proof(outproof):
+    	if check_proof(outproof, backend or hash_backend):
     		tx_hashed, _ = txproof[0]
     		outproof_merkle_root, _ = outproof[-1]
     		if [hash_function(outproof_merkle_root[0]).hexdigest(),outproof_merkle_root[1]]==tx_hashed:
-    			if check_proof(txproof):
+    			if check_proof(txproof, backend or hash_backend):
     				blk_hashed, _ = blkproof[0]
     				txproof_merkle_root, _ = txproof[-1]
     				if [hash_function(txproof_merkle_root[0]).hexdigest(), txproof_merkle_root[1]] == blk_hashed:
-    					if check_proof(blkproof):
+    					if check_proof(blkproof, backend or hash_backend):
     						blkproof_merkle_root,_ = blkproof[-1]
     						if blkproof_merkle_root == list(top_root):
     							return True
     return False
 
-def get_output(server, idx):
+def json_path(result):
+	'''Returns the output and the proof of a {"found", "proof", "inline"} result of /getout or /getouts.
+	The proof of an output whose tx is held inline has no outkey proof, which is put in as None, so that
+	every proof has the outkey, tx and block proofs in their places. A server that does not send
+	"inline" says so by leaving the outkey proof out.'''
+	proof = result["proof"]
+	if result.get("inline", len(proof) == 2):
+		proof = [None] + list(proof[-2:])
+	return result["found"], proof
+
+def check_paths(results, top_root, workers=1, backend=None):
+	'''Checks many (found_output, path_proof) pairs at once, such as those returned by get_outputs,
+	and returns whether each of them checked out. This is the same check as check_path, but a chain
+	that proves some root is part of a tree above it is only checked once per batch, so outputs that
+	share a transaction or a block do not check the same tx and block chains over again. The hashes
+	are decoded from hex once, and everything else is done on raw bytes. With more than one worker,
+	the batch is split into that many runs of neighbouring outputs, which are checked in a pool.'''
+	if workers > 1 and len(results) > workers:
+		size = -(-len(results) // workers)
+		chunks = [(results[i:i + size], top_root, backend) for i in range(0, len(results), size)]
+		pool = multiprocessing.Pool(workers)
+		try:
+			checked = pool.map(check_paths_chunk, chunks)
+		finally:
+			pool.close()
+			pool.join()
+		return [ok for chunk in checked for ok in chunk]
+	verified = set()
+	return [check_path_memo(found_output, path_proof, top_root, verified, backend) for found_output, path_proof in results]
+
+def check_paths_chunk(args):
+	'''Checks one run of a batch in a check_paths pool worker.'''
+	results, top_root, backend = args
+	return check_paths(results, top_root, backend=backend)
+
+def check_path_memo(found_output, path_proof, top_root, verified, backend=None):
+	'''check_path for check_paths, which skips the chains in the verified set of (leaf, root) pairs
+	that have been checked already, and adds those that it checks.'''
+	hash_function = hash_backends.get(backend or hash_backend).new
+	lower = [hash_function(found_output[0]).hexdigest(), found_output[1]]
+	if len(path_proof) == 2 or path_proof[0] is None:
+		# an inline output is the root of its own tx, so the tx chain starts from its hash
+		lower = [hash_function(lower[0]).hexdigest(), lower[1]]
+		path_proof = path_proof[-2:]
+	try:
+		for chain in path_proof:
+			if list(chain[0][0]) != lower:
+				return False
+			root = chain[-1][0]
+			if (lower[0], root[0]) not in verified:
+				if not raw_chain_valid(chain, backend):
+					return False
+				verified.add((lower[0], root[0]))
+			lower = [hash_function(root[0]).hexdigest(), root[1]]
+	except (TypeError, ValueError, IndexError):
+		return False
+	return list(root) == list(top_root)
+
+def raw_chain_valid(chain, backend=None):
+	'''Whether a hex chain leads to its root, as check_proof checks, but returning False instead
+	of raising, and decoding each hash once.'''
+	hash_function = hash_backends.get(backend or hash_backend).new
+	link = codecs.decode(chain[0][0][0], 'hex_codec')
+	for (digest, _), side in chain[1:-1]:
+		if side == 'R':
+			link = hash_function(link + codecs.decode(digest, 'hex_codec')).digest()
+		elif side == 'L':
+			link = hash_function(codecs.decode(digest, 'hex_codec') + link).digest()
+		else:
+			return False
+	return link == codecs.decode(chain[-1][0][0], 'hex_codec')
+
+def check_binary_path(path, top_root, backend=None):
+	'''Checks a proof in the binary format, decoded by proof_wire. This is the same check as
+	check_path, but over the one flattened chain: the output is hashed, and then each sibling is
+	hashed in on its side. Where the chain crosses from one tree to the next, the root of the lower
+	tree is hashed in hex form, which gives the leaf of the tree above. The siblings are hashed in
+	place from the response, and the result has to be the top root.'''
+	hash_function = hash_backends.get(backend or hash_backend).new
+	link = hash_function(path.data).digest()
+	i = 0
+	for layer, (num_siblings, _) in enumerate(path.layers):
+		if layer:
+			link = hash_function(codecs.encode(link, 'hex_codec')).digest()
+		for _ in range(num_siblings):
+			sibling, left = path.sibling(i)
+			i += 1
+			h = hash_function()
+			if left:
+				h.update(sibling)
+				h.update(link)
+			else:
+				h.update(link)
+				h.update(sibling)
+			link = h.digest()
+	return [codecs.encode(link, 'hex_codec'), path.layers[-1][1]] == list(top_root)
+
+def check_multiproof_paths(multiproof, top_root, backend=None):
+	'''Checks the multiproof returned for a batch of outputs by get_outputs_multiproof. Each output
+	is hashed into the tx tree it refers to, and the root of each tx tree is recomputed once from all
+	of its outputs. Those roots are hashed into their block trees in the same way, and the roots of the
+	block trees into the top tree, whose root must match top_root. A node that several outputs depend
+	on is only computed once. Returns True if every output in the batch was proven.'''
+	backend = hash_backends.get(backend or hash_backend)
+	hash_function = backend.new
+	try:
+		tx_leaves = [{} for _ in multiproof["txs"]]
+		for found_output, tx, pos in multiproof["outputs"]:
+			leaf = hash_function(found_output[0]).digest()
+			if tx_leaves[tx].setdefault(pos, leaf) != leaf:
+				return False
+		blk_leaves = [{} for _ in multiproof["blocks"]]
+		for leaves, tx in zip(tx_leaves, multiproof["txs"]):
+			root = _check_multiproof(tx["n"], leaves, multiproof_nodes(tx), backend)
+			leaf = hash_function(codecs.encode(root, 'hex_codec')).digest()
+			if blk_leaves[tx["block"]].setdefault(tx["pos"], leaf) != leaf:
+				return False
+		top_leaves = {}
+		for leaves, block in zip(blk_leaves, multiproof["blocks"]):
+			root = _check_multiproof(block["n"], leaves, multiproof_nodes(block), backend)
+			leaf = hash_function(codecs.encode(root, 'hex_codec')).digest()
+			if top_leaves.setdefault(block["pos"], leaf) != leaf:
+				return False
+		top = multiproof["top"]
+		root = _check_multiproof(top["n"], top_leaves, multiproof_nodes(top), backend)
+	except (MerkleError, KeyError, IndexError, TypeError, ValueError):
+		return False
+	return codecs.encode(root, 'hex_codec') == top_root[0]
+
+def multiproof_nodes(tree):
+	'''Decodes the nodes given for one tree of a multiproof into a dict of (level, position) to digest.'''
+	return dict(((level, pos), codecs.decode(digest, 'hex_codec')) for level, pos, digest in tree["nodes"])
+
+def get_output(server, idx, binary=False):
 	'''Gets the output located at at a given server, and also returns the proof
-	associated. This is done by calling the server'''
+	associated. This is done by calling the server. If binary is set, the proof is sent
+	in the binary format, and is checked by check_binary_path instead of check_path.
+	The proof is asked for against the root we hold for the server, so it still checks out
+	if the server has been updated since, as long as the server keeps that root.'''
 	assert server in [server1, server2]
 	top_root = t1_root if server==server1 else t2_root
 	if idx <= top_root[1] and idx >= 0:
-		r = requests.get(server+"/getout", json={"idx":idx})
+		payload = {"idx":idx, "root":top_root[0]}
+		if binary:
+			r = session.get(server+"/getout", json=payload, headers={"Accept":proof_wire.MIMETYPE})
+			if r.headers.get("Content-Type") != proof_wire.MIMETYPE:
+				raise ValueError("The server no longer keeps the root %s." % top_root[0])
+			path, _ = proof_wire.decode_path(memoryview(r.content))
+			return path.found_output, path
+		r = session.get(server+"/getout", json=payload)
 		r = r.json()
-		found_output = r["found"]
-		found_proof = r["proof"]
-		return found_output, found_proof
+		if "Failure" in r:
+			raise ValueError("The server no longer keeps the root %s." % top_root[0])
+		return json_path(r)
 	else:
 		raise ValueError("Invalid global index requested.")
 
-def get_outputs(server, indices=[]):
+def get_outputs(server, indices=[], binary=False):
 	'''Gets the outputs located at at a given server, and also returns the proofs
 	associated. This is done for multiple indices.'''
 	assert server in [server1, server2]
 	top_root = t1_root if server==server1 else t2_root
 	if all(idx <= top_root[1] and idx >= 0 for idx in indices):
+		if binary:
+			r = session.get(server+"/getouts", json={"idx":indices}, headers={"Accept":proof_wire.MIMETYPE})
+			return [(path.found_output, path) for path in proof_wire.decode_paths(r.content)]
 		output_list = []
-		r = requests.get(server+"/getouts", json={"idx":indices})
+		r = session.get(server+"/getouts", json={"idx":indices})
 		r = r.json()
 		results = r["results"]
 		for rs in results:
-			output_list.append((rs["found"], rs["proof"]))
+			output_list.append(json_path(rs))
 		return output_list
 	else:
 		raise ValueError("Invalid global index requested.")
 
+def get_outputs_multiproof(server, indices=[]):
+	'''Gets the outputs located at at a given server for multiple indices, together with one
+	multiproof for all of them, which is checked by check_multiproof_paths.'''
+	assert server in [server1, server2]
+	top_root = t1_root if server==server1 else t2_root
+	if all(idx <= top_root[1] and idx >= 0 for idx in indices):
+		r = session.get(server+"/getouts", json={"idx":indices, "multiproof":True})
+		r = r.json()
+		output_list = [found_output for found_output, _, _ in r["outputs"]]
+		return output_list, r
+	else:
+		raise ValueError("Invalid global index requested.")
+
 def update_server(server):
 	'''Get the updated top Merkle root at each server. This triggers the server side to 
-	read in new blocks and update its Merkle tree structure. In practice, we would want
-	the server to update itself without being called, and then periodically push a new
-	top root over to its client.'''
+	read in new blocks and update its Merkle tree structure. A server that updates itself,
+	with its ingestor, pushes each new top root to the clients that subscribe instead.'''
+	assert server in [server1, server2]
+	r = session.post(server+"/update")
+	set_root(server, r.json())
+
+def extend_server(server, count=None, idx=None):
+	'''Like update_server, but has the server add many blocks in one call: count of them, or
+	as many as it takes to reach global index idx, or else all the blocks it has.'''
 	assert server in [server1, server2]
-	r = requests.post(server+"/update")
-	r = r.json()
+	payload = {}
+	if count is not None:
+		payload["count"] = count
+	if idx is not None:
+		payload["idx"] = idx
+	r = session.post(server+"/extend", json=payload)
+	set_root(server, r.json())
+
+def rollback_server(server, height=None, idx=None):
+	'''Has the server drop its last blocks after the chain reorganizes, down to height blocks,
+	or to the last block at or below global index idx, and takes the root it rolled back to.'''
+	assert server in [server1, server2]
+	payload = {}
+	if height is not None:
+		payload["height"] = height
+	if idx is not None:
+		payload["idx"] = idx
+	r = session.post(server+"/rollback", json=payload)
+	set_root(server, r.json())
+
+def set_root(server, r):
+	'''Keeps the new top Merkle root that a server returned after an update.'''
 	if "Failure" in r:
 		raise Exception("Server is up to date.")
 	if server==server1:
@@ -199,16 +496,186 @@ def update_server(server):
 		t2_root = tuple(r["root"])
 		print "Server 2's top Merkle root has been updated."
 
+def watch_roots(server, sse=False, timeout=30, after=0, session=session):
+	'''Yields every new top root of a server as the server publishes it, by long polling /subscribe,
+	or else from its stream of server-sent events. Each one comes with the number of blocks in the top
+	tree, the time it was published and its sequence number.'''
+	while True:
+		if sse:
+			r = session.get(server+"/subscribe", headers={"Accept": "text/event-stream", "Last-Event-ID": str(after)}, stream=True)
+			# the stream is not chunked, so it is read a byte at a time to see each event once it is sent
+			for line in r.iter_lines(chunk_size=1):
+				if line.startswith("data: "):
+					event = json.loads(line[6:])
+					after = event["seq"]
+					yield event
+		else:
+			r = session.get(server+"/subscribe", json={"after": after, "timeout": timeout})
+			# a server that has not published a root yet has nothing to return
+			if r.status_code == 204:
+				continue
+			event = r.json()
+			if event["seq"] != after:
+				after = event["seq"]
+				yield event
+
+def subscribe(server, sse=False):
+	'''Keeps t1_root or t2_root up to date in the background as the server publishes new roots, in
+	place of calling update_server or polling /getroot. Returns the greenlet that does so.'''
+	assert server in [server1, server2]
+	def follow():
+		for event in watch_roots(server, sse=sse):
+			set_root(server, event)
+	return gevent.spawn(follow)
+
 def setup():
-	'''Sets up the client and connects it to the 2 remote nodes we use in our tests.'''
-	global t1_root, t2_root
-	r1 = requests.get(server1+"/getroot")
+	'''Sets up the client and connects it to the 2 remote nodes we use in our tests, and takes the
+	hash backend that their trees are built with.'''
+	global t1_root, t2_root, hash_backend
+	r1 = session.get(server1+"/getroot")
 	r1 = r1.json()
 	t1_root = tuple(r1["root"])
-	r2 = requests.get(server2+"/getroot")
+	hash_backend = r1.get("hash", hash_backend)
+	r2 = session.get(server2+"/getroot")
 	r2 = r2.json()
 	t2_root = tuple(r2["root"])
 
+class PooledClient(object):
+	'''A client that keeps a pool of keep-alive connections to each server, and fetches outputs
+	concurrently with gevent, which grequests has already set up. Long lists of indices are split into
+	chunks of chunk_size for /getouts, and at most max_in_flight chunks are requested at a time. If
+	binary is set, proofs are fetched in the binary format.
+	Each chunk is handed on to be decoded and checked as soon as it arrives, in whatever order the
+	chunks come in. With check_workers, which is one less than the number of CPUs unless it is given,
+	that is done in a pool of worker processes, so the checks run while the greenlets go on fetching,
+	and the client process only sends requests, reads responses and collects the outputs. Threads would
+	not do, since decoding and checking hold the GIL. With no workers, as on a single CPU, each chunk is
+	checked in the greenlet that collects them, and no request is sent while it is.
+	The chunks are spread over the servers in turn, so each output comes from one server only, and is
+	only checked against that server's top root. This spreads the load, but two servers on different
+	chains both pass. With cross_check, get_outputs also fetches one chunk, picked at random, from a
+	second server and compares the two.'''
+
+	def __init__(self, servers=None, chunk_size=500, max_in_flight=8, binary=True, check_workers=None):
+		self.servers = list(servers) if servers else [server1, server2]
+		self.chunk_size = chunk_size
+		self.binary = binary
+		if check_workers is None:
+			check_workers = multiprocessing.cpu_count() - 1
+		# started before any connection is opened, so that the workers share none of them
+		self.check_pool = multiprocessing.Pool(check_workers) if check_workers > 0 else None
+		self.pool = gevent.pool.Pool(max_in_flight)
+		self.sessions = {}
+		for server in self.servers:
+			self.sessions[server] = requests.Session()
+			self.sessions[server].mount(server, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight))
+		self.roots = {}
+		self.backends = {}
+		# (index, {server: found_output}) for each output on which a cross check found two servers disagree
+		self.disagreements = []
+
+	def setup(self):
+		'''Gets the top root and hash backend of every server, all at once.'''
+		responses = self.pool.imap(lambda server: self.sessions[server].get(server+"/getroot").json(), self.servers)
+		for server, r in zip(self.servers, responses):
+			self.roots[server] = tuple(r["root"])
+			self.backends[server] = r.get("hash", hash_backend)
+		return self.roots
+
+	def update_server(self, server):
+		'''Triggers an update at a server, and keeps its new top root.'''
+		r = self.sessions[server].post(server+"/update").json()
+		if "Failure" in r:
+			raise Exception("Server is up to date.")
+		self.roots[server] = tuple(r["root"])
+		return self.roots[server]
+
+	def subscribe(self, sse=False):
+		'''Keeps the top root of every server up to date in the background as they publish new ones.
+		Returns the greenlets that do so.'''
+		def follow(server):
+			for event in watch_roots(server, sse=sse, session=self.sessions[server]):
+				self.roots[server] = tuple(event["root"])
+		return [gevent.spawn(follow, server) for server in self.servers]
+
+	def fetch_chunk(self, server, indices):
+		'''Gets the outputs for one chunk of indices from a server, with their proofs, as the body of
+		the response, which check_chunk decodes.'''
+		headers = {"Accept":proof_wire.MIMETYPE} if self.binary else {}
+		return server, self.sessions[server].get(server+"/getouts", json={"idx":indices}, headers=headers).content
+
+	def check_chunk(self, server, content, verify=True):
+		'''Decodes one chunk from a server, and checks its proofs against that server's top root if
+		verify is set. Returns the outputs found and whether each checked out. With check_workers, this
+		is done in a worker, and the result is returned to wait for, rather than the result itself.'''
+		args = (content, self.binary, self.roots[server] if verify else None, self.backends.get(server))
+		if self.check_pool is None:
+			return check_chunk(args)
+		return self.check_pool.apply_async(check_chunk, (args,))
+
+	def close(self):
+		'''Stops the workers that check the chunks, if there are any.'''
+		if self.check_pool is not None:
+			self.check_pool.close()
+			self.check_pool.join()
+			self.check_pool = None
+
+	def get_outputs(self, indices, servers=None, verify=True, cross_check=False):
+		'''Gets the outputs at many indices from the given servers, or from all of them. Returns a list
+		of (found_output, server, checked) in the order of the indices, where checked says whether the
+		proof checked out against the top root of that server, or is None if verify is not set. With
+		cross_check and more than one server, the outputs of one chunk are fetched from the next
+		server as well, and any that differ are put in disagreements, for resolve_conflicts to find out
+		why.'''
+		servers = servers or self.servers
+		if any(server not in self.roots for server in servers):
+			self.setup()
+		if not all(0 <= idx <= min(self.roots[server][1] for server in servers) for idx in indices):
+			raise ValueError("Invalid global index requested.")
+		starts = range(0, len(indices), self.chunk_size)
+		chunks = [(servers[i % len(servers)], indices[start:start + self.chunk_size]) for i, start in enumerate(starts)]
+		if cross_check and len(servers) > 1 and chunks:
+			i = random.randrange(len(chunks))
+			chunks.append((servers[(i + 1) % len(servers)], chunks[i][1]))
+		def fetch(n):
+			return (n,) + self.fetch_chunk(*chunks[n])
+		fetched = [None] * len(chunks)
+		# chunks are checked in the order they arrive in, so one that is slow to come holds up no other
+		for n, server, content in self.pool.imap_unordered(fetch, range(len(chunks))):
+			# the chunk fetched again for the cross check is only compared
+			fetched[n] = (server, self.check_chunk(server, content, verify and n < len(starts)))
+		if self.check_pool is not None:
+			fetched = [(server, checking.get()) for server, checking in fetched]
+		if len(fetched) > len(starts):
+			self.cross_check(chunks[i][1], fetched[i], fetched.pop())
+		results = []
+		for server, (outputs, checked) in fetched:
+			results.extend((found_output, server, ok) for found_output, ok in zip(outputs, checked))
+		return results
+
+	def cross_check(self, indices, fetched, again):
+		'''Compares the outputs of one chunk as fetched from two servers, and keeps those that differ.'''
+		(server, (outputs, _)), (other, (other_outputs, _)) = fetched, again
+		for idx, found, other_found in zip(indices, outputs, other_outputs):
+			if list(found) != list(other_found):
+				self.disagreements.append((idx, {server: found, other: other_found}))
+
+def check_chunk(args):
+	'''Decodes the body of a /getouts response that a PooledClient fetched, and checks its proofs
+	against the top root, unless that is None. Returns the outputs found and whether each checked out.'''
+	content, binary, top_root, backend = args
+	if binary:
+		paths = proof_wire.decode_paths(content)
+		outputs = [path.found_output for path in paths]
+		if top_root is None:
+			return outputs, [None] * len(paths)
+		return outputs, [check_binary_path(path, top_root, backend) for path in paths]
+	results = [json_path(rs) for rs in json.loads(content)["results"]]
+	outputs = [found_output for found_output, _ in results]
+	if top_root is None:
+		return outputs, [None] * len(results)
+	return outputs, check_paths(results, top_root, backend=backend)
+
 def main():
 	setup()
 
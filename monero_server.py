@@ -1,10 +1,12 @@
 '''This file is used to set up the Merkle Tree on the server side'''
-from merkle import Node, MerkleTree, _check_proof, check_proof, print_tree, fetch_children_hash, get_num_leaves
-from hashlib import sha256
-from flask import Flask, request, jsonify
-from collections import OrderedDict
-import codecs, string, random, bisect, sqlite3, os.path
+from merkle import Node, MerkleTree, FlatMerkleTree, _check_proof, check_proof, hex_chain, print_tree, fetch_children_hash, get_num_leaves, level_widths
+from flask import Flask, request, jsonify, json, _request_ctx_stack
+import sys, codecs, string, random, bisect, sqlite3, os, os.path, itertools, multiprocessing, socket, signal, requests
+import threading, weakref, time, heapq
 import cPickle as pickle
+from operator import itemgetter
+from collections import OrderedDict, deque
+import forest_store, proof_wire, hash_backends, build_profile
 app = Flask(__name__)
 
 # Uncomment to disable logging
@@ -12,25 +14,72 @@ app = Flask(__name__)
 # log = logging.getLogger('werkzeug')
 # log.setLevel(logging.ERROR)
 
-hash_function = sha256
+# the hash backend that every tree is built with, by name, which clients learn from /getroot
+hash_backend = "sha256"
 utxos = []
+# blocks that have been read in but not yet added by update_merkle, one list of outkeys per block
+pending_blocks = iter([])
 
-merkle_forest = OrderedDict()
+# maps the raw root digest of every tx, block and top tree to the tree itself
+merkle_forest = {}
 
 top_root = None
 top_merkle = None
 
-def find_ge(my_array, target):
-    '''Find smallest item greater-than or equal to key.
+# number of processes scan_over_new_blocks builds the block and tx trees in, and roughly how many
+# outputs each of them is handed at a time
+build_workers = 1
+build_chunk_size = 20000
+# number of rows fetched from the out_table at a time
+ingest_chunk_size = 10000
+# whether a tx with a single output is kept inline in its block tree, rather than as a tree of its own
+inline_single_outputs = True
+# a build_profile.BuildProfiler to split the time that building and updating take into phases, or None;
+# main() sets one with "profile", writes its report to build_profile_path once the forest is built, and
+# dumps a cProfile of each phase to build_profile_dir, if that is set
+build_profiler = None
+build_profile_path = "/data/build_profile.json"
+build_profile_dir = None
+
+# where main() keeps the forest between runs: a snapshot, and a log of the updates made since
+snapshot_path = "/data/merkle_forest.snap"
+delta_log_path = "/data/merkle_forest.log"
+delta_log = None
+# the delta log is folded into a new snapshot once it holds this many records, or this many bytes
+compact_log_records = 10000
+compact_log_bytes = 256 << 20
+
+# in a pre-forked server, the writer publishes each new forest image through image_publisher,
+# while the readers map it through shared_image and hand updates on to the writer at writer_url
+image_publisher = None
+shared_image = None
+writer_url = None
+
+def build_phase(name):
+    '''Returns a context manager that times name as a phase of build_profiler, if it is set.'''
+    if build_profiler is None:
+        return build_profile.null_phase
+    return build_profiler.phase(name)
+
+def find_ge(merkle, target):
+    '''Find the leaf of a Merkle tree with the smallest index greater-than or equal to key,
+    as a (key, idx) pair together with its position.
     Raise ValueError if no such item exists.
     If multiple keys are equal, return the leftmost.
 
     '''
-    fst, snd = zip(*my_array)
-    i = bisect.bisect_left(snd, target)
-    if i == len(snd):
+    i = merkle.find_leaf(target)
+    if i == merkle.num_leaves:
         raise ValueError('No item found with key at or above: %r' % (target,))
-    return my_array[i], i
+    return merkle.leaf_entry(i), i
+
+def forest_key(hex_root):
+    '''Returns the raw digest used as the merkle_forest key for a hex encoded root, or None
+    if the root is not valid hex.'''
+    try:
+        return codecs.decode(hex_root, 'hex_codec')
+    except (TypeError, ValueError):
+        return None
 
 def find_nearest_above(my_array, target):
     '''A linear version of the find greater or equal to
@@ -44,41 +93,87 @@ def read_in_blocks(database_name):
     If there already exists an pickle file, then don't bother reading from the database again
     '''
     if os.path.isfile("/data/"+database_name+".p"):
-        fetched = pickle.load(open("/data/"+database_name+".p","rb"))
+        with build_phase("pickle"):
+            fetched = pickle.load(open("/data/"+database_name+".p","rb"))
     else:
-        conn = sqlite3.connect("/data/"+database_name+".db")
-        c_1 = conn.cursor()
-        c_1.execute('''SELECT block_hash, tx_hash, outkey, idx FROM out_table ORDER BY idx LIMIT 200''')
-        fetched = c_1.fetchall()
-        pickle.dump(fetched, open("/data/"+database_name+".p", "wb" ))
-        conn.close()
+        fetched = list(stream_outkeys(database_name))
+        with build_phase("pickle"):
+            pickle.dump(fetched, open("/data/"+database_name+".p", "wb" ))
     global utxos
     utxos = fetched
-    
+
+def stream_outkeys(database_name, start_idx=-1, chunk_size=None):
+    '''Yields the outkeys in the database with a global index above start_idx, in order of global index.
+    Only chunk_size rows are held in memory at a time, so the whole out_table can be read this way.
+    The database is looked for in /data, unless database_name is an absolute path.'''
+    if chunk_size is None:
+        chunk_size = ingest_chunk_size
+    conn = sqlite3.connect(os.path.join("/data", database_name+".db"), check_same_thread=False)
+    try:
+        c_1 = conn.cursor()
+        with build_phase("sqlite"):
+            c_1.execute('''SELECT block_hash, tx_hash, outkey, idx FROM out_table WHERE idx > ? ORDER BY idx''', (start_idx,))
+        while True:
+            with build_phase("sqlite"):
+                fetched = c_1.fetchmany(chunk_size)
+            if not fetched:
+                break
+            for outkey in fetched:
+                yield outkey
+    finally:
+        conn.close()
+
+def group_blocks(outkeys):
+    '''Groups a stream of outkeys, ordered by global index, into one list of outkeys per block.
+    Only the block being grouped is held in memory.'''
+    for _, block_outkeys in itertools.groupby(outkeys, key=itemgetter(0)):
+        with build_phase("group"):
+            block_outkeys = list(block_outkeys)
+        yield block_outkeys
+
+def queue_new_blocks(outkeys):
+    '''Sets the outkeys that update_merkle adds to the Merkle Tree, one block at a time.'''
+    global pending_blocks
+    pending_blocks = group_blocks(outkeys)
+
 def block_to_merkle(block_outkeys):
     '''Takes in the outkeys that all belong to the same block (by block hash, we can also do height)
     and then builds a Merkle Tree. It also updates the client side block_root_hash dictionary
     and the server side block_merkle dictionary
+    The tx Merkle Trees of the block are made, built and added to the merkle_forest each in one go,
+    so that build_profiler times each step once per block rather than once per tx.
     '''
-    # change to 
-    # for block_hash, tx_hash, outkey, idx in block_outkeys
     block_merkle_leaves=[]
+    inline = {}
     block_hash = block_outkeys[0][0]
     assert all(bhash == block_hash for bhash, _, _, _ in block_outkeys)
 
-    while block_outkeys:
-        curr_tx_hash = block_outkeys[0][1]
-        tx_outkeys = []
-        while block_outkeys[0][1] == curr_tx_hash:
-            tx_outkeys.append(block_outkeys.pop(0))
-            if not block_outkeys:
-                break
-        block_merkle_leaves.append(tx_to_merkle(tx_outkeys))
-    block_merkle = MerkleTree(leaves=block_merkle_leaves)
-    block_merkle.build()
+    with build_phase("group"):
+        txs = [list(tx_outkeys) for _, tx_outkeys in itertools.groupby(block_outkeys, key=itemgetter(1))]
+    with build_phase("allocate"):
+        # the root of a tree over one output is the hash of that output, so there is no tree to keep
+        tx_merkles = [None if inline_single_outputs and len(tx_outkeys) == 1 else
+            FlatMerkleTree(leaves=[(outkey,idx) for _,_,outkey,idx in tx_outkeys], backend=hash_backend)
+            for tx_outkeys in txs]
+    with build_phase("hash"):
+        hash_function = hash_backends.get(hash_backend).hash
+        for tx_outkeys, tx_merkle in itertools.izip(txs, tx_merkles):
+            if tx_merkle is None:
+                _, _, outkey, idx = tx_outkeys[0]
+                inline[len(block_merkle_leaves)] = outkey
+                block_merkle_leaves.append((hash_function(outkey), idx))
+            else:
+                tx_merkle.build()
+                block_merkle_leaves.append((tx_merkle.root_val, tx_merkle.root_idx))
+        block_merkle = FlatMerkleTree(leaves=block_merkle_leaves, keyed=True, inline=inline, backend=hash_backend)
+        block_merkle.build()
 
-    merkle_forest[codecs.encode(block_merkle.root.val, 'hex_codec')] = block_merkle
-    return (codecs.encode(block_merkle.root.val, 'hex_codec'), block_merkle.root.idx)
+    with build_phase("insert"):
+        for tx_merkle in tx_merkles:
+            if tx_merkle is not None:
+                merkle_forest[tx_merkle.root_val] = tx_merkle
+        merkle_forest[block_merkle.root_val] = block_merkle
+    return (block_merkle.root_val, block_merkle.root_idx)
 
 def tx_to_merkle(tx_outkeys):
     '''Takes in the outkeys that all belong to the same transaction (by transaction hash) and builds
@@ -88,32 +183,98 @@ def tx_to_merkle(tx_outkeys):
     assert all(t_hash == tx_hash for _, t_hash, _, _ in tx_outkeys)
 
     tx_merkle_leaves = [(outkey,idx) for _,_,outkey,idx in tx_outkeys]
-    tx_merkle = MerkleTree(leaves=tx_merkle_leaves)
+    tx_merkle = FlatMerkleTree(leaves=tx_merkle_leaves, backend=hash_backend)
     tx_merkle.build()
 
-    merkle_forest[codecs.encode(tx_merkle.root.val, 'hex_codec')] = tx_merkle
-    return (codecs.encode(tx_merkle.root.val, 'hex_codec'), tx_merkle.root.idx)
+    merkle_forest[tx_merkle.root_val] = tx_merkle
+    return (tx_merkle.root_val, tx_merkle.root_idx)
+
+def build_block_range(block_range):
+    '''Runs in a build worker. Takes a list of blocks, each a list of the outkeys in that block,
+    and builds their block and tx Merkle Trees. It returns the top Merkle leaf of each block,
+    along with every tree that was built, serialized and keyed by its root. If the parent is profiling
+    the build, the worker profiles its share too, and returns the report for the parent to merge.'''
+    global merkle_forest, build_profiler
+    merkle_forest = {}
+    profiling = build_profiler is not None
+    if profiling:
+        # the profiler inherited from the parent is a copy, so the worker starts one of its own
+        build_profiler = build_profile.BuildProfiler(trace_memory=build_profiler.trace_memory).start()
+    top_merkle_leaves = [block_to_merkle(block_outkeys) for block_outkeys in block_range]
+    with build_phase("serialize"):
+        trees = [(key, tree.serialize()) for key, tree in merkle_forest.iteritems()]
+    if not profiling:
+        return top_merkle_leaves, trees, None
+    report = build_profiler.stop().report()
+    build_profiler = None
+    return top_merkle_leaves, trees, report
 
-def scan_over_new_blocks(new_blocks):
+def split_block_ranges(new_blocks, chunk_size):
+    '''Splits the utxos into runs of whole blocks holding about chunk_size outkeys each.'''
+    block_range, range_size = [], 0
+    for block_outkeys in group_blocks(new_blocks):
+        block_range.append(block_outkeys)
+        range_size += len(block_outkeys)
+        if range_size >= chunk_size:
+            yield block_range
+            block_range, range_size = [], 0
+    if block_range:
+        yield block_range
+
+def parallel_scan(new_blocks, workers):
+    '''Builds the block and tx Merkle Trees for the utxos in a pool of worker processes,
+    and adds them to the merkle_forest. Returns the leaves of the top Merkle Tree, in order.'''
+    top_merkle_leaves = []
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.imap(build_block_range, split_block_ranges(new_blocks, build_chunk_size))
+        while True:
+            with build_phase("workers"):
+                result = next(results, None)
+            if result is None:
+                break
+            block_leaves, trees, report = result
+            if report is not None and build_profiler is not None:
+                build_profiler.merge(report)
+            for key, blob in trees:
+                with build_phase("serialize"):
+                    tree, _ = FlatMerkleTree.deserialize(blob)
+                with build_phase("insert"):
+                    merkle_forest[key] = tree
+            top_merkle_leaves.extend(block_leaves)
+    finally:
+        pool.close()
+        pool.join()
+    return top_merkle_leaves
+
+def scan_over_new_blocks(new_blocks, workers=None):
     '''Scan over the utxos, distinguishing new blocks
     We will use block hash to distinguish new blocks. The top Merkle Tree is created
-    The client side top_root will be udpated, as well as the top_merkle ADS on the server'''
-    top_merkle_leaves=[]
-    while new_blocks:
-        curr_block_hash = new_blocks[0][0]
-        block_outkeys = []
-        while new_blocks[0][0] == curr_block_hash:
-            block_outkeys.append(new_blocks.pop(0))
-            if not new_blocks:
-                break
-        top_merkle_leaves.append(block_to_merkle(block_outkeys))
-    global top_merkle
-    top_merkle = MerkleTree(leaves = top_merkle_leaves)
-    top_merkle.build()
+    The client side top_root will be udpated, as well as the top_merkle ADS on the server
+    The utxos can be any iterable ordered by global index, such as stream_outkeys.
+    With more than one worker, the blocks are built by parallel_scan instead. The top
+    Merkle Tree is the same either way.'''
+    global top_merkle, top_root, forest_generation
+    with update_lock, build_phase("build"):
+        if workers is None:
+            workers = build_workers
+        if workers > 1:
+            top_merkle_leaves = parallel_scan(new_blocks, workers)
+        else:
+            top_merkle_leaves = [block_to_merkle(block_outkeys) for block_outkeys in group_blocks(new_blocks)]
+        with build_phase("top"):
+            top_merkle = FlatMerkleTree(leaves = top_merkle_leaves, keyed=True, backend=hash_backend)
+            top_merkle.build()
 
-    global top_root
-    top_root = (codecs.encode(top_merkle.root.val, 'hex_codec'), top_merkle.root.idx)
-    merkle_forest[codecs.encode(top_merkle.root.val, 'hex_codec')] = top_merkle
+        top_root = (codecs.encode(top_merkle.root_val, 'hex_codec'), top_merkle.root_idx)
+        merkle_forest[top_merkle.root_val] = top_merkle
+        forest_generation += 1
+        if proof_cache is not None:
+            proof_cache.clear(forest_generation)
+        root_history.clear()
+        retiring.clear()
+        with build_phase("publish"):
+            publish_snapshot()
     # merkle_forest.close()
 
 def check_path(found_output, path_proof):
@@ -127,47 +288,667 @@ def check_path(found_output, path_proof):
         6-  The top_merkle proof is run.
         7-  Finally, the last part of the proof, which should contain the top merkle root, is verified.
     If all steps pass, then we have successfully checked that our query was returned correctly.
-    If any of the checks fail, then the query was not returned correctly, and we need to run the verifier.'''
+    If any of the checks fail, then the query was not returned correctly, and we need to run the verifier.
+    An output whose tx has no other outputs is held inline in its block tree, and its proof has no
+    outkey proof, since the hash of the output is the root of its tx. Its outkey proof is taken to
+    be the one a tree with that single leaf would give, whether it is None or left out.'''
+    hash_function = hash_backends.get(hash_backend).new
+    if len(path_proof) == 2 or path_proof[0] is None:
+        leaf = (hash_function(found_output[0]).hexdigest(), found_output[1])
+        path_proof = [[[leaf, 'SELF'], [leaf, 'ROOT']]] + list(path_proof[-2:])
     outproof, txproof, blkproof = path_proof
     leaf_hashed, _ = outproof[0]
     if (hash_function(found_output[0]).hexdigest(),found_output[1]) == leaf_hashed:
-        if check_proof(outproof):
+        if check_proof(outproof, hash_backend):
             tx_hashed, _ = txproof[0]
             outproof_merkle_root, _ = outproof[-1]
             if (hash_function(outproof_merkle_root[0]).hexdigest(),outproof_merkle_root[1])==tx_hashed:
-                if check_proof(txproof):
+                if check_proof(txproof, hash_backend):
                     blk_hashed, _ = blkproof[0]
                     txproof_merkle_root, _ = txproof[-1]
                     if (hash_function(txproof_merkle_root[0]).hexdigest(), txproof_merkle_root[1]) == blk_hashed:
-                        if check_proof(blkproof):
+                        if check_proof(blkproof, hash_backend):
                             blkproof_merkle_root,_ = blkproof[-1]
                             if blkproof_merkle_root == top_root:
                                 return True
     return False
 
+def add_next_block():
+    '''Adds the next pending block to the Merkle Tree by calling the function add_adjust, and
+    records the update in the delta log. Returns whether there was a block to add.'''
+    return add_blocks(count=1) > 0
+
+def add_blocks(count=None, until_idx=None, blocks=None):
+    '''Adds pending blocks to the Merkle Tree in bulk: count of them, or as many as it takes for
+    the top root to reach global index until_idx, or else all of them. If an iterator of blocks is
+    given, they are taken from it instead of the pending blocks. Their block and tx Merkle Trees are
+    built first, in parallel_scan if there are build_workers, and then the top Merkle Tree is extended
+    by all of them at once, so its right edge is hashed once and no intermediate roots are made. The
+    whole update is one record in the delta log. Queries go on being answered from the last snapshot
+    meanwhile, and see the new blocks once the next one is published. Returns the number of blocks
+    added.'''
+    global top_root
+    with update_lock, build_phase("update"):
+        new_blocks = []
+        last_idx = top_root[1]
+        while (count is None or len(new_blocks) < count) and (until_idx is None or last_idx < until_idx):
+            block_outkeys = next(pending_blocks if blocks is None else blocks, None)
+            if not block_outkeys:
+                break
+            new_blocks.append(block_outkeys)
+            last_idx = block_outkeys[-1][3]
+        if not new_blocks:
+            return 0
+        if build_workers > 1 and len(new_blocks) > 1:
+            block_leaves = parallel_scan(itertools.chain.from_iterable(new_blocks), build_workers)
+        else:
+            block_leaves = [block_to_merkle(block_outkeys) for block_outkeys in new_blocks]
+        prev_root = top_merkle.root_val
+        root_history.record(top_merkle)
+        del merkle_forest[prev_root]
+        with build_phase("top"):
+            if len(block_leaves) == 1:
+                top_merkle.add_adjust(block_leaves[0])
+            else:
+                top_merkle.extend(block_leaves)
+        top_root = (codecs.encode(top_merkle.root_val, 'hex_codec'), top_merkle.root_idx)
+        merkle_forest[top_merkle.root_val] = top_merkle
+        trees = [tree for block_leaf in block_leaves for tree in forest_store.block_trees(merkle_forest, block_leaf[0])]
+        for key, _ in trees:
+            # a tree that a rollback took out and that is back again stays
+            retiring.pop(key, None)
+        if delta_log:
+            with build_phase("log"):
+                delta_log.append(prev_root, trees, block_leaves, top_merkle)
+        with build_phase("publish"):
+            publish_snapshot()
+            if image_publisher:
+                image_publisher.publish(top_merkle)
+        compact_log()
+        return len(block_leaves)
+
+def rollback_blocks(height=None, until_idx=None):
+    '''Removes the last blocks from the Merkle Tree, as when the chain reorganizes: down to height
+    blocks, or to the last block whose global index is at most until_idx. The top Merkle Tree is
+    truncated, which gives exactly the root it had at that height, and the block and tx Merkle Trees
+    of the blocks that were removed are dropped from the merkle_forest. Pending blocks came after the
+    old tip, so they are dropped too, and the blocks of the new chain have to be queued again. The
+    rollback is one record in the delta log. Returns the number of blocks removed.
+    Snapshots that are in use share the nodes of the top tree that truncating it would change, so it
+    is truncated in a copy, and the trees that were removed only leave the forest once those snapshots
+    are let go.'''
+    global top_root, top_merkle, pending_blocks, forest_generation
+    with update_lock:
+        num_blocks = top_merkle.num_leaves
+        if until_idx is not None:
+            height = top_merkle.find_leaf(until_idx + 1)
+        if height is None or not 0 < height < num_blocks:
+            return 0
+        removed = [key for pos in range(height, num_blocks)
+            for key, _ in forest_store.block_trees(merkle_forest, top_merkle.leaf_key(pos))]
+        # the snapshot that queries in flight hold, which the removed trees have to outlive
+        old_snapshot = snapshot
+        prev_root = top_merkle.root_val
+        truncated, _ = FlatMerkleTree.deserialize(top_merkle.serialize())
+        truncated.truncate(height)
+        del merkle_forest[prev_root]
+        top_merkle = truncated
+        top_root = (codecs.encode(top_merkle.root_val, 'hex_codec'), top_merkle.root_idx)
+        merkle_forest[top_merkle.root_val] = top_merkle
+        pending_blocks = iter([])
+        root_history.truncate(height)
+        # queries that still hold old_snapshot may yet make entries for the blocks that were removed
+        forest_generation += 1
+        if proof_cache is not None:
+            proof_cache.clear(forest_generation)
+        if delta_log:
+            delta_log.rollback(prev_root, height, removed, top_merkle)
+        publish_snapshot()
+        retire_trees(old_snapshot, removed)
+        del old_snapshot
+        if image_publisher:
+            image_publisher.publish(top_merkle)
+        compact_log()
+        return num_blocks - height
+
+# where the ingestor keeps its high-water mark between runs
+watermark_path = "/data/ingest.watermark"
+ingestor = None
+
+class BlockIngestor(object):
+    '''Follows the out_table of a database in a background thread, and adds new blocks to the Merkle
+    Tree as they appear in it, so that the server updates itself rather than waiting for /update.
+    Each poll reads the rows above the high-water mark, which is the global index of the top root,
+    groups them into blocks and adds up to batch_size of them at once with add_blocks. Queries go on
+    being answered from the last snapshot meanwhile. The last block read may still be being written,
+    so it is only added once a later block follows it, or once it is unchanged over two polls.
+    The watermark is saved to path after every batch, together with the hash and last global index of
+    the last depth blocks. If one of them is no longer in the out_table, as when the chain reorganizes,
+    the Merkle Tree is rolled back to the last block that still is before going on.'''
+
+    def __init__(self, database_path, path=None, interval=1.0, batch_size=100, depth=64, chunk_size=None):
+        self.database_path = database_path
+        self.path = path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size or ingest_chunk_size
+        self.recent = deque(maxlen=depth)
+        self.tail = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.conn = None
+        self.blocks = self.outputs = self.batches = self.reorgs = 0
+        self.busy = self.last_batch = 0.0
+        self.head_idx = self.last_poll = self.behind_since = self.error = None
+        self.load_watermark()
+
+    def load_watermark(self):
+        '''Reads the recent blocks back from path. They only count if the watermark there is the
+        current top root, since otherwise the forest was saved at some other point.'''
+        if not self.path or not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            saved = json.load(f)
+        if top_root is not None and saved["idx"] == top_root[1]:
+            self.recent.extend((idx, str(block_hash)) for idx, block_hash in saved["recent"])
+
+    def save_watermark(self):
+        if self.path:
+            forest_store.write_atomic(self.path, json.dumps({"idx": top_root[1], "recent": list(self.recent)}))
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.database_path, check_same_thread=False)
+        return self.conn
+
+    def block_hash_at(self, idx):
+        row = self.connect().execute('''SELECT block_hash FROM out_table WHERE idx = ?''', (idx,)).fetchone()
+        return row[0] if row else None
+
+    def rows_above(self, start_idx):
+        '''Yields the rows above start_idx, fetching few of them at first, since a poll often only
+        needs a block or two, and up to chunk_size at a time after that.'''
+        c_1 = self.connect().cursor()
+        with build_phase("sqlite"):
+            c_1.execute('''SELECT block_hash, tx_hash, outkey, idx FROM out_table WHERE idx > ? ORDER BY idx''', (start_idx,))
+        size = 64
+        while True:
+            with build_phase("sqlite"):
+                fetched = c_1.fetchmany(min(size, self.chunk_size))
+            if not fetched:
+                break
+            for outkey in fetched:
+                yield outkey
+            size *= 2
+
+    def check_reorg(self):
+        '''Rolls the Merkle Tree back to the last recent block that is still in the out_table, if the
+        last one is not. Raises ValueError if none of them is.'''
+        if not self.recent:
+            # nothing was added since the watermark, so the top root is taken to be in the out_table
+            block_hash = self.block_hash_at(top_root[1]) if top_root is not None else None
+            if block_hash is not None:
+                self.recent.append((top_root[1], block_hash))
+            return
+        if self.block_hash_at(self.recent[-1][0]) == self.recent[-1][1]:
+            return
+        while self.recent and self.block_hash_at(self.recent[-1][0]) != self.recent[-1][1]:
+            self.recent.pop()
+        if not self.recent:
+            raise ValueError('The out_table has changed below the last %d blocks added.' % self.recent.maxlen)
+        rollback_blocks(until_idx=self.recent[-1][0])
+        self.reorgs += 1
+        self.tail = None
+        self.save_watermark()
+
+    def poll(self):
+        '''Adds up to batch_size blocks that are new in the out_table, and returns how many were added.'''
+        with update_lock:
+            self.last_poll = time.time()
+            self.head_idx = self.connect().execute('''SELECT MAX(idx) FROM out_table''').fetchone()[0]
+            self.check_reorg()
+            if self.head_idx is None or self.head_idx <= top_root[1]:
+                self.behind_since = None
+                return 0
+            if self.behind_since is None:
+                self.behind_since = self.last_poll
+            new_blocks = list(itertools.islice(group_blocks(self.rows_above(top_root[1])), self.batch_size + 1))
+            if len(new_blocks) <= self.batch_size:
+                last = new_blocks[-1]
+                tail, self.tail = self.tail, (last[0][0], last[-1][3])
+                if tail != self.tail:
+                    new_blocks.pop()
+            new_blocks = new_blocks[:self.batch_size]
+            if not new_blocks:
+                return 0
+            start = time.time()
+            added = add_blocks(blocks=iter(new_blocks))
+            self.last_batch = time.time() - start
+            self.busy += self.last_batch
+            self.blocks += added
+            self.outputs += sum(len(block_outkeys) for block_outkeys in new_blocks)
+            self.batches += 1
+            self.recent.extend((block_outkeys[-1][3], block_outkeys[0][0]) for block_outkeys in new_blocks)
+            if self.head_idx <= top_root[1]:
+                self.behind_since = None
+            self.save_watermark()
+            return added
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                added = self.poll()
+                self.error = None
+            except (sqlite3.Error, ValueError) as e:
+                # keep going, e.g. while the database is locked, and report it in the stats meanwhile
+                self.error = str(e)
+                added = 0
+            if not added:
+                self.stopping.wait(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="ingestor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def stats(self):
+        '''Returns how far the Merkle Tree lags behind the out_table, in outputs and in seconds since
+        the oldest row that is not in it yet was first seen, and how fast blocks have been added.'''
+        now = time.time()
+        watermark = top_root[1] if top_root is not None else None
+        return {"watermark": watermark, "head": self.head_idx,
+                "lag_outputs": max(0, self.head_idx - watermark) if self.head_idx is not None and watermark is not None else None,
+                "lag_seconds": now - self.behind_since if self.behind_since is not None else 0.0,
+                "since_poll": now - self.last_poll if self.last_poll is not None else None,
+                "blocks": self.blocks, "outputs": self.outputs, "batches": self.batches, "reorgs": self.reorgs,
+                "blocks_per_second": self.blocks / self.busy if self.busy else None,
+                "last_batch_seconds": self.last_batch, "error": self.error}
+
+def start_ingestor(database_path, **kwargs):
+    '''Starts following the out_table of database_path in the background, in place of /update.'''
+    global ingestor
+    ingestor = BlockIngestor(database_path, path=watermark_path, **kwargs)
+    ingestor.start()
+    return ingestor
+
 def update_test():
     '''Updates the Merkle Tree by calling the function add_adjust. It will return the new
     root of the new top Merkle tree. This is used by profiling function only!'''
-    if utxos:
-        del merkle_forest[top_root[0]]
-        curr_block_hash = utxos[0][0]
-        block_outkeys = []
-        while utxos[0][0] == curr_block_hash:
-            block_outkeys.append(utxos.pop(0))
-            if not utxos:
-                break
-        top_merkle.add_adjust(block_to_merkle(block_outkeys))
-        global top_root
-        top_root = (codecs.encode(top_merkle.root.val, 'hex_codec'), top_merkle.root.idx)
-        merkle_forest[codecs.encode(top_merkle.root.val, 'hex_codec')] = top_merkle
-    
+    add_next_block()
+
 @app.route("/getroot", methods = ["GET"])
 def getroot():
-    '''This function returns the root of the top merkle tree, when requested by the client.
+    '''This function returns the root of the top merkle tree, when requested by the client, with
+    the name of the hash backend that the trees are built with, which the client checks proofs with.
     Whenever the top Merkle tree structure is updated, the function is also invoked.'''
-    tr = {"root":top_root}
+    snap = current_snapshot()
+    tr = {"root":snap.top_root, "hash":snap.top_merkle.backend.name}
     return jsonify(tr)
 
+class ProofCache(object):
+    '''A bounded LRU cache of the outputs found for /getout and /getouts and their proofs, keyed by
+    global index. The output, tx and block proofs never change once a block is added, but the top proof
+    does whenever top_root does, so each entry also keeps its JSON and binary responses for the top root
+    they were made under, and only the top proof is redone once that root is stale. If lower_only is set,
+    only the lower two proofs are kept, and the top proof and the responses are made on every request.
+    Queries that run at once share the cache, so the order of its entries is kept under a lock, and the
+    responses of an entry are swapped as a whole, with the root they were made under.
+    Every entry is made under a generation of the forest, which a rebuild or a rollback moves on. A
+    query that is still answered from a snapshot of an earlier generation neither uses the entries of
+    the new one nor puts its own in among them, since they may be of blocks that are no longer there.'''
+
+    def __init__(self, size=10000, lower_only=False):
+        self.size = size
+        self.lower_only = lower_only
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = None
+        self.hits = 0
+        self.top_misses = 0
+        self.misses = 0
+
+    def lookup(self, idx, root, generation):
+        '''Returns the entry for a global index, marking it as the most recently used, or None.
+        Whether it is a full hit depends on the top root that the query is answered under.'''
+        with self.lock:
+            entry = self.entries.get(idx)
+            if entry is None or entry[6] != generation:
+                self.misses += 1
+                return None
+            del self.entries[idx]
+            self.entries[idx] = entry
+        if not self.lower_only and entry[4][0] == root:
+            self.hits += 1
+        else:
+            self.top_misses += 1
+        return entry
+
+    def insert(self, idx, entry):
+        with self.lock:
+            if self.generation is not None and entry[6] != self.generation:
+                return
+            self.entries[idx] = entry
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self, generation=None):
+        '''Empties the cache, and from then on only takes entries of the given generation, if any.'''
+        with self.lock:
+            self.entries.clear()
+            if generation is not None:
+                self.generation = generation
+
+    def stats(self):
+        return {"size": len(self.entries), "capacity": self.size, "lower_only": self.lower_only,
+                "hits": self.hits, "top_misses": self.top_misses, "misses": self.misses}
+
+# set to None to turn caching off
+proof_cache = ProofCache()
+
+class RootHistory(object):
+    '''Keeps the last few top roots, so that queries can still be answered against a root after the
+    top Merkle tree has moved on from it, such as by a client that has not called update_server yet.
+    Rather than a copy of the top tree, each root keeps the number of leaves the tree had and its
+    spine, the last node of each level, which is all FlatMerkleTree.version needs to rebuild a view of
+    the old tree over the nodes it shares with the current one, and the left siblings of the spine, which
+    tell whether the current tree still holds the old one's leaves. So each root costs O(log n).'''
+
+    def __init__(self, size=16):
+        self.size = size
+        self.versions = OrderedDict()
+
+    def record(self, tree):
+        '''Keeps the current root of the top tree, before the tree is changed.'''
+        if not self.size or tree is None or tree.root_val is None:
+            return
+        self.versions[tree.root_val] = (tree.num_leaves, tree.spine(), tree.siblings())
+        if len(self.versions) > self.size:
+            self.versions.popitem(last=False)
+
+    def truncate(self, num_leaves):
+        '''Drops the roots of trees with more than num_leaves leaves.'''
+        for root, (n, _, _) in self.versions.items():
+            if n > num_leaves:
+                del self.versions[root]
+
+    def clear(self):
+        self.versions.clear()
+
+# how many earlier top roots queries can still be answered against
+root_history = RootHistory()
+
+class ForestSnapshot(object):
+    '''An immutable view of the forest as of one top root, which the writer publishes after every
+    update. A query takes the current snapshot once and answers from it throughout, so it never sees a
+    tree halfway through an update, or a root that does not match its proofs, and it takes no lock.
+    The top tree of a snapshot is a read only version of the top Merkle Tree, which shares every node
+    but its right edge with it, so the writer goes on appending to the tree while the snapshot is in
+    use. The block and tx trees in the merkle_forest never change, so the forest is shared as it is,
+    and trees are only taken out of it once no snapshot that needs them is in use. The earlier roots
+    in root_history are copied into the snapshot as well, and so is the generation of the forest, which
+    the proof_cache entries made from the snapshot are tagged with.'''
+    __slots__ = ['tree', 'top_merkle', 'top_root', 'forest', 'versions', 'generation', '__weakref__']
+
+    def __init__(self, tree, forest, versions, generation=0):
+        self.tree = tree
+        self.top_merkle = tree.version(tree.num_leaves, tree.spine())
+        self.top_root = (codecs.encode(self.top_merkle.root_val, 'hex_codec'), self.top_merkle.root_idx)
+        self.forest = forest
+        self.versions = versions
+        self.generation = generation
+
+    def find_top(self, hex_root):
+        '''Returns the top tree with the given hex root, which is either the one of this snapshot or
+        an earlier version, or None if there is no such top tree.'''
+        if hex_root == self.top_root[0]:
+            return self.top_merkle
+        root = forest_key(str(hex_root))
+        if not root or root not in self.versions:
+            return None
+        num_leaves, spine, siblings = self.versions[root]
+        # a root any of whose blocks were rolled back is no longer in the tree, which the last leaf and
+        # the siblings of the spine tell, since they cover every leaf
+        if num_leaves > self.tree.num_leaves or self.tree.digest(0, num_leaves - 1) != spine[0][0]:
+            return None
+        widths = level_widths(num_leaves)
+        if any(self.tree.digest(level, widths[level] - 2) != digest for level, digest in siblings):
+            return None
+        return self.tree.version(num_leaves, spine)
+
+    def find_tree(self, hex_root):
+        '''Returns the tree with the given hex root, which is either in the merkle_forest or a
+        version of the top tree, or None if there is no such tree.'''
+        top = self.find_top(hex_root)
+        if top is not None:
+            return top
+        root = forest_key(str(hex_root))
+        if not root or root not in self.forest:
+            return None
+        tree = self.forest[root]
+        # the top Merkle Tree itself is only ever read through a version
+        return None if tree is self.tree else tree
+
+    def find_output(self, req_gidx, top=None):
+        '''Finds the output with the smallest global index greater than or equal to the requested index.
+        Returns the position of its block in the top tree and the block tree, the position of its tx in
+        the block tree and the tx tree, and the output and its position in the tx tree. The tx tree is
+        None if the tx has a single output, which is held inline in the block tree. The block is looked
+        up in the top tree given, or else the one of the snapshot.'''
+        found_block, blk_idx = find_ge(top if top is not None else self.top_merkle, req_gidx)
+        block_merkle = self.forest[found_block[0]]
+        found_tx, tx_idx = find_ge(block_merkle, req_gidx)
+        inline = block_merkle.leaf_inline(tx_idx)
+        if inline is not None:
+            return blk_idx, block_merkle, tx_idx, None, (inline, found_tx[1]), 0
+        tx_merkle = self.forest[found_tx[0]]
+        found_output, output_idx = find_ge(tx_merkle, req_gidx)
+        return blk_idx, block_merkle, tx_idx, tx_merkle, found_output, output_idx
+
+# the snapshot that queries are answered from, replaced as a whole by publish_snapshot
+snapshot = None
+# roots of trees that a rollback took out of the tree, which are kept in the merkle_forest until
+# the last snapshot that may need them is let go, unless they are added again before then
+retiring = {}
+# the writer holds this while it changes the forest; readers never take it
+update_lock = threading.RLock()
+# moved on whenever blocks that were in the forest may no longer be, by a rebuild, a load or a rollback
+forest_generation = 0
+retired_refs = set()
+
+def publish_snapshot():
+    '''Publishes a snapshot of the current forest, which new queries are answered from, and hands
+    its root to the subscribers of the root_feed. Only the writer calls this, holding update_lock.'''
+    global snapshot
+    snapshot = ForestSnapshot(top_merkle, merkle_forest, dict(root_history.versions), forest_generation)
+    root_feed.publish(snapshot)
+
+def current_snapshot():
+    '''Returns the snapshot to answer a query from. Queries never publish one themselves: only the
+    writer does, under update_lock, once the forest is built or loaded and after every update, so a
+    query can never publish a forest that is halfway through an update.'''
+    return snapshot
+
+def retire_trees(old_snapshot, keys):
+    '''Takes trees out of the merkle_forest once no query holds old_snapshot any more, which in
+    CPython is as soon as the last one that does returns.'''
+    forest, token = old_snapshot.forest, object()
+    for key in keys:
+        retiring[key] = token
+    def release(ref):
+        with update_lock:
+            retired_refs.discard(ref)
+            for key in keys:
+                if retiring.get(key) is token:
+                    del retiring[key]
+                    if key in forest:
+                        del forest[key]
+    retired_refs.add(weakref.ref(old_snapshot, release))
+
+class RootFeed(object):
+    '''Hands every new top root to the clients that subscribe to /subscribe, so that they do not have
+    to poll /getroot. Each root that is published becomes an event, with the number of blocks in the
+    top tree, the time it was published and a sequence number, and a subscriber waits for the first
+    event after the last one it saw. Each subscriber blocks on an Event of its own without a timeout,
+    which costs nothing while it waits, since a timed wait polls in Python 2. Instead, its deadline
+    goes on a heap, and a ticker thread, which runs only while anyone waits, checks every tick seconds
+    for deadlines that have passed and sets the Events of just those subscribers. A subscriber that leaves before its deadline marks its
+    entry as spent, and spent entries are dropped once they are half of the heap. A stream sends a
+    keepalive every heartbeat seconds.'''
+
+    def __init__(self, heartbeat=15.0, tick=1.0):
+        self.heartbeat = heartbeat
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.root = None
+        self.event = None
+        self.seq = 0
+        # [deadline, Event], with the Event set to None once its subscriber has left
+        self.deadlines = []
+        self.waiters = set()
+        self.spent = 0
+        self.ticker = None
+
+    def publish(self, snap):
+        '''Makes the root of a snapshot the latest event, unless it already is. The event is kept as
+        its sequence number and its JSON, which is encoded once for every subscriber.'''
+        with self.lock:
+            if snap.top_root == self.root:
+                return
+            self.root = snap.top_root
+            self.seq += 1
+            self.event = (self.seq, json.dumps({"root": snap.top_root, "blocks": snap.top_merkle.num_leaves,
+                                                "published": time.time(), "seq": self.seq}))
+            for waiter in self.waiters:
+                waiter.set()
+
+    def run_ticker(self):
+        while True:
+            time.sleep(self.tick)
+            if not self.expire(time.time()):
+                return
+
+    def expire(self, now):
+        '''Wakes the subscribers whose deadlines are before now, and drops the spent entries. Returns
+        whether any subscribers are left, and if not, lets the ticker go, to be started again by the
+        next subscriber.'''
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                entry = heapq.heappop(self.deadlines)
+                if entry[1] is None:
+                    self.spent -= 1
+                else:
+                    entry[1].set()
+            if not self.waiters:
+                self.ticker = None
+            return self.ticker is not None
+
+    def wait(self, after, timeout):
+        '''Returns the latest event as soon as it is not the one numbered after, or None if that
+        takes longer than timeout seconds, to within a tick. So a subscriber that saw a later number
+        than the latest, from before the server restarted, is given the latest event at once.'''
+        deadline = time.time() + timeout
+        waiter = threading.Event()
+        entry = [deadline, waiter]
+        with self.lock:
+            if self.event is not None and self.event[0] != after:
+                return self.event
+            if self.ticker is None:
+                self.ticker = threading.Thread(target=self.run_ticker, name="ticker")
+                self.ticker.daemon = True
+                self.ticker.start()
+            heapq.heappush(self.deadlines, entry)
+            self.waiters.add(waiter)
+        try:
+            while True:
+                waiter.wait()
+                with self.lock:
+                    waiter.clear()
+                    if self.event is not None and self.event[0] != after:
+                        return self.event
+                    if time.time() >= deadline:
+                        return None
+        finally:
+            with self.lock:
+                self.waiters.discard(waiter)
+                if entry[1] is not None:
+                    entry[1] = None
+                    self.spent += 1
+                    if self.spent * 2 > len(self.deadlines):
+                        self.deadlines = [e for e in self.deadlines if e[1] is not None]
+                        heapq.heapify(self.deadlines)
+                        self.spent = 0
+
+root_feed = RootFeed()
+
+# the most levels that /getsubtree returns at once, which is up to 2**max_subtree_depth hashes
+max_subtree_depth = 10
+
+def output_entry(req_gidx, snap):
+    '''Finds the output with the smallest global index greater than or equal to the requested index,
+    and returns its proof cache entry. An entry holds the output, the raw output and tx chains, the
+    position of the block in the top tree, and the top root that its JSON and binary responses were made
+    under, together with them. The responses are dropped once the top root has moved on. The output chain
+    is None for an output whose tx is held inline in its block tree. The entry also keeps the root of
+    the block and the generation of the forest it was made under, and is only used while that block
+    is still the one at its position in the top tree, which a pre-forked reader, whose image the writer
+    may have rolled back, relies on.'''
+    entry = proof_cache.lookup(req_gidx, snap.top_root[0], snap.generation) if proof_cache is not None else None
+    top = snap.top_merkle
+    if entry is None or entry[3] >= top.num_leaves or top.leaf_key(entry[3]) != entry[5]:
+        blk_idx, block_merkle, tx_idx, tx_merkle, found_output, output_idx = snap.find_output(req_gidx)
+        tx_proof = block_merkle._get_proof(tx_idx)
+        out_proof = tx_merkle._get_proof(output_idx) if tx_merkle is not None else None
+
+        entry = [found_output, out_proof, tx_proof, blk_idx, (snap.top_root[0], None, None),
+            top.leaf_key(blk_idx), snap.generation]
+        if proof_cache is not None:
+            proof_cache.insert(req_gidx, entry)
+    return entry
+
+def output_response(req_gidx, snap, binary=False, top=None):
+    '''Returns the output found for the requested index together with its proofs, serialized as a
+    {"found", "proof", "inline"} JSON object, or in the binary format of proof_wire. The proof of an output
+    whose tx is held inline has no output chain, so it is made of the tx and block chains only, and
+    "inline" is set. In the binary format, its tx layer has no siblings. If an earlier
+    version of the top tree is given, the block chain proves the output against its root instead. The
+    block is at the same position in every version, so the output and tx chains come from the cache
+    all the same, but such a response is not kept.'''
+    entry = output_entry(req_gidx, snap)
+    slot = 2 if binary else 1
+    if top is not None and top is not snap.top_merkle:
+        chains = (entry[1], entry[2], top._get_proof(entry[3]))
+        if binary:
+            return proof_wire.encode_path(entry[0], chains)
+        return json.dumps({"found":entry[0], "proof":[hex_chain(chain) for chain in chains if chain is not None],
+            "inline":entry[1] is None})
+    responses = entry[4]
+    if responses[0] != snap.top_root[0]:
+        responses = (snap.top_root[0], None, None)
+    if responses[slot] is not None:
+        return responses[slot]
+    chains = (entry[1], entry[2], snap.top_merkle._get_proof(entry[3]))
+    if binary:
+        response = proof_wire.encode_path(entry[0], chains)
+    else:
+        # an inline output is proven by the tx and block chains alone, which "inline" says
+        response = json.dumps({"found":entry[0], "proof":[hex_chain(chain) for chain in chains if chain is not None],
+            "inline":entry[1] is None})
+    if proof_cache is not None and not proof_cache.lower_only:
+        entry[4] = responses[:slot] + (response,) + responses[slot + 1:]
+    return response
+
+def wants_binary(t):
+    '''Whether the client asked for the binary format, by a "binary" flag or the Accept header.'''
+    return bool(t.get("binary")) or request.accept_mimetypes.best == proof_wire.MIMETYPE
+
 @app.route("/getout", methods = ["GET"])
 def getoutput():
     '''This function will return the output and proof associated with the requested index.
@@ -175,102 +956,482 @@ def getoutput():
     requested index. Next, it will find the transaction with the smallest global index greater 
     than the requested index. Afterwards, we will find the index, and return the data. To make sure
     we did this step correctly, we also keep track of the Merkle proofs along the way, and return
-    them to the client as a tuple for them to check'''
+    them to the client as a tuple for them to check. If a "root" is given, the proof is made against
+    that top root, which can be any of the recent ones kept in root_history.'''
     t = request.get_json()
     req_gidx = t["idx"]
-    if req_gidx < 0 or req_gidx > top_root[1]:
+    snap = current_snapshot()
+    top = snap.find_top(t["root"]) if "root" in t else snap.top_merkle
+    if top is None or req_gidx < 0 or req_gidx > top.root_idx:
     	return jsonify({"Failure": 0})
+    elif wants_binary(t):
+	    return app.response_class(output_response(req_gidx, snap, binary=True, top=top), mimetype=proof_wire.MIMETYPE)
     else:
-	    found_block, blk_idx = find_ge([(leaf.data, leaf.idx) for leaf in top_merkle.leaves], req_gidx)
-	    blk_proof = top_merkle.get_proof(blk_idx)
-	    block_merkle = merkle_forest[found_block[0]]
-
-	    found_tx, tx_idx = find_ge([(leaf.data,leaf.idx) for leaf in block_merkle.leaves], req_gidx)
-	    tx_proof = block_merkle.get_proof(tx_idx)
-	    tx_merkle = merkle_forest[found_tx[0]]
+	    return app.response_class(output_response(req_gidx, snap, top=top), mimetype="application/json")
 
-	    found_output, output_idx = find_ge([(leaf.data,leaf.idx) for leaf in tx_merkle.leaves], req_gidx)
-	    out_proof = tx_merkle.get_proof(output_idx)
-
-	    path_proof = (out_proof,tx_proof,blk_proof)
-	    return jsonify({"found":found_output, "proof":path_proof})
+def multiproof(req_gidxs, snap):
+    '''Finds the outputs for a number of requested indices, and proves all of them at once. Rather
+    than a proof for each output, every tx, block and top tree that is involved appears once, with
+    the nodes that its leaves need on their way to its root. So the hashes that the paths of several
+    outputs share, such as those near the top root, are sent and checked once. Outputs refer to
+    their tx tree and their position in it, tx trees to their block tree and position, and block
+    trees to their position in the top tree.'''
+    blocks, txs, outputs = OrderedDict(), OrderedDict(), []
+    for req_gidx in req_gidxs:
+        blk_idx, block_merkle, tx_idx, tx_merkle, found_output, output_idx = snap.find_output(req_gidx)
+        if blk_idx not in blocks:
+            blocks[blk_idx] = (len(blocks), block_merkle, set())
+        blocks[blk_idx][2].add(tx_idx)
+        if (blk_idx, tx_idx) not in txs:
+            txs[(blk_idx, tx_idx)] = (len(txs), tx_merkle, set())
+        txs[(blk_idx, tx_idx)][2].add(output_idx)
+        outputs.append((found_output, txs[(blk_idx, tx_idx)][0], output_idx))
+    return {"root": snap.top_root,
+        "top": {"n": snap.top_merkle.num_leaves, "nodes": snap.top_merkle.get_multiproof(blocks.keys())},
+        "blocks": [{"pos": blk_idx, "n": block_merkle.num_leaves, "nodes": block_merkle.get_multiproof(positions)}
+            for blk_idx, (_, block_merkle, positions) in blocks.items()],
+        "txs": [{"block": blocks[blk_idx][0], "pos": tx_idx, "n": tx_merkle.num_leaves if tx_merkle else 1,
+            "nodes": tx_merkle.get_multiproof(positions) if tx_merkle else []}
+            for (blk_idx, tx_idx), (_, tx_merkle, positions) in txs.items()],
+        "outputs": outputs}
 
 @app.route("/getouts", methods = ["GET"])
 def getoutputs():
-    '''Similar to get output, but retreives multiple outputs with one request'''
+    '''Similar to get output, but retreives multiple outputs with one request. If "multiproof" is
+    set in the request, the outputs are proven together by a single multiproof instead.'''
     t = request.get_json()
     req_gidxs = t["idx"]
+    snap = current_snapshot()
+    if any(req_gidx < 0 or req_gidx > snap.top_root[1] for req_gidx in req_gidxs):
+        return jsonify({"Failure": 0})
+    if t.get("multiproof"):
+        return app.response_class(json.dumps(multiproof(req_gidxs, snap)), mimetype="application/json")
+    if wants_binary(t):
+        paths = [output_response(req_gidx, snap, binary=True) for req_gidx in req_gidxs]
+        return app.response_class(proof_wire.encode_paths(paths), mimetype=proof_wire.MIMETYPE)
     query_results = []
     for req_gidx in req_gidxs:
-        if req_gidx < 0 or req_gidx > top_root[1]:
-            return jsonify({"Failure": 0})
-        else:
-            found_block, blk_idx = find_ge([(leaf.data, leaf.idx) for leaf in top_merkle.leaves], req_gidx)
-            blk_proof = top_merkle.get_proof(blk_idx)
-            block_merkle = merkle_forest[found_block[0]]
+        query_results.append(output_response(req_gidx, snap))
+    return app.response_class('{"results": [%s]}' % ", ".join(query_results), mimetype="application/json")
 
-            found_tx, tx_idx = find_ge([(leaf.data,leaf.idx) for leaf in block_merkle.leaves], req_gidx)
-            tx_proof = block_merkle.get_proof(tx_idx)
-            tx_merkle = merkle_forest[found_tx[0]]
+# the longest a /subscribe long poll is held open for, in seconds
+max_subscribe_timeout = 60
 
-            found_output, output_idx = find_ge([(leaf.data,leaf.idx) for leaf in tx_merkle.leaves], req_gidx)
-            out_proof = tx_merkle.get_proof(output_idx)
+@app.route("/subscribe", methods = ["GET"])
+def subscribe():
+    '''Returns the first top root published after the one with the sequence number "after", with
+    the number of blocks in the top tree, the time it was published and its own sequence number, so
+    a client learns of new roots without polling /getroot. A long poll waits "timeout" seconds for
+    one, and then returns the latest root again, or nothing, with status 204, if no root has been
+    published yet. With an Accept header of
+    text/event-stream, every new root is streamed as a server-sent event instead, with a keepalive
+    comment in between, and "after" can be given as a Last-Event-ID header. The arguments can also
+    be given in the query string.'''
+    t = request.get_json(silent=True) or request.args
+    after = int(request.headers.get("Last-Event-ID", t.get("after", 0)))
+    if request.accept_mimetypes.best == "text/event-stream":
+        def stream(after):
+            while True:
+                event = root_feed.wait(after, root_feed.heartbeat)
+                if event is None:
+                    yield ": keepalive\n\n"
+                    continue
+                after = event[0]
+                yield "id: %d\ndata: %s\n\n" % event
+        return app.response_class(stream(after), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+    timeout = min(float(t.get("timeout", 30)), max_subscribe_timeout)
+    event = root_feed.wait(after, timeout) or root_feed.event
+    if event is None:
+        return app.response_class(status=204)
+    return app.response_class(event[1], mimetype="application/json")
 
-            path_proof = (out_proof,tx_proof,blk_proof)
-            query_results.append({"found":found_output, "proof":path_proof})
-    return jsonify(results=query_results)
+@app.route("/cachestats", methods = ["GET"])
+def cachestats():
+    '''Returns the size and hit counters of the proof cache.'''
+    if proof_cache is None:
+        return jsonify({"Failure": 0})
+    return jsonify(proof_cache.stats())
 
 @app.route("/getchildren", methods = ["GET"])
 def getchildren():
     '''Calls the get children Merkle Tree function. If there is no "root" argument passed in,
-    we will get the children of the top root.'''
+    we will get the children of the top root. The root can also be one of the earlier top roots.'''
     t = request.get_json()
-    if "root" in t:
-        root = str(t["root"])
-    else:
-        root = top_root[0]
+    snap = current_snapshot()
+    tree = snap.find_tree(t["root"]) if "root" in t else snap.top_merkle
+    if tree is None:
+        return jsonify({"Failure": 0})
     path = t["path"]
-    data = fetch_children_hash(merkle_forest[root], path=path)
+    data = fetch_children_hash(tree, path=path)
+    if wants_binary(t):
+        return app.response_class(proof_wire.encode_children(data, keyed=tree.keyed), mimetype=proof_wire.MIMETYPE)
     return jsonify({"data": data})
 
+@app.route("/getsubtree", methods = ["GET"])
+def getsubtree():
+    '''Returns the hashes of a node and of its descendants, down to "depth" levels below it, so
+    that a client can compare several levels of two trees in one round trip. The node is given by
+    its (level, pos) handle in the tree with the given "root", or in the top tree, and defaults to
+    the root. The height of the tree comes back too, so the client can work out handles.'''
+    t = request.get_json()
+    snap = current_snapshot()
+    tree = snap.find_tree(t["root"]) if "root" in t else snap.top_merkle
+    if tree is None:
+        return jsonify({"Failure": 0})
+    level, pos = t.get("node", (tree.height - 1, 0))
+    depth = min(t.get("depth", 1), max_subtree_depth)
+    if not (0 <= level < tree.height and 0 <= pos < len(tree.idxs[level]) and depth >= 0):
+        return jsonify({"Failure": 0})
+    rows, data = tree.get_subtree(level, pos, depth)
+    return jsonify({"height": tree.height, "levels": rows, "data": data})
+
 @app.route("/getnumleaves", methods = ["GET"])
 def getleaves():
-    '''Returns the number of leaves in a given root. If the root is invalid, we will return a failure.'''
+    '''Returns the number of leaves in a given root. If the root is invalid, we will return a failure.
+    A tx held inline in a block tree is only found if the root of that "block" is given as well.'''
     t = request.get_json()
-    root = str(t["root"])
-    if root in merkle_forest:
-        data = get_num_leaves(merkle_forest[root])
-        return jsonify({"data": data})
-    else:
-        return jsonify({"Failure": 0})
+    snap = current_snapshot()
+    tree = snap.find_tree(t["root"])
+    if tree is not None:
+        return jsonify({"data": get_num_leaves(tree)})
+    root = forest_key(str(t["root"]))
+    block_merkle = snap.find_tree(t.get("block", ""))
+    if block_merkle is not None:
+        # a tx with a single output has no tree of its own, but its block knows it
+        for pos in (block_merkle.inline or ()):
+            if block_merkle.leaf_key(pos) == root:
+                return jsonify({"data": 1})
+    return jsonify({"Failure": 0})
 
 @app.route("/update", methods = ["POST"])
 def update_merkle():
     '''Updates the Merkle Tree by calling the function add_adjust. It will return the new
     root of the new top Merkle tree.'''
-    if utxos:
-        del merkle_forest[top_root[0]]
-        curr_block_hash = utxos[0][0]
-        block_outkeys = []
-        while utxos[0][0] == curr_block_hash:
-            block_outkeys.append(utxos.pop(0))
-            if not utxos:
-                break
-        top_merkle.add_adjust(block_to_merkle(block_outkeys))
-        global top_root
-        top_root = (codecs.encode(top_merkle.root.val, 'hex_codec'), top_merkle.root.idx)
-        merkle_forest[codecs.encode(top_merkle.root.val, 'hex_codec')] = top_merkle
+    if add_next_block():
         return getroot()
     else:
         return jsonify({"Failure": 0})
 
+@app.route("/extend", methods = ["POST"])
+def extend_merkle():
+    '''Adds many blocks to the Merkle Tree in one call, and returns the new root. The request
+    can give a "count" of blocks to add, or an "idx" for the top root to reach, and otherwise
+    every pending block is added.'''
+    t = request.get_json(silent=True) or {}
+    if add_blocks(count=t.get("count"), until_idx=t.get("idx")):
+        return getroot()
+    else:
+        return jsonify({"Failure": 0})
+
+@app.route("/rollback", methods = ["POST"])
+def rollback_merkle():
+    '''Rolls the Merkle Tree back to a given "height" in blocks, or to the last block at or below
+    the global index "idx", and returns the new root.'''
+    t = request.get_json(silent=True) or {}
+    if rollback_blocks(height=t.get("height"), until_idx=t.get("idx")):
+        return getroot()
+    else:
+        return jsonify({"Failure": 0})
+
+@app.route("/buildprofile", methods = ["GET"])
+def buildprofile():
+    '''Returns the phases that building and updating the forest have taken so far, if it is profiled.'''
+    if build_profiler is None:
+        return jsonify({"Failure": 0})
+    return jsonify(build_profiler.report(hash=hash_backend, workers=build_workers))
+
+@app.route("/ingeststats", methods = ["GET"])
+def ingeststats():
+    '''Returns the lag and throughput of the background ingestor.'''
+    if ingestor is None:
+        return jsonify({"Failure": 0})
+    return jsonify(ingestor.stats())
+
+class RequestMetrics(object):
+    '''Counts the requests to each route and how long they took, for /metrics. Each latency goes into
+    a histogram of fixed buckets for its route, so recording one is a bisect and a few additions under
+    a lock, however many requests there have been. The size of the forest takes a pass over every tree,
+    so it is worked out again only once the top root has moved on, and at most every forest_interval
+    seconds.'''
+
+    # upper bounds of the latency buckets, in seconds, with one more bucket for anything slower
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, forest_interval=60.0):
+        self.forest_interval = forest_interval
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.started = time.time()
+        self.forest = None
+
+    def record(self, route, seconds, error=False):
+        with self.lock:
+            entry = self.routes.get(route)
+            if entry is None:
+                # the count, the errors, the total seconds and the count in each bucket
+                entry = self.routes[route] = [0, 0, 0.0, [0] * (len(self.buckets) + 1)]
+            entry[0] += 1
+            entry[1] += error
+            entry[2] += seconds
+            entry[3][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def forest_size(self, snap):
+        '''Returns the number of trees in the forest of a snapshot, their nodes and their bytes.'''
+        cached, now = self.forest, time.time()
+        if cached is None or (cached[0] != snap.top_root and now - cached[1] >= self.forest_interval):
+            cached = self.forest = (snap.top_root, now, forest_store.forest_size(snap.forest))
+        return cached[2]
+
+    def collect(self):
+        '''Returns every metric, as a dict. The buckets of each route are cumulative, as in Prometheus.'''
+        snap = current_snapshot()
+        trees, nodes, nbytes = self.forest_size(snap)
+        routes = {}
+        with self.lock:
+            for route, (count, errors, total, counts) in self.routes.items():
+                routes[route] = {"count": count, "errors": errors, "sum": total,
+                                 "buckets": [sum(counts[:i + 1]) for i in range(len(counts))]}
+        backend = snap.top_merkle.backend
+        lag = ingestor.stats() if ingestor is not None else {}
+        return {"uptime_seconds": time.time() - self.started, "routes": routes, "buckets": self.buckets,
+                "hash": backend.name, "hashes": backend.hashed,
+                "forest": {"trees": trees, "nodes": nodes, "bytes": nbytes},
+                "top_idx": snap.top_root[1], "top_blocks": snap.top_merkle.num_leaves,
+                "proof_cache": proof_cache.stats() if proof_cache is not None else None,
+                "ingest_lag_outputs": lag.get("lag_outputs"), "ingest_lag_seconds": lag.get("lag_seconds")}
+
+# set to None to turn request metrics off
+request_metrics = RequestMetrics()
+
+@app.before_request
+def start_request_timer():
+    '''Keeps the time the request started in its WSGI environ. The request context is looked up once,
+    rather than going through the request and g proxies, which cost a few microseconds a lookup.'''
+    if request_metrics is not None:
+        _request_ctx_stack.top.request.environ["monero_ads.request_start"] = time.time()
+
+@app.teardown_request
+def record_request(exc):
+    '''Records the latency of every request that matched a route, and whether it raised.'''
+    metrics = request_metrics
+    if metrics is None:
+        return
+    req = _request_ctx_stack.top.request
+    start = req.environ.get("monero_ads.request_start")
+    if start is not None and req.url_rule is not None:
+        metrics.record(req.url_rule.rule, time.time() - start, exc is not None)
+
+def prometheus_text(metrics):
+    '''Formats the metrics collected by RequestMetrics in the Prometheus text format.'''
+    lines = []
+    def metric(name, kind, help_text, samples):
+        lines.append("# HELP monero_ads_%s %s" % (name, help_text))
+        lines.append("# TYPE monero_ads_%s %s" % (name, kind))
+        for suffix, labels, value in samples:
+            label_text = ",".join('%s="%s"' % label for label in labels)
+            value = repr(value) if isinstance(value, float) else str(value)
+            lines.append("monero_ads_%s%s%s %s" % (name, suffix, "{%s}" % label_text if label_text else "", value))
+    routes = sorted(metrics["routes"].items())
+    bounds = [repr(bound) for bound in metrics["buckets"]] + ["+Inf"]
+    metric("request_seconds", "histogram", "Time taken to answer requests, by route.",
+           [("_bucket", (("route", route), ("le", le)), count) for route, r in routes for le, count in zip(bounds, r["buckets"])] +
+           [(suffix, (("route", route),), r[key]) for route, r in routes for suffix, key in (("_sum", "sum"), ("_count", "count"))])
+    metric("request_errors_total", "counter", "Requests that raised an error, by route.",
+           [("", (("route", route),), r["errors"]) for route, r in routes])
+    metric("hashes_total", "counter", "Hashes computed building and updating trees in this process.",
+           [("", (("hash", metrics["hash"]),), metrics["hashes"])])
+    forest = metrics["forest"]
+    metric("forest_trees", "gauge", "Trees in the merkle_forest.", [("", (), forest["trees"])])
+    metric("forest_nodes", "gauge", "Nodes in the trees of the merkle_forest.", [("", (), forest["nodes"])])
+    metric("forest_bytes", "gauge", "Bytes held by the trees of the merkle_forest.", [("", (), forest["bytes"])])
+    metric("top_idx", "gauge", "Greatest global index in the top Merkle tree.", [("", (), metrics["top_idx"])])
+    metric("top_blocks", "gauge", "Blocks in the top Merkle tree.", [("", (), metrics["top_blocks"])])
+    cache = metrics["proof_cache"]
+    if cache is not None:
+        metric("proof_cache_lookups_total", "counter", "Proof cache lookups, by result.",
+               [("", (("result", result),), cache[result]) for result in ("hits", "top_misses", "misses")])
+        metric("proof_cache_entries", "gauge", "Entries in the proof cache.", [("", (), cache["size"])])
+    if metrics["ingest_lag_outputs"] is not None:
+        metric("ingest_lag_outputs", "gauge", "Outputs in the out_table not yet in the tree.", [("", (), metrics["ingest_lag_outputs"])])
+    if metrics["ingest_lag_seconds"] is not None:
+        metric("ingest_lag_seconds", "gauge", "Seconds since the oldest output not yet in the tree was seen.", [("", (), metrics["ingest_lag_seconds"])])
+    return "\n".join(lines) + "\n"
+
+@app.route("/metrics", methods = ["GET"])
+def metrics():
+    '''Returns request counts and latency histograms per route, the hashes computed, the proof cache
+    counters, the size of the forest, the top index and the lag of the ingestor, in the Prometheus text
+    format, or as JSON if that is what the client accepts.'''
+    if request_metrics is None:
+        return jsonify({"Failure": 0})
+    collected = request_metrics.collect()
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(collected)
+    return app.response_class(prometheus_text(collected), mimetype="text/plain; version=0.0.4")
+
+def save_snapshot():
+    '''Writes the whole forest to snapshot_path, and starts a new delta log that every update
+    is recorded in from then on. The forest is then served from the new snapshot, so the trees
+    that were held in memory since the last one are let go, and a new snapshot is published.'''
+    global delta_log, merkle_forest
+    with update_lock:
+        forest_store.write_snapshot(snapshot_path, merkle_forest, top_merkle)
+        if delta_log:
+            delta_log.close()
+        delta_log = forest_store.DeltaLog(delta_log_path, truncate=True)
+        # the old forest is not closed, since snapshots that are still in use may map its trees
+        image = forest_store.ForestImage(snapshot_path)
+        image[top_merkle.root_val] = top_merkle
+        for key in retiring:
+            if key in image:
+                del image[key]
+        merkle_forest = image
+        publish_snapshot()
+        if image_publisher:
+            image_publisher.publish(top_merkle)
+
+def compact_log():
+    '''Saves a new snapshot, which starts the delta log again, once the log holds compact_log_records
+    records or compact_log_bytes bytes, so that a restart never replays more than that. The writer
+    holds update_lock. Returns whether it did.'''
+    if delta_log is None or (delta_log.records < compact_log_records and delta_log.size < compact_log_bytes):
+        return False
+    with build_phase("compact"):
+        save_snapshot()
+    return True
+
+def shut_down():
+    '''Stops the ingestor, and folds whatever is in the delta log into a new snapshot, so that the
+    next start replays nothing. Readers never write, so they leave the files alone.'''
+    global delta_log
+    if shared_image is not None:
+        return
+    if ingestor is not None:
+        ingestor.stop()
+    with update_lock:
+        if delta_log is None:
+            return
+        if delta_log.records:
+            save_snapshot()
+        delta_log.close()
+        delta_log = None
+
+def load_snapshot(verify=False):
+    '''Maps the forest from snapshot_path instead of building it, and replays the updates in
+    the delta log on top of it. Only the top Merkle tree and the log are read in, so this
+    takes time in proportion to the log, not the chain.'''
+    global merkle_forest, top_merkle, top_root, delta_log, forest_generation
+    with update_lock:
+        merkle_forest, top_merkle = forest_store.load_forest(snapshot_path, verify=verify)
+        if top_merkle.backend.name != hash_backend:
+            raise forest_store.SnapshotError('The snapshot was built with %s, not %s.' % (top_merkle.backend.name, hash_backend))
+        replayed = forest_store.replay_log(delta_log_path, merkle_forest, top_merkle)
+        top_root = (codecs.encode(top_merkle.root_val, 'hex_codec'), top_merkle.root_idx)
+        delta_log = forest_store.DeltaLog(delta_log_path, records=replayed)
+        forest_generation += 1
+        if proof_cache is not None:
+            proof_cache.clear(forest_generation)
+        root_history.clear()
+        retiring.clear()
+        publish_snapshot()
+
+@app.before_request
+def refresh_shared_image():
+    '''In a pre-forked reader, switches to the newest forest image before each request, and
+    hands updates on to the writer, since readers never change the forest themselves.'''
+    if shared_image is None:
+        return None
+    if request.path in ("/update", "/extend", "/rollback"):
+        r = requests.post(writer_url+request.path, data=request.get_data(), headers={"Content-Type": request.content_type})
+        return app.response_class(r.content, status=r.status_code, mimetype="application/json")
+    switch_image()
+
+def switch_image():
+    '''Switches a reader to the newest forest image, and publishes a snapshot of it if it is new. A
+    reader serves one request at a time, so it is the writer of its own view of the image.'''
+    global merkle_forest, top_merkle, top_root
+    with update_lock:
+        # a reader only keeps the roots of the generations it has served
+        last_merkle = top_merkle
+        merkle_forest, top_merkle = shared_image.refresh()
+        if last_merkle is top_merkle:
+            return
+        if last_merkle is not None:
+            root_history.record(last_merkle)
+        top_root = (codecs.encode(top_merkle.root_val, 'hex_codec'), top_merkle.root_idx)
+        publish_snapshot()
+
+def become_reader():
+    '''Turns this process into a reader of the forest image published by the writer. The forest it
+    inherited is dropped, so the reader only holds the pages it maps.'''
+    global shared_image, merkle_forest, top_merkle, image_publisher, delta_log
+    merkle_forest, top_merkle, image_publisher, delta_log = {}, None, None, None
+    shared_image = forest_store.SharedImage(snapshot_path, delta_log_path)
+    switch_image()
+
+def serve_prefork(host="127.0.0.1", port=5000, workers=4, writer_port=5001):
+    '''Serves queries from a number of forked reader processes that share one listening socket
+    and one memory mapped forest image, so reads are spread over every core. This process is the
+    writer: it applies updates on writer_port, and publishes each new image for the readers to
+    switch to. The forest has to be built or loaded, and a snapshot saved, beforehand.'''
+    global image_publisher, writer_url
+    from werkzeug.serving import make_server
+    image_publisher = forest_store.ImagePublisher(snapshot_path, delta_log_path)
+    image_publisher.publish(top_merkle)
+    writer_url = "http://127.0.0.1:%d" % writer_port
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            become_reader()
+            make_server(host, port, app, fd=listener.fileno()).serve_forever()
+            os._exit(0)
+        pids.append(pid)
+    listener.close()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        make_server("127.0.0.1", writer_port, app).serve_forever()
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
 def main():
-    read_in_blocks("rct_output_10_23_2017")
-    scan_over_new_blocks(utxos)
-    read_in_blocks("rct_output_11_05_2017")
+    global build_profiler
+    if "profile" in sys.argv[1:]:
+        build_profiler = build_profile.BuildProfiler(label="build", profile_dir=build_profile_dir).start()
+    if os.path.isfile(snapshot_path):
+        load_snapshot()
+    else:
+        scan_over_new_blocks(stream_outkeys("rct_output_10_23_2017"))
+        save_snapshot()
+    if build_profiler is not None:
+        report = build_profiler.report(hash=hash_backend, workers=build_workers)
+        forest_store.write_atomic(build_profile_path, json.dumps(report, indent=2, sort_keys=True))
+        print "\n".join(build_profile.format_report(report))
+        # go on profiling the updates, which /buildprofile reports, but without tracing memory
+        build_profiler.stop()
+        build_profiler = build_profile.BuildProfiler(label="update", trace_memory=False).start()
+    queue_new_blocks(stream_outkeys("rct_output_11_05_2017", start_idx=top_root[1]))
 
 if __name__ == '__main__':
     main()
-    # Run on localhost
-    app.run() # use this for testing
-    # app.run(host='0.0.0.0')
+    # a SIGTERM is a clean shutdown too, so that the delta log is compacted on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if "ingest" in sys.argv[1:]:
+            # follow the out_table rather than waiting for /update
+            start_ingestor("/data/rct_output_11_05_2017.db")
+        if len(sys.argv) > 2 and sys.argv[1] == "prefork":
+            # serve reads from a number of forked readers, e.g. one per core
+            serve_prefork(workers=int(sys.argv[2]))
+        # Run on localhost
+        app.run(threaded=True) # use this for testing
+        # app.run(host='0.0.0.0')
+    finally:
+        shut_down()
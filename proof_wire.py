@@ -0,0 +1,169 @@
+'''A compact binary encoding of the proofs that the server sends, used instead of JSON when the
+client asks for it with an Accept header of MIMETYPE or a "binary" flag in the request.
+
+Digests are sent as raw 32 bytes instead of hex, and integers as unsigned LEB128 varints.
+The output, tx and block chains of a proof are flattened into one chain, which leaves out the
+roots of the lower trees, since the client has to recompute them anyway:
+
+    output:  varint length, data, varint idx
+    layers:  for the tx, block and top tree in turn, varint number of siblings, varint root idx
+    sides:   varint, with bit i set if sibling i of the flattened chain is a left sibling
+    digests: the raw siblings of the flattened chain, from the output up to the top root
+
+A batch of proofs is a varint count followed by the proofs. Decoding keeps references into the
+buffer it was given instead of copying the digests out of it.
+'''
+from merkle import DIGEST_SIZE
+import codecs
+
+MIMETYPE = 'application/octet-stream'
+
+def encode_varint(n):
+    '''Encodes a non-negative integer as an unsigned LEB128 varint.'''
+    if n < 0:
+        raise ValueError('Cannot encode a negative varint: %d' % n)
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def decode_varint(buf, offset=0):
+    '''Decodes the varint at offset, and returns it with the offset just past it.'''
+    n = shift = 0
+    while True:
+        byte = ord(buf[offset])
+        offset += 1
+        n |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return n, offset
+        shift += 7
+
+def encode_bytes(data):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return encode_varint(len(data)) + data
+
+def decode_bytes(buf, offset=0):
+    length, offset = decode_varint(buf, offset)
+    if offset + length > len(buf):
+        raise ValueError('The buffer ends inside a field.')
+    return buf[offset:offset + length], offset + length
+
+def encode_path(found_output, chains):
+    '''Encodes an output and the raw chains that prove it, as returned by _get_proof on the
+    tx, block and top trees in turn. The tx chain is None if the tx is held inline in its block
+    tree, which is encoded as a tx layer with no siblings.'''
+    parts = [encode_bytes(found_output[0]), encode_varint(found_output[1])]
+    sides = bit = 0
+    digests = []
+    for chain in chains:
+        if chain is None:
+            parts.append(encode_varint(0))
+            parts.append(encode_varint(found_output[1]))
+            continue
+        siblings = chain[1:-1]
+        parts.append(encode_varint(len(siblings)))
+        parts.append(encode_varint(chain[-1][0][1]))
+        for (digest, _), side in siblings:
+            if side == 'L':
+                sides |= 1 << bit
+            digests.append(digest)
+            bit += 1
+    parts.append(encode_varint(sides))
+    parts.extend(digests)
+    return b''.join(parts)
+
+class BinaryPath(object):
+    '''A decoded proof. data is the output, idx its global index, and layers holds the number of
+    siblings and the root idx of the tx, block and top tree. The siblings are read in place, from
+    offset digests of buf, through the sibling method.'''
+    __slots__ = ['buf', 'data', 'idx', 'layers', 'sides', 'digests']
+
+    def __init__(self, buf, data, idx, layers, sides, digests):
+        self.buf = buf
+        self.data = data
+        self.idx = idx
+        self.layers = layers
+        self.sides = sides
+        self.digests = digests
+
+    @property
+    def found_output(self):
+        return (self.data.tobytes(), self.idx)
+
+    def sibling(self, i):
+        '''Returns the ith sibling of the flattened chain, and whether it is a left sibling.'''
+        offset = self.digests + i * DIGEST_SIZE
+        return self.buf[offset:offset + DIGEST_SIZE], bool(self.sides >> i & 1)
+
+def decode_path(buf, offset=0):
+    '''Decodes the proof at offset of a memoryview, and returns it with the offset just past it.'''
+    data, offset = decode_bytes(buf, offset)
+    idx, offset = decode_varint(buf, offset)
+    layers = []
+    for _ in range(3):
+        num_siblings, offset = decode_varint(buf, offset)
+        root_idx, offset = decode_varint(buf, offset)
+        layers.append((num_siblings, root_idx))
+    sides, offset = decode_varint(buf, offset)
+    end = offset + sum(num_siblings for num_siblings, _ in layers) * DIGEST_SIZE
+    if end > len(buf):
+        raise ValueError('The buffer ends inside a proof.')
+    return BinaryPath(buf, data, idx, layers, sides, offset), end
+
+def encode_paths(paths):
+    '''Encodes a batch of proofs that were each encoded by encode_path.'''
+    return encode_varint(len(paths)) + b''.join(paths)
+
+def decode_paths(buf):
+    '''Decodes a batch of proofs from a string, without copying it.'''
+    buf = memoryview(buf)
+    count, offset = decode_varint(buf)
+    paths = []
+    for _ in range(count):
+        path, offset = decode_path(buf, offset)
+        paths.append(path)
+    return paths
+
+def encode_children(children, keyed=False):
+    '''Encodes what fetch_children_hash returns. A flag byte says which of the left and right
+    hashes and data are present, and whether the data is the hex root of a lower tree, which is
+    sent as a raw digest. The hashes follow as raw digests, and then the data.'''
+    lhash, rhash, ldata, rdata = children
+    flags = 0
+    parts = []
+    for bit, digest in enumerate((lhash, rhash)):
+        if digest is not None:
+            flags |= 1 << bit
+            parts.append(codecs.decode(digest, 'hex_codec'))
+    for bit, data in enumerate((ldata, rdata), 2):
+        if data is not None:
+            flags |= 1 << bit
+            parts.append(codecs.decode(data, 'hex_codec') if keyed else encode_bytes(data))
+    if keyed:
+        flags |= 1 << 4
+    return chr(flags) + b''.join(parts)
+
+def decode_children(buf):
+    '''Decodes encode_children back into (lhash, rhash, ldata, rdata), with hex hashes.'''
+    flags = ord(buf[0])
+    offset = 1
+    children = []
+    for bit in range(2):
+        if flags >> bit & 1:
+            children.append(codecs.encode(buf[offset:offset + DIGEST_SIZE], 'hex_codec'))
+            offset += DIGEST_SIZE
+        else:
+            children.append(None)
+    for bit in range(2, 4):
+        if not flags >> bit & 1:
+            children.append(None)
+        elif flags >> 4 & 1:
+            children.append(codecs.encode(buf[offset:offset + DIGEST_SIZE], 'hex_codec'))
+            offset += DIGEST_SIZE
+        else:
+            data, offset = decode_bytes(buf, offset)
+            children.append(data)
+    return tuple(children)
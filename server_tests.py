@@ -1,8 +1,10 @@
-import time, sys, cProfile, os, shelve
+import time, sys, cProfile, os, sqlite3, tempfile, shutil
 import numpy as np
 import monero_server as server
 
 first_arg = sys.argv[1]
+if len(sys.argv) > 2:
+    server.build_workers = int(sys.argv[2])
 
 def build_time():
     '''Tests the average build time of the server without any of the initial data structures.
@@ -14,10 +16,15 @@ def build_time():
     elapsed = end - start
     return elapsed
 
-def add_adjust():
+def add_adjust(num_outputs=1000000):
     '''Tests the average time it takes for the server to add new blocks into the 3-layer
-    Merkle tree design.'''
-    server.main()
+    Merkle tree design. Without the Monero database in /data, the forest is built over all but the
+    last 1% of num_outputs synthetic outputs instead, which are queued to be added.'''
+    if os.path.isfile("/data/rct_output_10_23_2017.db"):
+        server.main()
+    else:
+        print "No database in /data, so building over %d synthetic outputs..."%(num_outputs)
+        synthetic_forest(num_outputs, built=0.99)
     print "Profiling adding to the top Merkle tree..."
     avg = []
     for x in range(0,100):
@@ -28,6 +35,54 @@ def add_adjust():
         avg.append(elapsed)
     return np.average(avg)
 
+def block_start(rows, i):
+    '''Returns the position of the first row of the block that row i is in.'''
+    while i > 0 and rows[i - 1][0] == rows[i][0]:
+        i -= 1
+    return i
+
+def ingest_rate(num_outputs, batch_size):
+    '''Builds the forest over the first tenth of num_outputs synthetic outputs, writes the rest to the
+    out_table of a scratch database, and times the ingestor while it catches up on them. Returns the
+    number of blocks added and the blocks added per second, counting the reads from the database.'''
+    from tree_bench import make_outkeys
+    rows = make_outkeys(num_outputs)
+    split = block_start(rows, len(rows) // 10)
+    scratch = tempfile.mkdtemp()
+    try:
+        database_path = os.path.join(scratch, "out.db")
+        conn = sqlite3.connect(database_path)
+        conn.execute('''CREATE TABLE out_table (block_hash text, tx_hash text, outkey text, idx integer primary key)''')
+        conn.executemany('''INSERT INTO out_table VALUES (?,?,?,?)''', rows)
+        conn.commit()
+        conn.close()
+        server.merkle_forest = {}
+        server.scan_over_new_blocks(rows[:split])
+        ingestor = server.BlockIngestor(database_path, batch_size=batch_size)
+        start = time.time()
+        while ingestor.poll() or server.top_root[1] < rows[-1][3]:
+            pass
+        end = time.time()
+        ingestor.stop()
+        return ingestor.blocks, ingestor.blocks / (end - start)
+    finally:
+        shutil.rmtree(scratch)
+
+def synthetic_forest(num_outputs, built=0.1):
+    '''Builds the forest over the first tenth, or the given fraction, of num_outputs synthetic
+    outputs, with the rest queued for /update. Nothing is written to /data.'''
+    from tree_bench import make_outkeys
+    rows = make_outkeys(num_outputs)
+    split = block_start(rows, int(len(rows) * built))
+    server.snapshot_path = server.delta_log_path = None
+    server.scan_over_new_blocks(rows[:split])
+    server.queue_new_blocks(rows[split:])
+
+def serve_synthetic(num_outputs=100000):
+    '''Serves a forest over synthetic outputs on localhost, for client_tests to run against.'''
+    synthetic_forest(num_outputs)
+    server.app.run(threaded=True)
+
 def main():
     if first_arg=="build":
         print "Profiling build time..."
@@ -36,12 +91,18 @@ def main():
             print "Currently on iteration: %d"%(x+1)
             if os.path.isfile("/data/rct_output_10_23_2017.p"):
                 os.remove("/data/rct_output_10_23_2017.p")
-            if os.path.isfile("/data/merkle_forest"):
-                os.remove("/data/merkle_forest")
-                server.merkle_forest = shelve.open("/data/merkle_forest", protocol=-1)
+            server.merkle_forest = {}
             avg.append(build_time())
         print avg
         print "Average time to build data structure for 100 trials is %.6f seconds."%(np.average(avg))
+    elif first_arg=="synthetic":
+        serve_synthetic()
+    elif first_arg=="ingest":
+        num_outputs = 200000
+        print "Ingesting %d synthetic outputs from the out_table, 90%% of them after the initial build..."%(num_outputs)
+        for batch_size in (1, 10, 100, 1000):
+            blocks, rate = ingest_rate(num_outputs, batch_size)
+            print "Batches of up to %d blocks: %d blocks added at %.1f blocks per second."%(batch_size, blocks, rate)
     elif first_arg=="add":
         print "Average time to add to the top Merkle tree is %.6f seconds."%(add_adjust())
 
@@ -1,4 +1,5 @@
 import pytest
+import sys, os, time, json, struct, socket, subprocess, contextlib, itertools, gc
 from merkle import *
 
 
@@ -181,3 +182,1016 @@ def test_add_adjust_prehashed():
             test_tree.add_adjust(hash_function(inputs[k]).digest(), prehashed=True)
         assert control_tree == test_tree
         assert control_tree.get_all_chains() == test_tree.get_all_chains()
+
+
+def test_flat_tree():
+    inputs = 'abcdefghijklmnopqrstuvwxyz'
+    for i in range(1, len(inputs) + 1, 1):
+        leaves = [(j, k) for k, j in enumerate(inputs[0:i])]
+        control_tree = MerkleTree(leaves)
+        control_tree.build()
+        flat_tree = FlatMerkleTree(leaves)
+        assert flat_tree.build() == control_tree.root.val
+        assert flat_tree.root_idx == control_tree.root.idx
+        assert flat_tree.get_all_proofs() == control_tree.get_all_proofs()
+        for path in ([], ['l'], ['r'], ['r', 'r'], ['l', 'r', 'l']):
+            assert fetch_children_hash(flat_tree, path) == fetch_children_hash(control_tree, path)
+
+
+def test_flat_add_adjust():
+    inputs = 'abcdefghijklmnopqrstuvwxyz'
+    for i in range(1, len(inputs) + 1, 1):
+        control_tree = FlatMerkleTree([(j, k) for k, j in enumerate(inputs[0:i])])
+        control_tree.build()
+        test_tree = FlatMerkleTree([(inputs[0], 0)])
+        test_tree.build()
+        for k in range(1, i, 1):
+            test_tree.add_adjust((hash_function(inputs[k]).digest(), k), prehashed=True)
+        assert control_tree == test_tree
+        assert control_tree.levels == test_tree.levels
+        assert control_tree.idxs == test_tree.idxs
+
+
+def test_flat_keyed():
+    keys = [hash_function(j).digest() for j in 'abcde']
+    control_tree = MerkleTree([(codecs.encode(key, 'hex_codec'), k) for k, key in enumerate(keys)])
+    control_tree.build()
+    flat_tree = FlatMerkleTree([(key, k) for k, key in enumerate(keys)], keyed=True)
+    assert flat_tree.build() == control_tree.root.val
+    assert flat_tree.leaf_key(3) == keys[3]
+    assert flat_tree.leaf_data(3) == control_tree.leaves[3].data
+    assert fetch_children_hash(flat_tree, ['r']) == fetch_children_hash(control_tree, ['r'])
+
+
+def test_add_adjust_frontier():
+    leaves = [(j, k) for k, j in enumerate('abcdefghijklmnopqrstuvwxyz')]
+    for i in range(1, len(leaves) + 1, 1):
+        control_tree = MerkleTree(leaves[0:i])
+        control_tree.build()
+        for start in (1, (i + 1) // 2):
+            test_tree = MerkleTree(leaves[0:start])
+            test_tree.build()
+            for leaf in leaves[start:i]:
+                test_tree.add_adjust(leaf)
+            assert control_tree == test_tree
+            assert control_tree.get_all_proofs() == test_tree.get_all_proofs()
+            assert len(test_tree.frontier or [test_tree.root]) == bin(i).count('1')
+
+
+def test_flat_serialize():
+    for leaves, keyed in (([(j, k) for k, j in enumerate(u'abcde')], False),
+                          ([(hash_function(j).digest(), k) for k, j in enumerate('abcdefg')], True)):
+        tree = FlatMerkleTree(leaves, keyed=keyed)
+        tree.build()
+        blob = 'x' + tree.serialize()
+        restored, offset = FlatMerkleTree.deserialize(blob, 1)
+        assert offset == len(blob)
+        assert restored == tree
+        assert restored.get_all_proofs() == tree.get_all_proofs()
+        assert restored.leaf_entries() == tree.leaf_entries()
+
+def test_flat_serialize_idx_layout(monkeypatch):
+    import merkle
+    tree = FlatMerkleTree([(j, 2 ** 40 + k) for k, j in enumerate('abcde')])
+    tree.build()
+    blob = tree.serialize()
+    # the idx values follow the levels as 8 byte little endian integers, whatever array('l') is
+    offset = 5 + sum(len(level) for level in tree.levels)
+    assert blob[offset:offset + 40] == struct.pack('<5q', *[2 ** 40 + k for k in range(5)])
+    mapped, _ = FlatMerkleTree.deserialize(blob, copy=False)
+    assert [mapped.idxs[0][i] for i in range(5)] == list(tree.idxs[0])
+    # and are read and written the same way where array('l') does not match them
+    monkeypatch.setattr(merkle, 'NATIVE_IDX', False)
+    assert tree.serialize() == blob
+    restored, _ = FlatMerkleTree.deserialize(blob)
+    assert restored == tree
+    mapped._thaw()
+    assert list(mapped.idxs[0]) == list(tree.idxs[0])
+
+def test_flat_inline():
+    tx_tree = FlatMerkleTree([('b', 1), ('c', 2)])
+    tx_tree.build()
+    leaves = [(hash_function('a').digest(), 0), (tx_tree.root_val, 2), (hash_function('d').digest(), 3)]
+    tree = FlatMerkleTree(leaves, keyed=True, inline={0: 'a', 2: 'd'})
+    plain = FlatMerkleTree(leaves, keyed=True)
+    assert tree.build() == plain.build()
+    assert [tree.leaf_inline(i) for i in range(3)] == ['a', None, 'd']
+    assert plain.leaf_inline(0) is None
+    for copy in (True, False):
+        restored, offset = FlatMerkleTree.deserialize(tree.serialize(), copy=copy)
+        assert offset == len(tree.serialize())
+        assert restored == tree
+        assert restored.inline == tree.inline
+    assert FlatMerkleTree.deserialize(plain.serialize())[0].inline is None
+
+
+def test_flat_version():
+    leaves = [(hash_function(j).digest(), k) for k, j in enumerate('abcdefghijk')]
+    tree = FlatMerkleTree(leaves[:1], keyed=True)
+    tree.build()
+    versions = [(1, tree.spine())]
+    for leaf in leaves[1:]:
+        tree.add_adjust(leaf)
+        versions.append((tree.num_leaves, tree.spine()))
+    for num_leaves, spine in versions:
+        old = tree.version(num_leaves, spine)
+        control = FlatMerkleTree(leaves[:num_leaves], keyed=True)
+        control.build()
+        assert old == control
+        assert old.num_leaves == num_leaves
+        assert old.get_all_proofs() == control.get_all_proofs()
+        assert old.serialize() == control.serialize()
+    old = tree.version(*versions[4])
+    old.add_adjust(leaves[-1])
+    assert tree.version(*versions[4]).root_val == versions[4][1][-1][0]
+    assert old.root_val != tree.root_val
+    with pytest.raises(MerkleError):
+        tree.version(20, versions[4][1])
+
+
+def test_add_adjust_counts_hashes():
+    leaves = [(hash_function(j).digest(), k) for k, j in enumerate('abcdefghijk')]
+    tree = FlatMerkleTree(leaves[:1], keyed=True)
+    tree.build()
+    for leaf in leaves[1:]:
+        hashed = tree.backend.hashed
+        tree.add_adjust(leaf)
+        # one hash for the leaf, and one for each level that ends in a pair
+        assert tree.backend.hashed - hashed == 1 + sum(1 for width in level_widths(tree.num_leaves)[:-1] if width % 2 == 0)
+
+def test_version_while_appending():
+    leaves = [(hash_function(j).digest(), k) for k, j in enumerate('abcdefghijklmnopq')]
+    tree = FlatMerkleTree(leaves[:5], keyed=True)
+    tree.build()
+    view = tree.version(tree.num_leaves, tree.spine())
+    control = FlatMerkleTree(leaves[:5], keyed=True)
+    control.build()
+    tree.add_adjust(leaves[5])
+    tree.extend(leaves[6:])
+    assert view == control
+    assert view.get_all_proofs() == control.get_all_proofs()
+    assert view.find_leaf(16) == control.find_leaf(16)
+
+
+def test_truncate():
+    leaves = [(j, k) for k, j in enumerate('abcdefghijklm')]
+    for num_leaves in range(1, len(leaves) + 1):
+        tree = MerkleTree(leaves[:1])
+        tree.build()
+        for leaf in leaves[1:]:
+            tree.add_adjust(leaf)
+        flat = FlatMerkleTree(leaves)
+        flat.build()
+        control = FlatMerkleTree(leaves[:num_leaves])
+        control.build()
+        tree.truncate(num_leaves)
+        flat.truncate(num_leaves)
+        assert tree.root.val == flat.root_val == control.root_val
+        assert tree.get_all_proofs() == flat.get_all_proofs() == control.get_all_proofs()
+        tree.add_adjust(leaves[-1])
+        flat.add_adjust(leaves[-1])
+        assert tree.root.val == flat.root_val
+    with pytest.raises(MerkleError):
+        flat.truncate(0)
+
+
+def test_forest_snapshot(tmpdir):
+    import forest_store
+    forest = {}
+    tx_leaves = []
+    for k, j in enumerate('abcdef'):
+        tx_tree = FlatMerkleTree([(j, k)])
+        forest[tx_tree.build()] = tx_tree
+        tx_leaves.append((tx_tree.root_val, k))
+    top_tree = FlatMerkleTree(tx_leaves[:4], keyed=True)
+    forest[top_tree.build()] = top_tree
+    snapshot, log = str(tmpdir.join('forest.snap')), str(tmpdir.join('forest.log'))
+    forest_store.write_snapshot(snapshot, forest, top_tree)
+    delta_log = forest_store.DeltaLog(log, truncate=True)
+    for leaf in tx_leaves[4:]:
+        prev_root = top_tree.root_val
+        del forest[prev_root]
+        top_tree.add_adjust(leaf)
+        forest[top_tree.root_val] = top_tree
+        delta_log.append(prev_root, [], [leaf], top_tree)
+    prev_root = top_tree.root_val
+    del forest[prev_root], forest[tx_leaves[5][0]]
+    top_tree.truncate(5)
+    forest[top_tree.root_val] = top_tree
+    delta_log.rollback(prev_root, 5, [tx_leaves[5][0]], top_tree)
+    delta_log.close()
+    image, loaded_tree = forest_store.load_forest(snapshot, verify=True)
+    assert forest_store.replay_log(log, image, loaded_tree) == 3
+    assert loaded_tree == top_tree
+    assert sorted(image.iterkeys()) == sorted(forest.iterkeys())
+    assert image[tx_leaves[2][0]].leaf_entries() == forest[tx_leaves[2][0]].leaf_entries()
+    # a tree looked up from the image reads the mapped file, and is only copied once it changes
+    tx_tree = image[tx_leaves[2][0]]
+    assert isinstance(tx_tree.levels[0], buffer)
+    tx_tree.add_adjust(('g', 6))
+    assert isinstance(tx_tree.levels[0], bytearray)
+    assert image[tx_leaves[2][0]].leaf_entries() == forest[tx_leaves[2][0]].leaf_entries()
+
+def test_shared_image(tmpdir):
+    import forest_store
+    forest = {}
+    tx_leaves = []
+    for k, j in enumerate('abcdef'):
+        tx_tree = FlatMerkleTree([(j, k)])
+        forest[tx_tree.build()] = tx_tree
+        tx_leaves.append((tx_tree.root_val, k))
+    top_tree = FlatMerkleTree(tx_leaves[:4], keyed=True)
+    forest[top_tree.build()] = top_tree
+    snapshot, log = str(tmpdir.join('forest.snap')), str(tmpdir.join('forest.log'))
+    forest_store.write_snapshot(snapshot, dict((key, forest[key]) for key in forest if key != tx_leaves[5][0]), top_tree)
+    delta_log = forest_store.DeltaLog(log, truncate=True)
+    publisher = forest_store.ImagePublisher(snapshot, log)
+    publisher.publish(top_tree)
+    reader = forest_store.SharedImage(snapshot, log)
+    image, shared_top = reader.refresh()
+    assert shared_top == top_tree
+    for leaf in tx_leaves[4:]:
+        prev_root = top_tree.root_val
+        del forest[prev_root]
+        top_tree.add_adjust(leaf)
+        forest[top_tree.root_val] = top_tree
+        delta_log.append(prev_root, [(leaf[0], forest[leaf[0]])], [leaf], top_tree)
+        publisher.publish(top_tree)
+    delta_log.close()
+    image, shared_top = reader.refresh()
+    assert shared_top == top_tree
+    assert sorted(image.iterkeys()) == sorted(forest.iterkeys())
+    assert image[tx_leaves[5][0]].leaf_entries() == forest[tx_leaves[5][0]].leaf_entries()
+    assert shared_top.get_proof(5) == top_tree.get_proof(5)
+
+def test_flat_find_leaf():
+    tree = FlatMerkleTree([(str(i), 3 * i + 2) for i in range(9)])
+    tree.build()
+    assert [tree.find_leaf(idx) for idx in (0, 2, 3, 5, 26, 27)] == [0, 0, 1, 1, 8, 9]
+    tree.add_adjust(('9', 40))
+    assert tree.find_leaf(27) == 9 and tree.leaf_entry(9) == ('9', 40)
+    mapped, _ = FlatMerkleTree.deserialize(tree.serialize(), copy=False)
+    assert [mapped.find_leaf(idx) for idx in range(42)] == [tree.find_leaf(idx) for idx in range(42)]
+
+def test_flat_multiproof():
+    for n in (1, 2, 5, 11, 16):
+        tree = FlatMerkleTree([(str(i), i) for i in range(n)])
+        root = codecs.encode(tree.build(), 'hex_codec')
+        for positions in ([0], [n - 1], range(0, n, 3), range(n)):
+            leaves = dict((pos, tree.get_proof(pos)[0][0][0]) for pos in positions)
+            nodes = tree.get_multiproof(positions)
+            assert check_multiproof(n, leaves, nodes) == root
+            assert len(nodes) <= sum(len(tree.get_proof(pos)) - 2 for pos in positions)
+        if n > 2:
+            with pytest.raises(MerkleError):
+                check_multiproof(n, {0: tree.get_proof(0)[0][0][0]}, tree.get_multiproof([0])[1:])
+
+def test_proof_wire():
+    import proof_wire
+    for n in (0, 1, 127, 128, 300, 2 ** 40):
+        assert proof_wire.decode_varint(proof_wire.encode_varint(n)) == (n, len(proof_wire.encode_varint(n)))
+    tx_tree = FlatMerkleTree([(str(i), i) for i in range(5)])
+    tx_tree.build()
+    block_tree = FlatMerkleTree([(tx_tree.root_val, 4), (tx_tree.root_val, 9), (tx_tree.root_val, 12)], keyed=True)
+    block_tree.build()
+    top_tree = FlatMerkleTree([(block_tree.root_val, 12)], keyed=True)
+    top_tree.build()
+    chains = (tx_tree._get_proof(3), block_tree._get_proof(0), top_tree._get_proof(0))
+    buf = proof_wire.encode_paths([proof_wire.encode_path(('3', 3), chains)] * 2)
+    paths = proof_wire.decode_paths(buf)
+    assert len(paths) == 2 and paths[1].found_output == ('3', 3)
+    assert paths[0].layers == [(3, 4), (2, 12), (0, 12)]
+    siblings = [link for chain in chains for link in chain[1:-1]]
+    for i, ((digest, _), side) in enumerate(siblings):
+        assert paths[0].sibling(i) == (digest, side == 'L')
+    children = fetch_children_hash(block_tree)
+    assert proof_wire.decode_children(proof_wire.encode_children(children, keyed=True)) == children
+
+def test_flat_subtree():
+    tree = FlatMerkleTree([(str(i), i) for i in range(11)])
+    tree.build()
+    rows, data = tree.get_subtree(tree.height - 1, 0, 2)
+    assert rows[0] == [codecs.encode(tree.root_val, 'hex_codec')] and data is None
+    assert rows[1] == [codecs.encode(tree.digest(tree.height - 2, p), 'hex_codec') for p in range(2)]
+    assert len(rows[2]) == len(tree.idxs[tree.height - 3])
+    rows, data = tree.get_subtree(2, 2, 5)
+    assert [len(row) for row in rows] == [1, 2, 3] and data == ['8', '9', '10']
+    rows, data = tree.get_subtree(0, 4, 3)
+    assert rows == [[tree.get_proof(4)[0][0][0]]] and data == ['4']
+
+def test_extend():
+    leaves = [(str(i), i) for i in range(100)]
+    for first, step in ((1, 1), (3, 7), (16, 50), (5, 95)):
+        node_tree, flat_tree = MerkleTree(leaves[:first]), FlatMerkleTree(leaves[:first])
+        node_tree.build()
+        flat_tree.build()
+        for start in range(first, len(leaves), step):
+            node_tree.extend(leaves[start:start + step])
+            flat_tree.extend(leaves[start:start + step])
+            control_tree = FlatMerkleTree(leaves[:start + step])
+            assert node_tree.root.val == flat_tree.root_val == control_tree.build()
+            assert flat_tree.levels == control_tree.levels and flat_tree.idxs == control_tree.idxs
+        assert node_tree.get_proof(first) == flat_tree.get_proof(first)
+
+def test_hash_backends():
+    vectors = {
+        'blake2b': ('', '0e5751c026e543b2e8ab2eb06099daa1d1e5df47778f7787faab45cdf12fe3a8'),
+        'sha3_256': ('abc', '3a985da74fe225b2045c172d6bd390bd855f086e3e9d525b46bfe24511431532'),
+        'keccak256': ('', 'c5d2460186f7233c927e7db2dcc703c0e500b653ca82273b7bfad8045d85a470'),
+    }
+    for name, (data, digest) in vectors.items():
+        backend = hash_backends.get(name)
+        assert backend.hexhash(data) == digest
+        # feeding it across the block boundary gives the same digest as in one go
+        long_data = 'x' * 300
+        hasher = backend.new(long_data[:135])
+        hasher.update(long_data[135:])
+        assert hasher.copy().hexdigest() == hasher.hexdigest() == backend.hexhash(long_data)
+    assert hash_backends.get() is hash_backends.get('sha256') is hash_backends.from_code(0)
+    with pytest.raises(ValueError):
+        hash_backends.get('md5')
+
+def test_backend_trees():
+    leaves = [(str(i), i) for i in range(13)]
+    roots = set()
+    for name in hash_backends.BACKENDS:
+        node_tree, flat_tree = MerkleTree(leaves, backend=name), FlatMerkleTree(leaves, backend=name)
+        node_tree.build()
+        flat_tree.build()
+        flat_tree.add_adjust(('13', 13))
+        node_tree.add_adjust(('13', 13))
+        assert node_tree.root.val == flat_tree.root_val
+        assert node_tree.get_proof(5) == flat_tree.get_proof(5)
+        roots.add(flat_tree.root_val)
+        assert check_proof(flat_tree.get_proof(5), name) == codecs.encode(flat_tree.root_val, 'hex_codec')
+        for other in set(hash_backends.BACKENDS) - set([name]):
+            with pytest.raises(MerkleError):
+                check_proof(flat_tree.get_proof(5), other)
+        restored, _ = FlatMerkleTree.deserialize(flat_tree.serialize())
+        assert restored.backend.name == name and restored == flat_tree
+        known = dict((pos, flat_tree.get_proof(pos)[0][0][0]) for pos in (0, 4, 5, 12))
+        nodes = flat_tree.get_multiproof(sorted(known))
+        assert check_multiproof(14, known, nodes, name) == codecs.encode(flat_tree.root_val, 'hex_codec')
+    assert len(roots) == len(hash_backends.BACKENDS)
+
+def test_forest_size(tmpdir):
+    import forest_store
+    forest = {}
+    for k in range(1, 8):
+        tree = FlatMerkleTree([(str(i), i) for i in range(k)])
+        forest[tree.build()] = tree
+        assert tree.num_nodes == forest_store.count_nodes(k)
+    top_tree = FlatMerkleTree([(key, 0) for key in forest], keyed=True)
+    forest[top_tree.build()] = top_tree
+    snapshot = str(tmpdir.join('forest.snap'))
+    forest_store.write_snapshot(snapshot, forest, top_tree)
+    image, _ = forest_store.load_forest(snapshot)
+    trees, nodes, _ = forest_store.forest_size(forest)
+    assert (trees, nodes) == (8, sum(tree.num_nodes for tree in forest.values()))
+    assert forest_store.forest_size(image)[:2] == (trees, nodes)
+
+def test_build_profile():
+    import build_profile, threading
+    profiler = build_profile.BuildProfiler(label='test').start()
+    with profiler.phase('build'):
+        for _ in range(3):
+            with profiler.phase('hash'):
+                with profiler.phase('insert'):
+                    pass
+        # another thread's phases do not nest with these, so they are left out
+        other = threading.Thread(target=lambda: profiler.phase('sqlite').__enter__())
+        other.start()
+        other.join()
+    report = profiler.stop().report()
+    phases = report['phases']
+    assert sorted(phases) == ['build', 'hash', 'insert']
+    assert [phases[name]['calls'] for name in ('build', 'hash', 'insert')] == [1, 3, 3]
+    assert phases['hash']['own_seconds'] <= phases['hash']['seconds'] <= phases['build']['seconds']
+    # the growth of the peak RSS is recorded with or without tracemalloc
+    assert all(phases[name]['rss_kb'] >= 0 for name in phases)
+    profiler.merge(report)
+    assert profiler.report()['phases']['hash']['calls'] == 6
+    assert profiler.phase('build') is build_profile.null_phase
+
+@pytest.fixture(scope='module')
+def outkeys():
+    from tree_bench import make_outkeys
+    return make_outkeys(3000)
+
+@pytest.fixture
+def server(outkeys):
+    '''The server, with its forest built over all but the last 20 blocks of outkeys, which are
+    queued for /update. Nothing is written to /data.'''
+    import monero_server as server
+    blocks = list(server.group_blocks(outkeys))
+    server.snapshot_path = server.delta_log_path = None
+    server.delta_log = server.image_publisher = server.shared_image = server.ingestor = None
+    server.build_workers = 1
+    server.merkle_forest = {}
+    server.proof_cache = server.ProofCache()
+    server.scan_over_new_blocks(itertools.chain.from_iterable(blocks[:-20]))
+    server.queue_new_blocks(itertools.chain.from_iterable(blocks[-20:]))
+    return server
+
+def test_queries_never_publish(server):
+    snap = server.current_snapshot()
+    # as halfway through a rollback, the top tree has been replaced but nothing is published yet
+    top = server.top_merkle
+    server.top_merkle, _ = FlatMerkleTree.deserialize(top.serialize())
+    try:
+        assert server.current_snapshot() is snap
+        assert server.app.test_client().get('/getroot').status_code == 200
+        assert server.current_snapshot() is snap
+    finally:
+        server.top_merkle = top
+
+def test_rollback_keeps_trees_for_held_snapshots(server):
+    import forest_store
+    held = server.current_snapshot()
+    last_idx = server.top_root[1]
+    num_blocks = server.top_merkle.num_leaves
+    removed = [key for pos in range(num_blocks - 3, num_blocks)
+        for key, _ in forest_store.block_trees(server.merkle_forest, server.top_merkle.leaf_key(pos))]
+    assert server.rollback_blocks(height=num_blocks - 3) == 3
+    # a query that took the snapshot before the rollback still finds the outputs that were removed
+    assert held.find_output(last_idx)[4][1] == last_idx
+    with pytest.raises(ValueError):
+        server.current_snapshot().find_output(last_idx)
+    assert all(key in server.merkle_forest for key in removed)
+    del held
+    gc.collect()
+    assert not any(key in server.merkle_forest for key in removed)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+@contextlib.contextmanager
+def local_servers(*specs):
+    '''Serves the forest over the synthetic rows of benchmarks.py for each (num_outputs, corrupt) in
+    specs, each in a process of its own on a free local port, and yields their addresses. Rows are the
+    same for every number of outputs up to where the smaller one ends, so a server over more outputs
+    has the same chain with more blocks on top.'''
+    import requests
+    here = os.path.dirname(os.path.abspath(__file__))
+    ports = [free_port() for _ in specs]
+    procs = [subprocess.Popen([sys.executable, os.path.join(here, 'benchmarks.py'), 'serve', str(spec[0]), str(port)] +
+        [str(arg) for arg in spec[1:]], cwd=here, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        for spec, port in zip(specs, ports)]
+    try:
+        addresses = ['http://127.0.0.1:%d' % port for port in ports]
+        for address, proc in zip(addresses, procs):
+            while True:
+                assert proc.poll() is None, 'a test server exited before it was up'
+                try:
+                    requests.get(address + '/getroot')
+                    break
+                except requests.ConnectionError:
+                    time.sleep(0.2)
+        yield addresses
+    finally:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+
+def server_roots(addresses):
+    import requests
+    return dict((address, tuple(requests.get(address + '/getroot').json()['root'])) for address in addresses)
+
+def test_resolve_conflicts_extra_blocks():
+    import monero_client as client
+    with local_servers((2000,), (2000, 700), (3000,)) as (short, corrupt, extra):
+        roots = server_roots([short, corrupt, extra])
+        conflicts = client.resolve_conflicts(roots)
+        # the corrupt output is found first, where the other two agree
+        first = conflicts[0]
+        assert sorted(first) == sorted([short, corrupt, extra])
+        assert first[short] == first[extra] != first[corrupt]
+        # then the server with more blocks, which the short one has no block for at all
+        second = [conflict for conflict in conflicts if sorted(conflict) == sorted([short, extra])]
+        assert len(second) == 1
+        assert second[0][short] == (None, None, 0)
+        block_root, tx_root, num_outputs = second[0][extra]
+        assert block_root is not None and tx_root is not None and num_outputs > 0
+        assert len(conflicts) == 2
+
+class FakeSnapshot(object):
+    def __init__(self, root, num_leaves):
+        self.top_root = root
+        self.top_merkle = FlatMerkleTree([("%d" % i, i) for i in range(num_leaves)])
+
+def test_root_feed_waiters():
+    import threading
+    import monero_server as server
+    feed = server.RootFeed(tick=0.05)
+    feed.publish(FakeSnapshot(("a", 1), 1))
+    assert feed.wait(0, 1)[0] == 1
+    # a subscriber that times out, and one that is woken by a new root, leave no live entries behind
+    assert feed.wait(1, 0.1) is None
+    events = []
+    long_waiter = threading.Thread(target=lambda: events.append(feed.wait(1, 30)))
+    long_waiter.start()
+    time.sleep(0.2)
+    # the long waiter is not woken by the deadlines of others
+    for _ in range(3):
+        assert feed.wait(1, 0.1) is None
+    assert long_waiter.is_alive() and not events
+    feed.publish(FakeSnapshot(("b", 2), 2))
+    long_waiter.join()
+    assert events[0][0] == 2
+    assert not feed.waiters
+    assert all(entry[1] is None for entry in feed.deadlines)
+    # spent entries are dropped once they are half of the heap
+    for _ in range(10):
+        feed.wait(1, 30)
+    assert len(feed.deadlines) <= 2
+    # and the ticker stops once no one is waiting
+    time.sleep(0.2)
+    assert feed.ticker is None
+
+def test_subscribe_timeout(server):
+    client = server.app.test_client()
+    event = json.loads(client.get('/subscribe?after=0').data)
+    assert tuple(event["root"]) == server.top_root
+    start = time.time()
+    again = json.loads(client.get('/subscribe?after=%d&timeout=0.1' % event["seq"]).data)
+    assert again == event
+    assert time.time() - start < 0.1 + server.root_feed.tick + 0.5
+    client.post('/update')
+    newer = json.loads(client.get('/subscribe?after=%d&timeout=5' % event["seq"]).data)
+    assert newer["seq"] > event["seq"] and tuple(newer["root"]) == server.top_root
+
+def test_subscribe_before_first_root(server, monkeypatch):
+    monkeypatch.setattr(server, 'root_feed', server.RootFeed(tick=0.05))
+    r = server.app.test_client().get('/subscribe?after=0&timeout=0.1')
+    assert r.status_code == 204 and r.data == ''
+
+def test_delta_log_compaction(server, tmpdir, monkeypatch):
+    import forest_store
+    import monero_client as client
+    monkeypatch.setattr(server, 'snapshot_path', str(tmpdir.join('forest.snap')))
+    monkeypatch.setattr(server, 'delta_log_path', str(tmpdir.join('forest.log')))
+    monkeypatch.setattr(server, 'compact_log_records', 3)
+    server.save_snapshot()
+    try:
+        for _ in range(2):
+            server.add_next_block()
+        assert server.delta_log.records == 2 and os.path.getsize(server.delta_log_path) == server.delta_log.size > 0
+        # the third record folds the log into a new snapshot
+        server.add_next_block()
+        assert server.delta_log.records == 0 and os.path.getsize(server.delta_log_path) == 0
+        forest, top = forest_store.load_forest(server.snapshot_path)
+        assert top.root_val == server.top_merkle.root_val
+        # the forest is served from the new snapshot, with only the top tree held in memory
+        assert isinstance(server.merkle_forest, forest_store.ForestImage)
+        assert server.merkle_forest.overlay.keys() == [server.top_merkle.root_val]
+        assert server.current_snapshot().forest is server.merkle_forest
+        assert server.current_snapshot().top_root == server.top_root
+        r = json.loads(query(server, '/getout', idx=server.top_merkle.root_idx).data)
+        assert client.check_path(r['found'], r['proof'], server.top_root)
+        # and a clean shutdown folds in whatever was logged since
+        server.add_next_block()
+        root = server.top_merkle.root_val
+        server.shut_down()
+        assert server.delta_log is None and os.path.getsize(server.delta_log_path) == 0
+        forest, top = forest_store.load_forest(server.snapshot_path)
+        assert top.root_val == root
+    finally:
+        if server.delta_log is not None:
+            server.delta_log.close()
+            server.delta_log = None
+
+def test_pooled_client():
+    import monero_client as client
+    with local_servers((2000,), (2000, 700)) as (honest, corrupt):
+        pooled = client.PooledClient([honest, corrupt], chunk_size=100)
+        results = pooled.get_outputs(range(1000))
+        assert [found[1] for found, _, _ in results] == range(1000)
+        # the chunks go to the servers in turn, and each proof checks out against its own server's root
+        assert [server for _, server, _ in results[::100]] == [honest, corrupt] * 5
+        assert all(ok for _, _, ok in results)
+        assert results[700][0] != client.PooledClient([honest]).get_outputs([700])[0][0]
+        # with proofs in JSON, the results are the same
+        plain = client.PooledClient([honest, corrupt], chunk_size=100, binary=False)
+        assert [(list(found), server, ok) for found, server, ok in plain.get_outputs(range(1000))] == [
+            (list(found), server, ok) for found, server, ok in results]
+        # and so they are when the chunks are checked in worker processes, in either format
+        for binary in (True, False):
+            workers = client.PooledClient([honest, corrupt], chunk_size=100, binary=binary, check_workers=2)
+            try:
+                assert [(list(found), server, ok) for found, server, ok in workers.get_outputs(range(1000))] == [
+                    (list(found), server, ok) for found, server, ok in results]
+                assert workers.get_outputs([699, 700, 701], cross_check=True)
+                assert [idx for idx, _ in workers.disagreements] == [700]
+            finally:
+                workers.close()
+        # a cross check fetches the chunk from the other server too, and finds where they differ
+        assert pooled.get_outputs([699, 700, 701], cross_check=True)
+        assert [idx for idx, _ in pooled.disagreements] == [700]
+        assert sorted(pooled.disagreements[0][1]) == sorted([honest, corrupt])
+
+def query(server, path, **payload):
+    return server.app.test_client().get(path, data=json.dumps(payload), content_type='application/json')
+
+def test_proof_cache(server):
+    import monero_client as client
+    server.proof_cache = server.ProofCache(size=2)
+    first = query(server, '/getout', idx=100).data
+    assert server.proof_cache.stats()['misses'] == 1
+    assert query(server, '/getout', idx=100).data == first
+    assert server.proof_cache.stats()['hits'] == 1
+    # a new top root only makes the top proof stale, and the response is made again against it
+    assert server.app.test_client().post('/update').status_code == 200
+    again = json.loads(query(server, '/getout', idx=100).data)
+    assert server.proof_cache.stats()['top_misses'] == 1
+    assert again['found'] == json.loads(first)['found'] and again['proof'] != json.loads(first)['proof']
+    assert client.check_path(again['found'], again['proof'], server.top_root)
+    # the least recently used entry goes once there are more than size
+    query(server, '/getout', idx=200)
+    query(server, '/getout', idx=300)
+    assert sorted(server.proof_cache.entries) == [200, 300]
+    # and a rollback empties it
+    server.rollback_blocks(height=server.top_merkle.num_leaves - 1)
+    assert not server.proof_cache.entries
+
+def test_multiproof(server):
+    import copy
+    import monero_client as client
+    picks = range(100, 112) + [5, 2000, server.top_root[1]]
+    proof = json.loads(query(server, '/getouts', idx=picks, multiproof=True).data)
+    plain = json.loads(query(server, '/getouts', idx=picks).data)['results']
+    assert [found for found, _, _ in proof['outputs']] == [r['found'] for r in plain]
+    assert client.check_multiproof_paths(proof, server.top_root)
+    # each tx and block tree appears once, however many of the outputs are in it
+    txs = set((r['proof'][-2][0][0][0], r['proof'][-1][0][0][0]) for r in plain)
+    assert len(proof['txs']) == len(txs)
+    assert len(proof['blocks']) == len(set(r['proof'][-1][0][0][0] for r in plain))
+    # a proof that has been tampered with, or a different root, does not check out
+    tampered = copy.deepcopy(proof)
+    tampered['outputs'][3][0][0] = hash_function('forged').hexdigest()
+    assert not client.check_multiproof_paths(tampered, server.top_root)
+    tampered = copy.deepcopy(proof)
+    level, pos, digest = tampered['top']['nodes'][0]
+    tampered['top']['nodes'][0] = [level, pos, hash_function(digest).hexdigest()]
+    assert not client.check_multiproof_paths(tampered, server.top_root)
+    tampered = copy.deepcopy(proof)
+    del tampered['blocks'][0]['nodes'][0]
+    assert not client.check_multiproof_paths(tampered, server.top_root)
+    tampered = copy.deepcopy(proof)
+    tampered['outputs'][0][2] += 1
+    assert not client.check_multiproof_paths(tampered, server.top_root)
+    assert not client.check_multiproof_paths(proof, (hash_function('other').hexdigest(), server.top_root[1]))
+
+def test_binary_proofs(server):
+    import proof_wire
+    import monero_client as client
+    picks = [0, 101, 102, 2000, server.top_root[1]]
+    plain = json.loads(query(server, '/getouts', idx=picks).data)['results']
+    # the flag and the Accept header both ask for the binary format
+    batch = query(server, '/getouts', idx=picks, binary=True)
+    assert batch.mimetype == proof_wire.MIMETYPE
+    paths = proof_wire.decode_paths(batch.data)
+    assert [list(path.found_output) for path in paths] == [r['found'] for r in plain]
+    assert all(client.check_binary_path(path, server.top_root) for path in paths)
+    single = server.app.test_client().get('/getout', data=json.dumps({'idx': 101}), content_type='application/json',
+        headers={'Accept': proof_wire.MIMETYPE}).data
+    path, end = proof_wire.decode_path(memoryview(single))
+    assert end == len(single) and client.check_binary_path(path, server.top_root)
+    # a changed sibling or output, or a different root, does not check out
+    for pos in (len(single) - 1, 2):
+        tampered = bytearray(single)
+        tampered[pos] ^= 1
+        assert not client.check_binary_path(proof_wire.decode_path(memoryview(bytes(tampered)))[0], server.top_root)
+    assert not client.check_binary_path(path, (hash_function('other').hexdigest(), server.top_root[1]))
+
+def test_check_paths(server):
+    import copy
+    import monero_client as client
+    picks = range(100, 140) + [5, 2000, server.top_root[1]]
+    results = [(r['found'], r['proof']) for r in json.loads(query(server, '/getouts', idx=picks).data)['results']]
+    assert client.check_paths(results, server.top_root) == [True] * len(results)
+    assert client.check_paths(results, server.top_root, workers=2) == [True] * len(results)
+    # a bad proof is False on its own, and does not spoil the others that share its chains
+    bad = copy.deepcopy(results)
+    bad[0][0][0] = hash_function('forged').hexdigest()
+    (digest, idx), side = bad[1][1][0][1]
+    bad[1][1][0][1] = [[hash_function(digest).hexdigest(), idx], side]
+    bad[2][1][-1][-1][0][0] = hash_function('other').hexdigest()
+    bad[3] = (bad[3][0], bad[3][1][:-1])
+    checked = client.check_paths(bad, server.top_root)
+    assert checked == [False] * 4 + [True] * (len(results) - 4)
+    assert checked == [client.check_path(found, proof, server.top_root) if i >= 4 else False
+        for i, (found, proof) in enumerate(bad)]
+    assert client.check_paths(results, (hash_function('other').hexdigest(), server.top_root[1])) == [False] * len(results)
+
+def test_inline_flag(server):
+    import monero_client as client
+    results = json.loads(query(server, '/getouts', idx=range(400)).data)['results']
+    # each result says whether its tx is held inline, in which case its proof has no outkey proof
+    assert all(r['inline'] == (len(r['proof']) == 2) for r in results)
+    assert any(r['inline'] for r in results) and not all(r['inline'] for r in results)
+    single = [r for r in results if r['inline']][0]
+    assert json.loads(query(server, '/getout', idx=single['found'][1]).data) == single
+    # the client puts None in place of the outkey proof, and checks either form
+    paths = [client.json_path(r) for r in results]
+    assert all(len(proof) == 3 and (proof[0] is None) == r['inline'] for r, (_, proof) in zip(results, paths))
+    assert client.check_paths(paths, server.top_root) == [True] * len(paths)
+    assert all(client.check_path(found, proof, server.top_root) for found, proof in paths)
+    # a server that does not send the flag is read by the length of the proof
+    assert [client.json_path({'found': r['found'], 'proof': r['proof']}) for r in results] == paths
+
+def assert_rows_hash_up(levels):
+    for parents, children in zip(levels, levels[1:]):
+        for pos, parent in enumerate(parents):
+            pair = children[2 * pos:2 * pos + 2]
+            # an odd node at the end of a level is promoted unchanged
+            expected = hash_function(''.join(c.decode('hex') for c in pair)).hexdigest() if len(pair) == 2 else pair[0]
+            assert parent == expected
+
+def test_getsubtree(server):
+    top = server.top_merkle
+    r = json.loads(query(server, '/getsubtree', depth=3).data)
+    assert r['height'] == top.height and r['data'] is None
+    assert r['levels'][0] == [server.top_root[0]] and len(r['levels']) == 4
+    assert_rows_hash_up(r['levels'])
+    # a node below the root, and a block tree down to its leaves, whose data comes back too
+    level, pos = top.height - 3, 2
+    r = json.loads(query(server, '/getsubtree', node=[level, pos], depth=2).data)
+    assert r['levels'][0] == [top.digest(level, pos).encode('hex')]
+    assert_rows_hash_up(r['levels'])
+    block_root = top.leaf_data(5)
+    r = json.loads(query(server, '/getsubtree', root=block_root, depth=50).data)
+    block = server.merkle_forest[top.leaf_key(5)]
+    assert r['levels'][0] == [block_root] and len(r['levels']) == block.height
+    assert r['data'] == [block.leaf_data(p) for p in range(block.num_leaves)]
+    assert [hash_function(d).hexdigest() for d in r['data']] == r['levels'][-1]
+    assert_rows_hash_up(r['levels'])
+    # depth is capped, and a node or root that is not there fails
+    r = json.loads(query(server, '/getsubtree', depth=50).data)
+    assert len(r['levels']) == min(server.max_subtree_depth + 1, top.height)
+    cap, server.max_subtree_depth = server.max_subtree_depth, 2
+    try:
+        assert len(json.loads(query(server, '/getsubtree', depth=50).data)['levels']) == 3
+    finally:
+        server.max_subtree_depth = cap
+    assert 'Failure' in json.loads(query(server, '/getsubtree', node=[0, top.num_leaves]).data)
+    assert 'Failure' in json.loads(query(server, '/getsubtree', root=hash_function('other').hexdigest()).data)
+
+class LocalResponse(object):
+    def __init__(self, response):
+        self.data = response.data
+
+    def json(self):
+        return json.loads(self.data)
+
+class LocalRequests(object):
+    '''Stands in for grequests in the client, and answers its requests from the app of the server in
+    this process, whichever server they are sent to. Every request the conflict search sends names the
+    root it is about, so two forests in one merkle_forest can stand for two servers.'''
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, url, **kwargs):
+        return '/' + url.split('/', 3)[3], kwargs.get('json')
+
+    def map(self, requests):
+        return [LocalResponse(self.client.get(path, data=json.dumps(payload), content_type='application/json'))
+            for path, payload in requests]
+
+def corrupt_forest(server, outkeys, idx):
+    '''Builds a forest over the same rows as the server's, with the output at idx changed, into the
+    same merkle_forest. Returns the honest top root and the corrupt one.'''
+    honest = server.top_root
+    rows = list(outkeys[:honest[1] + 1])
+    rows[idx] = rows[idx][:2] + (hash_function('forged').hexdigest(),) + rows[idx][3:]
+    server.scan_over_new_blocks(rows)
+    return honest, server.top_root
+
+def test_subtree_conflict_search(server, outkeys, monkeypatch):
+    import monero_client as client
+    honest, corrupt = corrupt_forest(server, outkeys, 700)
+    monkeypatch.setattr(client, 'grequests', LocalRequests(server.app))
+    roots = {'http://honest': honest, 'http://corrupt': corrupt, 'http://also-honest': honest}
+    block, _ = server.find_ge(server.merkle_forest[server.forest_key(honest[0])], 700)
+    # any number of levels per round trip finds the block and the transaction that hold the output
+    found = [client.resolve_conflicts(roots, k) for k in (1, 3, 10)]
+    assert found[0] == found[1] == found[2] and len(found[0]) == 1
+    conflict = found[0][0]
+    assert sorted(conflict) == sorted(roots) and conflict['http://honest'] == conflict['http://also-honest']
+    assert server.forest_key(conflict['http://honest'][0]) == block[0]
+    assert conflict['http://honest'][:2] != conflict['http://corrupt'][:2]
+    assert conflict['http://honest'][2] == conflict['http://corrupt'][2] > 0
+
+def test_extend_endpoint(server, outkeys):
+    client = server.app.test_client()
+    blocks = list(server.group_blocks(outkeys))
+    queued, height = blocks[-20:], server.top_merkle.num_leaves
+    r = json.loads(client.post('/extend', data=json.dumps({"count": 5}), content_type='application/json').data)
+    assert server.top_merkle.num_leaves == height + 5
+    extended = tuple(r['root'])
+    assert extended == server.top_root
+    # the same blocks added one at a time to the same forest give the same root
+    server.merkle_forest = {}
+    server.scan_over_new_blocks(itertools.chain.from_iterable(blocks[:-20]))
+    server.queue_new_blocks(itertools.chain.from_iterable(queued))
+    for _ in range(5):
+        assert client.post('/update').status_code == 200
+    assert server.top_root == extended
+    # up to the block that holds idx, then every pending block, then nothing is left to add
+    idx = queued[8][0][3]
+    r = json.loads(client.post('/extend', data=json.dumps({"idx": idx}), content_type='application/json').data)
+    assert r['root'][1] == queued[8][-1][3] and server.top_merkle.num_leaves == height + 9
+    r = json.loads(client.post('/extend').data)
+    assert r['root'][1] == queued[-1][-1][3] and server.top_merkle.num_leaves == height + 20
+    assert 'Failure' in json.loads(client.post('/extend').data)
+
+def test_queries_against_old_roots(server, monkeypatch):
+    import monero_client as client
+    client_post = server.app.test_client().post
+    monkeypatch.setattr(server, 'root_history', server.RootHistory(size=2))
+    old_root = server.top_root
+    for _ in range(2):
+        assert client_post('/update').status_code == 200
+    # an output under the old root is proven against it, and one above it is not there
+    r = json.loads(query(server, '/getout', idx=100, root=old_root[0]).data)
+    assert client.check_path(r['found'], r['proof'], old_root)
+    assert not client.check_path(r['found'], r['proof'], server.top_root)
+    assert 'Failure' in json.loads(query(server, '/getout', idx=old_root[1] + 1, root=old_root[0]).data)
+    r = json.loads(query(server, '/getsubtree', root=old_root[0], depth=2).data)
+    assert r['levels'][0] == [old_root[0]] and r['height'] <= server.top_merkle.height
+    assert_rows_hash_up(r['levels'])
+    # a root that was never the top root fails, and so does one that has dropped out of the history
+    other = hash_function('other').hexdigest()
+    assert 'Failure' in json.loads(query(server, '/getout', idx=100, root=other).data)
+    assert 'Failure' in json.loads(query(server, '/getsubtree', root=other).data)
+    assert client_post('/update').status_code == 200
+    assert 'Failure' in json.loads(query(server, '/getout', idx=100, root=old_root[0]).data)
+    # as does one whose last block has been rolled back
+    recent = server.top_root
+    assert client_post('/update').status_code == 200
+    assert 'Failure' not in json.loads(query(server, '/getout', idx=100, root=recent[0]).data)
+    server.rollback_blocks(height=server.top_merkle.num_leaves - 2)
+    assert 'Failure' in json.loads(query(server, '/getout', idx=100, root=recent[0]).data)
+
+def test_rollback(server):
+    client = server.app.test_client()
+    height, earlier = server.top_merkle.num_leaves, server.top_root
+    for _ in range(3):
+        assert client.post('/update').status_code == 200
+    middle = server.top_root
+    assert client.post('/update').status_code == 200
+    # back to the root of an earlier height, by height or by the global index of its last output
+    r = json.loads(client.post('/rollback', data=json.dumps({"idx": middle[1]}), content_type='application/json').data)
+    assert tuple(r['root']) == middle == server.top_root
+    r = json.loads(client.post('/rollback', data=json.dumps({"height": height}), content_type='application/json').data)
+    assert tuple(r['root']) == earlier == server.top_root and server.top_merkle.num_leaves == height
+    assert json.loads(client.get('/getroot').data)['root'] == list(earlier)
+    # the pending blocks came after the old tip, so they are dropped
+    assert 'Failure' in json.loads(client.post('/update').data)
+    # nothing to roll back to, or past the start of the tree
+    for bad in (height, height + 1, 0):
+        assert 'Failure' in json.loads(client.post('/rollback', data=json.dumps({"height": bad}),
+            content_type='application/json').data)
+    assert server.top_root == earlier
+
+def test_find_top_after_reorg(server):
+    leaves = [(hash_function(j).digest(), k) for k, j in enumerate('abcdefghijk')]
+    history = server.RootHistory()
+    tree = FlatMerkleTree(leaves[:6], keyed=True)
+    tree.build()
+    history.record(tree)
+    old_root = codecs.encode(tree.root_val, 'hex_codec')
+    # a tree that goes on from the old one finds it, and one that only shares its last leaf does not
+    for changed, found in ((None, True), (2, False), (4, False)):
+        forked = list(leaves)
+        if changed is not None:
+            forked[changed] = (hash_function('fork').digest(), changed)
+        tree = FlatMerkleTree(forked, keyed=True)
+        tree.build()
+        snap = server.ForestSnapshot(tree, {}, dict(history.versions))
+        top = snap.find_top(old_root)
+        assert (top is not None) == found
+        if found:
+            assert top.root_val == codecs.decode(old_root, 'hex_codec') and top.num_leaves == 6
+
+def test_queries_during_update(server, monkeypatch):
+    import threading
+    import monero_client as client
+    old_root = server.top_root
+    publish, reached, release = server.publish_snapshot, threading.Event(), threading.Event()
+    def paused_publish():
+        reached.set()
+        release.wait()
+        publish()
+    monkeypatch.setattr(server, 'publish_snapshot', paused_publish)
+    writer = threading.Thread(target=server.add_blocks, kwargs={"count": 3})
+    writer.start()
+    try:
+        assert reached.wait(10)
+        # the writer holds the lock and has extended the top tree, but queries take no lock and are
+        # answered from the last snapshot until the next one is published
+        assert not server.update_lock.acquire(False)
+        assert server.top_root != old_root
+        assert tuple(json.loads(query(server, '/getroot').data)['root']) == old_root
+        r = json.loads(query(server, '/getout', idx=100).data)
+        assert client.check_path(r['found'], r['proof'], old_root)
+        assert 'Failure' in json.loads(query(server, '/getout', idx=old_root[1] + 1).data)
+    finally:
+        release.set()
+        writer.join()
+    new_root = tuple(json.loads(query(server, '/getroot').data)['root'])
+    assert new_root == server.top_root != old_root
+    r = json.loads(query(server, '/getout', idx=old_root[1] + 1).data)
+    assert client.check_path(r['found'], r['proof'], new_root)
+
+def test_ingestor_reorg(server, outkeys, tmpdir):
+    import sqlite3
+    blocks = list(server.group_blocks(outkeys))
+    database_path = str(tmpdir.join('out.db'))
+    conn = sqlite3.connect(database_path)
+    conn.execute('''CREATE TABLE out_table (block_hash text, tx_hash text, outkey text, idx integer primary key)''')
+    conn.executemany('''INSERT INTO out_table VALUES (?,?,?,?)''', outkeys)
+    conn.commit()
+    ingestor = server.BlockIngestor(database_path, batch_size=8, depth=4)
+    try:
+        while ingestor.poll() or server.top_root[1] < outkeys[-1][3]:
+            pass
+        assert ingestor.blocks == 20 and ingestor.reorgs == 0
+        # the last two blocks are replaced by others over the same global indices
+        replaced = [(row[0] + '-fork', row[1] + '-fork', row[2] + '-fork', row[3]) for block in blocks[-2:] for row in block]
+        conn.executemany('''REPLACE INTO out_table VALUES (?,?,?,?)''', replaced)
+        conn.commit()
+        while ingestor.poll() or server.top_root[1] < outkeys[-1][3]:
+            pass
+        assert ingestor.reorgs == 1 and ingestor.blocks == 22 and ingestor.stats()['lag_outputs'] == 0
+        assert json.loads(query(server, '/getout', idx=replaced[0][3]).data)['found'][0] == replaced[0][2]
+        # the root is the one that building over the new chain gives
+        ingested = server.top_root
+        server.merkle_forest = {}
+        server.scan_over_new_blocks(outkeys[:-len(replaced)] + replaced)
+        assert server.top_root == ingested
+        # a reorg deeper than the recent blocks kept cannot be followed
+        conn.execute('''UPDATE out_table SET block_hash = block_hash || '-deep' WHERE idx > ?''', (blocks[-8][-1][3],))
+        conn.commit()
+        with pytest.raises(ValueError):
+            ingestor.poll()
+        assert server.top_root == ingested
+    finally:
+        ingestor.stop()
+        conn.close()
+
+def test_metrics(server, monkeypatch):
+    monkeypatch.setattr(server, 'request_metrics', server.RequestMetrics())
+    client = server.app.test_client()
+    for _ in range(3):
+        client.get('/getroot')
+    query(server, '/getout', idx=100)
+    # a request without a body raises, and is counted as an error
+    assert client.get('/getout').status_code == 500
+    collected = json.loads(client.get('/metrics', headers={'Accept': 'application/json'}).data)
+    routes = collected['routes']
+    assert routes['/getroot']['count'] == 3 and routes['/getroot']['errors'] == 0
+    assert routes['/getout']['count'] == 2 and routes['/getout']['errors'] == 1
+    assert '/metrics' not in routes
+    for r in routes.values():
+        # one cumulative bucket for each bound and one for anything slower, which holds every request
+        assert len(r['buckets']) == len(collected['buckets']) + 1 and r['buckets'][-1] == r['count']
+        assert r['buckets'] == sorted(r['buckets']) and r['sum'] > 0
+    assert collected['top_idx'] == server.top_root[1] and collected['top_blocks'] == server.top_merkle.num_leaves
+    assert collected['forest']['trees'] == len(server.merkle_forest) and collected['proof_cache']['misses'] >= 1
+    # the Prometheus text has the same numbers, and the JSON request is counted by now
+    text = client.get('/metrics')
+    assert text.mimetype == 'text/plain'
+    samples = dict(line.rsplit(' ', 1) for line in text.data.splitlines() if not line.startswith('#'))
+    assert samples['monero_ads_request_seconds_count{route="/getroot"}'] == '3'
+    assert samples['monero_ads_request_seconds_bucket{route="/getout",le="+Inf"}'] == '2'
+    assert samples['monero_ads_request_errors_total{route="/getout"}'] == '1'
+    assert samples['monero_ads_request_seconds_count{route="/metrics"}'] == '1'
+    assert samples['monero_ads_top_idx'] == str(server.top_root[1])
+    assert '# TYPE monero_ads_request_seconds histogram' in text.data.splitlines()
+    monkeypatch.setattr(server, 'request_metrics', None)
+    assert 'Failure' in json.loads(client.get('/metrics').data)
+
+def test_proof_cache_across_rollback(server, outkeys):
+    import monero_client as client
+    blocks = list(server.group_blocks(outkeys))[-22:-20]
+    held, last = server.current_snapshot(), server.top_root[1]
+    assert server.rollback_blocks(height=server.top_merkle.num_leaves - 2) == 2
+    # a query still answered from the snapshot before the rollback does not leave its entry behind
+    server.output_entry(last, held)
+    assert last not in server.proof_cache.entries
+    # so once other blocks take the place of the ones removed, the output is found in them
+    forked = [(row[0] + '-fork', row[1] + '-fork', row[2] + '-fork', row[3]) for block in blocks for row in block]
+    server.queue_new_blocks(forked)
+    assert server.add_blocks() == 2
+    r = json.loads(query(server, '/getout', idx=last).data)
+    assert r['found'][0] == forked[-1][2] and client.check_path(r['found'], r['proof'], server.top_root)
+    # an entry whose block is not the one at its position in the top tree any more is made again
+    server.proof_cache.entries[last][5] = hash_function('other').digest()
+    again = json.loads(query(server, '/getout', idx=last).data)
+    assert again == r and server.proof_cache.entries[last][5] == server.top_merkle.leaf_key(server.top_merkle.num_leaves - 1)
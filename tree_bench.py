@@ -0,0 +1,160 @@
+'''Benchmarks of the trees themselves, over synthetic leaves, and the synthetic out_table rows that
+the other benchmarks run over.
+
+    python tree_bench.py memory|append|inline|hash [num_leaves]
+'''
+import time, sys, gc, itertools
+import numpy as np
+from hashlib import sha256
+from merkle import MerkleTree, FlatMerkleTree
+
+def make_leaves(n):
+    '''Generates n synthetic leaves, shaped like the (root, idx) pairs of the block and top trees.'''
+    return [(sha256(str(i)).digest(), i) for i in range(n)]
+
+def node_tree_size(m):
+    '''Counts the bytes held by a Node based MerkleTree: every node, its digest and the leaf list.
+    Leaf data is left out, since it is shared with the caller.'''
+    seen = set()
+    total = sys.getsizeof(m) + sys.getsizeof(m.__dict__) + sys.getsizeof(m.leaves)
+    nodes = list(m.leaves)
+    while nodes:
+        node = nodes.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        total += sys.getsizeof(node) + sys.getsizeof(node.val)
+        if node.p is not None:
+            nodes.append(node.p)
+    return total
+
+def flat_tree_size(m):
+    '''Counts the bytes held by a FlatMerkleTree: the level buffers, the idx arrays and the keys.'''
+    total = sys.getsizeof(m) + sys.getsizeof(m.levels) + sys.getsizeof(m.idxs) + sys.getsizeof(m.data)
+    if m.inline is not None:
+        total += sys.getsizeof(m.inline)
+    for level in m.levels:
+        total += sys.getsizeof(level)
+    for idxs in m.idxs:
+        total += sys.getsizeof(idxs)
+    return total
+
+def build_time(cls, leaves, **kwargs):
+    '''Returns the time taken to build a tree over the leaves, and the tree.'''
+    gc.collect()
+    start = time.time()
+    m = cls(leaves=leaves, **kwargs)
+    m.build()
+    end = time.time()
+    return end - start, m
+
+def proof_time(m, n, trials=1000):
+    '''Returns the average time taken to assemble a hex proof for a random leaf.'''
+    picks = np.random.randint(0, n, trials)
+    start = time.time()
+    for i in picks:
+        m.get_proof(i)
+    end = time.time()
+    return (end - start) / trials
+
+def append_time(cls, leaves, **kwargs):
+    '''Returns the average time taken to add each leaf after the first to a built tree with add_adjust.'''
+    gc.collect()
+    m = cls(leaves=leaves[:1], **kwargs)
+    m.build()
+    start = time.time()
+    for leaf in leaves[1:]:
+        m.add_adjust(leaf)
+    end = time.time()
+    return (end - start) / (len(leaves) - 1), m
+
+def make_outkeys(n, seed=1):
+    '''Generates about n synthetic rows of the out_table, with 1 to 5 txs per block and 1 to 4
+    outputs per tx.'''
+    r = np.random.RandomState(seed)
+    rows, idx, b = [], 0, 0
+    while idx < n:
+        block_hash = sha256('b%d' % b).hexdigest()
+        for t in range(r.randint(1, 6)):
+            tx_hash = sha256('t%d-%d' % (b, t)).hexdigest()
+            for _ in range(r.randint(1, 5)):
+                rows.append((block_hash, tx_hash, sha256('o%d' % idx).hexdigest(), idx))
+                idx += 1
+        b += 1
+    return rows
+
+def forest_size(forest):
+    '''Counts the bytes held by a forest of flat trees: the dict, its keys and every tree.'''
+    total = sys.getsizeof(forest)
+    for key, tree in forest.iteritems():
+        total += sys.getsizeof(key) + flat_tree_size(tree)
+    return total
+
+def main():
+    first_arg = sys.argv[1] if len(sys.argv) > 1 else None
+    num_leaves = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    if first_arg=="memory":
+        print "Comparing Node and flat trees over %d leaves..."%(num_leaves)
+        leaves = make_leaves(num_leaves)
+        hex_leaves = [(key.encode('hex'), idx) for key, idx in leaves]
+        node_time, node_tree = build_time(MerkleTree, hex_leaves)
+        flat_time, flat_tree = build_time(FlatMerkleTree, leaves, keyed=True)
+        assert node_tree.root.val == flat_tree.root_val
+        node_bytes, flat_bytes = node_tree_size(node_tree), flat_tree_size(flat_tree)
+        print "Node tree: %d bytes (%.1f per leaf), built in %.6f seconds."%(node_bytes, float(node_bytes)/num_leaves, node_time)
+        print "Flat tree: %d bytes (%.1f per leaf), built in %.6f seconds."%(flat_bytes, float(flat_bytes)/num_leaves, flat_time)
+        print "Average time to get a proof is %.6f seconds for the Node tree and %.6f seconds for the flat tree."%(
+            proof_time(node_tree, num_leaves), proof_time(flat_tree, num_leaves))
+    elif first_arg=="append":
+        print "Appending %d leaves one at a time..."%(num_leaves)
+        leaves = make_leaves(num_leaves)
+        hex_leaves = [(key.encode('hex'), idx) for key, idx in leaves]
+        node_time, node_tree = append_time(MerkleTree, hex_leaves)
+        flat_time, flat_tree = append_time(FlatMerkleTree, leaves, keyed=True)
+        _, control_tree = build_time(FlatMerkleTree, leaves, keyed=True)
+        assert node_tree.root.val == flat_tree.root_val == control_tree.root_val
+        print "Average time to add a leaf is %.6f seconds for the Node tree and %.6f seconds for the flat tree."%(node_time, flat_time)
+    elif first_arg=="inline":
+        import monero_server
+        print "Building the forest over %d outputs with and without inline single output txs..."%(num_leaves)
+        rows = make_outkeys(num_leaves)
+        singles = sum(1 for _, tx in itertools.groupby(rows, key=lambda row: row[1]) if len(list(tx)) == 1)
+        results = []
+        for inline in (False, True):
+            monero_server.inline_single_outputs = inline
+            monero_server.merkle_forest = {}
+            gc.collect()
+            start = time.time()
+            monero_server.scan_over_new_blocks(rows, workers=1)
+            end = time.time()
+            forest = monero_server.merkle_forest
+            blob_bytes = sum(len(tree.serialize()) for tree in forest.itervalues())
+            results.append((monero_server.top_root, len(forest), forest_size(forest), blob_bytes, end - start))
+        assert results[0][0] == results[1][0]
+        scale = 1000000.0 / len(rows)
+        print "%d outputs, %d of them alone in their tx."%(len(rows), singles)
+        for name, (_, trees, mem, blob, built) in zip(("Separate trees", "Inline"), results):
+            print "%s: %d trees, %.1f MB in memory and %.1f MB serialized per million outputs, built in %.3f seconds."%(
+                name, trees, mem * scale / 1e6, blob * scale / 1e6, built)
+        print "Inlining saves %.1f MB in memory and %.1f MB serialized per million outputs."%(
+            (results[0][2] - results[1][2]) * scale / 1e6, (results[0][3] - results[1][3]) * scale / 1e6)
+    elif first_arg=="hash":
+        import hash_backends
+        from merkle import check_proof
+        print "Building flat trees over %d leaves with each hash backend..."%(num_leaves)
+        leaves = make_leaves(num_leaves)
+        for name in sorted(hash_backends.BACKENDS, key=lambda name: hash_backends.BACKENDS[name].code):
+            backend = hash_backends.get(name)
+            built, m = build_time(FlatMerkleTree, leaves, keyed=True, backend=name)
+            proofs = [m.get_proof(i) for i in np.random.randint(0, num_leaves, 1000)]
+            start = time.time()
+            for proof in proofs:
+                check_proof(proof, name)
+            checked = time.time() - start
+            print "%s (%s): built at %.0f leaves per second, and checks %.0f proofs per second."%(
+                name, "native" if backend.native else "pure Python", num_leaves / built, len(proofs) / checked)
+    else:
+        print "Please provide a valid argument."
+
+if __name__ == '__main__':
+    main()